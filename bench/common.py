@@ -0,0 +1,180 @@
+"""
+Shared helpers for the benchmark scripts: loading the app against a scratch database,
+seeding it with generated catalog data, and measuring latency, SQL statements and memory.
+"""
+import datetime
+import os
+import resource
+import random
+import sys
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC)
+
+BENCH_PASSWORD = 'starwars'
+BENCH_JWT_SECRET = 'benchmark-secret-benchmark-secret-benchmark'
+
+DEFAULT_VOLUMES = {
+    "planets": 60,
+    "characters": 1000,
+    "species": 40,
+    "films": 7,
+    "users": 100,
+    "favorites": 2000,
+}
+
+def load_app(db_url, **env):
+    """Build the app of main.py against `db_url`, the environment has to be set before the import."""
+    os.environ['DB_CONNECTION_STRING'] = db_url
+    os.environ.setdefault('JWT_SECRET_KEY', BENCH_JWT_SECRET)
+    # a few clients send all the traffic, the limiter is only on when measuring it (--rate-limit)
+    os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+    for key, value in env.items():
+        os.environ[key] = str(value)
+    import main
+    return main.create_app()
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+def latency_summary(latencies, elapsed):
+    # latencies in seconds, reported in milliseconds
+    return {
+        "requests": len(latencies),
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3) if latencies else None,
+    }
+
+def peak_rss_kb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def process_rss_kb(pid, field='VmRSS'):
+    # VmRSS is the current resident size, VmHWM the peak; Linux only
+    try:
+        with open('/proc/%d/status' % pid) as status:
+            for line in status:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+class StatementCounter:
+    """Counts the statements sent to `engine` while active."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def on_execute(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        from sqlalchemy import event
+        event.listen(self.engine, 'before_cursor_execute', self.on_execute)
+        return self
+
+    def __exit__(self, *args):
+        from sqlalchemy import event
+        event.remove(self.engine, 'before_cursor_execute', self.on_execute)
+
+def chunks(rows, size=1000):
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+def reset_sequences(session, tables):
+    """
+    Move the PostgreSQL id sequences of `tables` past the rows inserted with explicit ids, or the
+    inserts of the API would start again at id 1. SQLite and MySQL follow max(id) by themselves.
+    """
+    from sqlalchemy import text
+    if session.get_bind().dialect.name != 'postgresql':
+        return
+    preparer = session.get_bind().dialect.identifier_preparer
+    for table in tables:
+        name = preparer.format_table(table)
+        session.execute(text("SELECT setval(pg_get_serial_sequence(:name, 'id'), COALESCE((SELECT MAX(id) FROM %s), 0) + 1, false)" % name),
+            {"name": name})
+
+def seed(app, volumes, seed_value=42):
+    """Create the tables and fill them with generated rows, returns the ids the scenarios need."""
+    from models import db, User, Planet, Character, Specie, Film, Favorite, species_characters, film_characters, film_planets, film_species
+    from auth import hash_password
+    from popular import reconcile
+
+    rnd = random.Random(seed_value)
+    start = time.perf_counter()
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        password = hash_password(BENCH_PASSWORD)
+
+        def insert(table, rows):
+            for chunk in chunks(rows):
+                db.session.execute(table.insert(), chunk)
+
+        planets = volumes["planets"]
+        characters = volumes["characters"]
+        species = volumes["species"]
+        films = volumes["films"]
+        users = volumes["users"]
+
+        insert(Planet.__table__, [{
+            "id": i, "name": "Planet %d" % i, "diameter": rnd.randint(1000, 20000), "rotation_period": rnd.randint(10, 40),
+            "orbital_period": rnd.randint(200, 600), "gravity": "1 standard", "population": rnd.randint(1000, 10 ** 9),
+            "climate": rnd.choice(["arid", "temperate", "frozen", "murky"]), "terrain": rnd.choice(["desert", "grasslands", "tundra", "swamp"]),
+            "surface_water": rnd.randint(0, 100)
+        } for i in range(1, planets + 1)])
+        insert(Character.__table__, [{
+            "id": i, "name": "Character %d" % i, "height": rnd.randint(60, 230), "mass": rnd.randint(20, 150),
+            "hair_color": rnd.choice(["blond", "brown", "black", "none"]), "skin_color": rnd.choice(["fair", "light", "dark", "green"]),
+            "eye_color": rnd.choice(["blue", "brown", "yellow", "red"]), "birth_year": "%dBBY" % rnd.randint(1, 900),
+            "gender": rnd.choice(["male", "female", "n/a"]), "planet_id": rnd.randint(1, planets)
+        } for i in range(1, characters + 1)])
+        insert(Specie.__table__, [{
+            "id": i, "name": "Specie %d" % i, "classification": rnd.choice(["mammal", "reptile", "artificial"]),
+            "designation": "sentient", "average_height": rnd.randint(50, 300), "average_lifespan": rnd.randint(30, 1000),
+            "hair_colors": "brown, black", "skin_colors": "green, grey", "eye_colors": "brown, blue", "language": "Galactic Basic",
+            "planet_id": rnd.randint(1, planets)
+        } for i in range(1, species + 1)])
+        insert(Film.__table__, [{
+            "id": i, "title": "Episode %d" % i, "episode_id": i, "producer": "Gary Kurtz, Rick McCallum", "director": "George Lucas",
+            "release_date": "1977-05-25", "opening": "It is a period of civil war. " * 40
+        } for i in range(1, films + 1)])
+        insert(species_characters, [{"specie_id": rnd.randint(1, species), "character_id": i} for i in range(1, characters + 1)])
+        insert(film_characters, [{"film_id": f, "character_id": c} for f in range(1, films + 1) for c in rnd.sample(range(1, characters + 1), min(characters, 40))])
+        insert(film_planets, [{"film_id": f, "planet_id": p} for f in range(1, films + 1) for p in rnd.sample(range(1, planets + 1), min(planets, 10))])
+        insert(film_species, [{"film_id": f, "specie_id": s} for f in range(1, films + 1) for s in rnd.sample(range(1, species + 1), min(species, 10))])
+        insert(User.__table__, [{"id": i, "email": "user%d@starwars.com" % i, "password": password, "is_active": True} for i in range(1, users + 1)])
+
+        favorites = set()
+        target = min(volumes["favorites"], users * 3 * planets)
+        while len(favorites) < target:
+            favorites.add((rnd.randint(1, users), rnd.choice("pcf"), rnd.randint(1, planets)))
+        insert(Favorite.__table__, [{
+            "id": i, "user_id": user_id, "favorite_type": favorite_type, "favorite_id": favorite_id, "favorite_name": "Favorite %d" % favorite_id
+        } for i, (user_id, favorite_type, favorite_id) in enumerate(sorted(favorites), 1)])
+        # the ids above are explicit so the association rows can refer to them
+        reset_sequences(db.session, [Planet.__table__, Character.__table__, Specie.__table__, Film.__table__, User.__table__, Favorite.__table__])
+        db.session.commit()
+        # favorite_count is maintained by the API, the bulk insert above bypasses it
+        reconcile(db.session)
+
+    return {
+        "volumes": volumes,
+        "seconds": round(time.perf_counter() - start, 3),
+        "favorite_ids": list(range(1, target + 1)),
+    }
+
+def mint_tokens(app, user_ids):
+    from flask_jwt_extended import create_access_token
+    with app.app_context():
+        # long lived so slow runs don't fail half way with expired tokens
+        return [create_access_token(identity=user_id, expires_delta=datetime.timedelta(hours=12)) for user_id in user_ids]
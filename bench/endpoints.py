@@ -0,0 +1,452 @@
+"""
+Latency / throughput benchmark for every route in src/main.py.
+
+    $ pipenv run python bench/endpoints.py                              # Flask test client, in process
+    $ pipenv run python bench/endpoints.py --characters 100000 --output run.json
+    $ pipenv run python bench/endpoints.py --server gunicorn --workers 4 --concurrency 16
+    $ pipenv run python bench/endpoints.py --output new.json --compare run.json
+
+The database (a scratch SQLite file by default, or --db postgresql://...) is dropped and seeded
+with the requested volumes, JWTs are minted for the seeded users, then every scenario runs
+--iterations times. For each one it reports throughput, p50/p95/p99 latency, SQL statements per
+request (test client only) and the peak RSS of the process (or the sum of the gunicorn workers).
+Results are written as JSON so two runs can be compared with --compare, which exits with
+status 1 when a p95 or a throughput gets worse than --tolerance.
+"""
+import argparse
+import collections
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common import SRC, BENCH_PASSWORD, BENCH_JWT_SECRET, DEFAULT_VOLUMES, load_app, seed, mint_tokens, \
+    latency_summary, peak_rss_kb, process_rss_kb, StatementCounter
+
+#----------------------------------------------SCENARIOS----------------------------------------
+
+# "<endpoint>" or "<endpoint>:<variant>" -> function(ctx, i) returning the request to send
+SCENARIOS = collections.OrderedDict()
+
+def scenario(name):
+    def decorator(build):
+        SCENARIOS[name] = build
+        return build
+    return decorator
+
+class Context:
+
+    def __init__(self, volumes, tokens, spare_tokens, favorite_ids, seed_value=42):
+        self.volumes = volumes
+        self.tokens = tokens
+        self.spare_tokens = collections.deque(spare_tokens)
+        self.favorite_ids = collections.deque(favorite_ids)
+        self.rnd = random.Random(seed_value)
+        self.run_id = '%x' % int(time.time() * 1000)
+
+    def user(self, i):
+        return i % self.volumes["users"] + 1
+
+    def token(self, i):
+        return self.tokens[self.user(i) - 1]
+
+    def some(self, volume):
+        return self.rnd.randint(1, self.volumes[volume])
+
+    def favorite_keys(self, count, with_name=False):
+        keys = []
+        for _ in range(count):
+            key = {"favorite_type": self.rnd.choice("pcf"), "favorite_id": self.some("planets")}
+            if with_name:
+                key["favorite_name"] = "Favorite %d" % key["favorite_id"]
+            keys.append(key)
+        return keys
+
+def request(method, path, token=None, body=None, headers=None):
+    return {"method": method, "path": path, "token": token, "json": body, "headers": headers or {}}
+
+@scenario('sitemap')
+def sitemap(ctx, i):
+    return request('GET', '/')
+
+@scenario('create_user')
+def create_user(ctx, i):
+    return request('POST', '/register', body={"email": "bench-%s-%d@starwars.com" % (ctx.run_id, i), "password": BENCH_PASSWORD})
+
+@scenario('login')
+def login(ctx, i):
+    return request('POST', '/login', body={"email": "user%d@starwars.com" % ctx.user(i), "password": BENCH_PASSWORD})
+
+@scenario('logout')
+def logout(ctx, i):
+    return request('POST', '/logout', token=ctx.spare_tokens.popleft())
+
+@scenario('health')
+def health(ctx, i):
+    return request('GET', '/health')
+
+@scenario('get_metrics')
+def get_metrics(ctx, i):
+    return request('GET', '/metrics')
+
+@scenario('get_cache_stats')
+def get_cache_stats(ctx, i):
+    return request('GET', '/cache/stats', token=ctx.token(i))
+
+@scenario('get_all_users')
+def get_all_users(ctx, i):
+    return request('GET', '/user', token=ctx.token(i))
+
+@scenario('get_user_favorite')
+def get_user_favorite(ctx, i):
+    return request('GET', '/user/%d/favorites' % ctx.user(i), token=ctx.token(i))
+
+@scenario('post_user_favorite')
+def post_user_favorite(ctx, i):
+    return request('POST', '/user/%d/favorites' % ctx.user(i), token=ctx.token(i), body=ctx.favorite_keys(1, with_name=True)[0])
+
+@scenario('post_user_favorites_batch')
+def post_user_favorites_batch(ctx, i):
+    return request('POST', '/user/%d/favorites/batch' % ctx.user(i), token=ctx.token(i), body=ctx.favorite_keys(20, with_name=True))
+
+@scenario('check_user_favorites')
+def check_user_favorites(ctx, i):
+    return request('POST', '/user/%d/favorites/check' % ctx.user(i), token=ctx.token(i), body=ctx.favorite_keys(20))
+
+@scenario('delete_user_favorites_batch')
+def delete_user_favorites_batch(ctx, i):
+    return request('DELETE', '/user/%d/favorites/batch' % ctx.user(i), token=ctx.token(i), body=ctx.favorite_keys(20))
+
+@scenario('get_favorite')
+def get_favorite(ctx, i):
+    key = ctx.favorite_keys(1)[0]
+    key["user_id"] = ctx.user(i)
+    return request('POST', '/favorite', token=ctx.token(i), body=key)
+
+@scenario('delete_favorite')
+def delete_favorite(ctx, i):
+    # every call deletes another seeded favorite, the ones already gone answer 404
+    fid = ctx.favorite_ids.popleft() if ctx.favorite_ids else 0
+    return request('DELETE', '/favorite/%d' % fid, token=ctx.token(i))
+
+@scenario('get_all_planets')
+def get_all_planets(ctx, i):
+    return request('GET', '/planet', token=ctx.token(i))
+
+@scenario('get_planet')
+def get_planet(ctx, i):
+    return request('GET', '/planet/%d' % ctx.some("planets"), token=ctx.token(i))
+
+@scenario('get_all_characters')
+def get_all_characters(ctx, i):
+    return request('GET', '/character', token=ctx.token(i))
+
+@scenario('get_all_characters:stream')
+def get_all_characters_stream(ctx, i):
+    return request('GET', '/character?stream=1', token=ctx.token(i))
+
+@scenario('get_all_characters:filtered')
+def get_all_characters_filtered(ctx, i):
+    return request('GET', '/character?gender=female&planet_id=%d' % ctx.some("planets"), token=ctx.token(i))
+
+@scenario('get_all_characters:ids')
+def get_all_characters_ids(ctx, i):
+    ids = ','.join(str(ctx.some("characters")) for _ in range(20))
+    return request('GET', '/character?ids=%s' % ids, token=ctx.token(i))
+
+@scenario('get_character')
+def get_character(ctx, i):
+    return request('GET', '/character/%d' % ctx.some("characters"), token=ctx.token(i))
+
+@scenario('get_character:include')
+def get_character_include(ctx, i):
+    return request('GET', '/character/%d?include=planet,species,films' % ctx.some("characters"), token=ctx.token(i))
+
+@scenario('get_all_species')
+def get_all_species(ctx, i):
+    return request('GET', '/specie', token=ctx.token(i))
+
+@scenario('get_specie')
+def get_specie(ctx, i):
+    return request('GET', '/specie/%d' % ctx.some("species"), token=ctx.token(i))
+
+@scenario('get_all_film')
+def get_all_film(ctx, i):
+    return request('GET', '/film', token=ctx.token(i))
+
+@scenario('get_all_film:gzip')
+def get_all_film_gzip(ctx, i):
+    return request('GET', '/film', token=ctx.token(i), headers={"Accept-Encoding": "gzip"})
+
+@scenario('get_film')
+def get_film(ctx, i):
+    return request('GET', '/film/%d' % ctx.some("films"), token=ctx.token(i))
+
+@scenario('search')
+def search(ctx, i):
+    return request('GET', '/search?q=%s' % ctx.rnd.choice(['char', 'planet 1', 'episode', 'spe']), token=ctx.token(i))
+
+@scenario('get_popular')
+def get_popular(ctx, i):
+    return request('GET', '/popular?type=%s' % ctx.rnd.choice("pcf"), token=ctx.token(i))
+
+@scenario('get_batch')
+def get_batch(ctx, i):
+    ids = ['character:%d' % ctx.some("characters") for _ in range(8)] + ['planet:%d' % ctx.some("planets"), 'film:%d' % ctx.some("films")]
+    return request('GET', '/batch?ids=%s' % ','.join(ids), token=ctx.token(i))
+
+@scenario('export_catalog')
+def export_catalog(ctx, i):
+    return request('GET', '/export', token=ctx.token(i))
+
+@scenario('export_catalog:csv_gzip')
+def export_catalog_csv_gzip(ctx, i):
+    return request('GET', '/export?format=csv&tables=character', token=ctx.token(i), headers={"Accept-Encoding": "gzip"})
+
+def main_endpoints(app):
+    # the endpoints of the api blueprint, without its 'api.' prefix
+    return sorted(name.partition('.')[2] for name in app.view_functions if name.startswith('api.'))
+
+def check_coverage(app):
+    covered = set(name.split(':')[0] for name in SCENARIOS)
+    missing = [name for name in main_endpoints(app) if name not in covered]
+    for name in missing:
+        print('warning: no benchmark scenario for endpoint %s' % name, file=sys.stderr)
+    return missing
+
+#----------------------------------------------RUNNERS----------------------------------------
+
+def run_client(app, ctx, names, iterations, warmup):
+    from models import db
+
+    client = app.test_client()
+    with app.app_context():
+        engine = db.engine
+
+    def send(req):
+        headers = dict(req["headers"])
+        if req["token"]:
+            headers["Authorization"] = "Bearer " + req["token"]
+        response = client.open(req["path"], method=req["method"], json=req["json"], headers=headers)
+        body = response.get_data()
+        response.close()
+        return response.status_code, len(body)
+
+    results = collections.OrderedDict()
+    for name in names:
+        build = SCENARIOS[name]
+        for i in range(warmup):
+            send(build(ctx, i))
+        requests = [build(ctx, warmup + i) for i in range(iterations)]
+        latencies = []
+        statuses = collections.Counter()
+        size = 0
+        with StatementCounter(engine) as counter:
+            start = time.perf_counter()
+            for req in requests:
+                t0 = time.perf_counter()
+                status, length = send(req)
+                latencies.append(time.perf_counter() - t0)
+                statuses[status] += 1
+                size += length
+            elapsed = time.perf_counter() - start
+        result = latency_summary(latencies, elapsed)
+        result.update({
+            "statements_per_request": round(counter.count / float(iterations), 2),
+            "bytes_per_response": int(size / iterations),
+            "status": dict((str(k), v) for k, v in statuses.items()),
+            "errors": sum(v for k, v in statuses.items() if k >= 500),
+            "peak_rss_kb": peak_rss_kb(),
+        })
+        results[name] = result
+        print_result(name, result)
+    return results
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def child_pids(pid):
+    try:
+        with open('/proc/%d/task/%d/children' % (pid, pid)) as children:
+            return [int(x) for x in children.read().split()]
+    except OSError:
+        return []
+
+def server_rss_kb(pid, field='VmRSS'):
+    values = [process_rss_kb(p, field) for p in [pid] + child_pids(pid)]
+    values = [v for v in values if v is not None]
+    return sum(values) if values else None
+
+def start_gunicorn(db_url, args):
+    port = free_port()
+    env = dict(os.environ, DB_CONNECTION_STRING=db_url, JWT_SECRET_KEY=os.environ.get('JWT_SECRET_KEY', BENCH_JWT_SECRET))
+    command = ['gunicorn', 'wsgi', '--chdir', SRC, '--bind', '127.0.0.1:%d' % port, '--workers', str(args.workers),
+        '--worker-class', args.worker_class, '--threads', str(args.threads), '--log-level', 'warning']
+    process = subprocess.Popen(command, env=env)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/')
+            connection.getresponse().read()
+            return process, port
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('gunicorn did not start on port %d' % port)
+
+def run_server(port, pid, ctx, names, iterations, warmup, concurrency):
+
+    def send(req):
+        headers = dict(req["headers"])
+        body = None
+        if req["token"]:
+            headers["Authorization"] = "Bearer " + req["token"]
+        if req["json"] is not None:
+            body = json.dumps(req["json"])
+            headers["Content-Type"] = "application/json"
+        t0 = time.perf_counter()
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        try:
+            connection.request(req["method"], req["path"], body=body, headers=headers)
+            response = connection.getresponse()
+            length = len(response.read())
+            status = response.status
+        except OSError:
+            status, length = 599, 0
+        finally:
+            connection.close()
+        return time.perf_counter() - t0, status, length
+
+    results = collections.OrderedDict()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for name in names:
+            build = SCENARIOS[name]
+            list(pool.map(send, [build(ctx, i) for i in range(warmup)]))
+            requests = [build(ctx, warmup + i) for i in range(iterations)]
+            start = time.perf_counter()
+            responses = list(pool.map(send, requests))
+            elapsed = time.perf_counter() - start
+            statuses = collections.Counter(status for _, status, _ in responses)
+            result = latency_summary([latency for latency, _, _ in responses], elapsed)
+            result.update({
+                "statements_per_request": None,
+                "bytes_per_response": int(sum(length for _, _, length in responses) / iterations),
+                "status": dict((str(k), v) for k, v in statuses.items()),
+                "errors": sum(v for k, v in statuses.items() if k >= 500),
+                "peak_rss_kb": server_rss_kb(pid, 'VmHWM'),
+            })
+            results[name] = result
+            print_result(name, result)
+    return results
+
+#----------------------------------------------REPORT----------------------------------------
+
+def print_result(name, r):
+    print('%-34s %9s req/s  p50 %8s ms  p95 %8s ms  p99 %8s ms  sql %5s  err %d' % (
+        name, r["throughput_rps"], r["p50_ms"], r["p95_ms"], r["p99_ms"], r["statements_per_request"], r["errors"]), file=sys.stderr)
+
+def compare(baseline, current, tolerance):
+    regressions = []
+    for name, new in current["endpoints"].items():
+        old = baseline.get("endpoints", {}).get(name, None)
+        if old is None or not old.get("p95_ms") or not old.get("throughput_rps"):
+            continue
+        if new["p95_ms"] > old["p95_ms"] * (1 + tolerance):
+            regressions.append('%s: p95 %.3f ms -> %.3f ms' % (name, old["p95_ms"], new["p95_ms"]))
+        if new["throughput_rps"] < old["throughput_rps"] * (1 - tolerance):
+            regressions.append('%s: throughput %.1f -> %.1f req/s' % (name, old["throughput_rps"], new["throughput_rps"]))
+    return regressions
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', help='database URL, a scratch SQLite file by default (it is dropped and re-seeded)')
+    parser.add_argument('--server', default='client', choices=['client', 'gunicorn'])
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--worker-class', default='sync')
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--concurrency', type=int, default=8, help='parallel clients, gunicorn only')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--only', help='comma separated scenario names')
+    parser.add_argument('--no-cache', action='store_true', help='run with CACHE_ENABLED=0')
+    parser.add_argument('--rate-limit', metavar='BACKEND', nargs='?', const='memory',
+        help='run with the rate limiter and the concurrency cap on, with limits never reached, to measure their overhead')
+    parser.add_argument('--output', help='write the JSON results here instead of stdout')
+    parser.add_argument('--compare', help='JSON results of a previous run')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    for volume, default in DEFAULT_VOLUMES.items():
+        parser.add_argument('--' + volume, type=int, default=default)
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    db_url = args.db or 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='swapi-bench-'), 'bench.db')
+    env = {"CACHE_ENABLED": 0} if args.no_cache else {}
+    if args.rate_limit:
+        env.update({"RATE_LIMIT_ENABLED": 1, "RATE_LIMIT_BACKEND": args.rate_limit, "RATE_LIMIT_DEFAULT": "1000000/second",
+            "RATE_LIMITS": "", "MAX_CONCURRENT_REQUESTS": 10000})
+    app = load_app(db_url, **env)
+
+    volumes = dict((volume, getattr(args, volume)) for volume in DEFAULT_VOLUMES)
+    seeded = seed(app, volumes)
+    runs = args.iterations + args.warmup
+    ctx = Context(volumes, mint_tokens(app, range(1, volumes["users"] + 1)),
+        mint_tokens(app, [1] * runs), seeded["favorite_ids"])
+
+    missing = check_coverage(app)
+    names = args.only.split(',') if args.only else list(SCENARIOS)
+
+    if args.server == 'client':
+        results = run_client(app, ctx, names, args.iterations, args.warmup)
+    else:
+        process, port = start_gunicorn(db_url, args)
+        try:
+            results = run_server(port, process.pid, ctx, names, args.iterations, args.warmup, args.concurrency)
+        finally:
+            process.terminate()
+            process.wait()
+
+    report = {
+        "meta": {
+            "server": args.server,
+            "workers": args.workers if args.server == 'gunicorn' else None,
+            "worker_class": args.worker_class if args.server == 'gunicorn' else None,
+            "threads": args.threads if args.server == 'gunicorn' else None,
+            "concurrency": args.concurrency if args.server == 'gunicorn' else 1,
+            "iterations": args.iterations,
+            "cache": not args.no_cache,
+            "rate_limit": args.rate_limit,
+            "database": db_url.split(':')[0],
+            "python": sys.version.split()[0],
+            "timestamp": int(time.time()),
+        },
+        "seed": {"volumes": volumes, "seconds": seeded["seconds"]},
+        "missing_scenarios": missing,
+        "endpoints": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), report, args.tolerance)
+        for line in regressions:
+            print('regression: ' + line, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
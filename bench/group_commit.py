@@ -0,0 +1,96 @@
+"""
+POST /user/<tid>/favorites under a burst, with and without group commit (group_commit.py).
+
+    $ pipenv run python bench/group_commit.py
+    $ pipenv run python bench/group_commit.py --threads 64 --requests 4000 --db postgresql://localhost/swapi_bench
+
+--threads clients send --requests new favorites in total through the Flask test client of one
+process (a gthread worker under a burst), first committing every request, then with
+FAVORITES_GROUP_COMMIT. Commits are counted on the engine; the table reports database commits
+per second next to stored favorites per second and the latency percentiles.
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common import DEFAULT_VOLUMES, load_app, seed, mint_tokens, latency_summary
+
+def run(app, tokens, users, threads, requests, offset):
+    from sqlalchemy import event
+    from models import db
+
+    commits = []
+    with app.app_context():
+        engine = db.engine
+    on_commit = lambda connection: commits.append(1)
+    event.listen(engine, 'commit', on_commit)
+    counter = itertools.count()
+    local = threading.local()
+
+    def post(i):
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+        n = next(counter)
+        user = n % users + 1
+        body = {"favorite_type": "p", "favorite_id": offset + n, "favorite_name": "Favorite %d" % n}
+        start = time.perf_counter()
+        response = local.client.post('/user/%d/favorites' % user, json=body, headers={"Authorization": "Bearer " + tokens[user - 1]})
+        return time.perf_counter() - start, response.status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        results = list(pool.map(post, range(requests)))
+    elapsed = time.perf_counter() - start
+    event.remove(engine, 'commit', on_commit)
+
+    summary = latency_summary([latency for latency, status in results if status == 200], elapsed)
+    summary.update({
+        "errors": sum(1 for latency, status in results if status != 200),
+        "commits": len(commits),
+        "commits_per_sec": round(len(commits) / elapsed, 1),
+        "favorites_per_commit": round(summary["requests"] / len(commits), 2) if commits else None,
+    })
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', help='database URL, a scratch SQLite file by default (it is dropped and re-seeded)')
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--wait-ms', type=float, default=5)
+    parser.add_argument('--max-items', type=int, default=100)
+    parser.add_argument('--output', help='write the JSON results here instead of stdout')
+    args = parser.parse_args()
+
+    db_url = args.db or 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='swapi-bench-'), 'bench.db')
+    # a connection per client thread, the pool is not what is measured
+    app = load_app(db_url, CACHE_ENABLED=0, DB_POOL_SIZE=args.threads + 1, FAVORITES_GROUP_COMMIT_MS=args.wait_ms, FAVORITES_GROUP_COMMIT_MAX=args.max_items)
+    volumes = DEFAULT_VOLUMES
+    seeded = seed(app, volumes)
+    print('seeded %s in %.1f s' % (volumes, seeded["seconds"]), file=sys.stderr)
+    tokens = mint_tokens(app, range(1, volumes["users"] + 1))
+
+    results = {}
+    # favorite ids above the seeded ones, so every request inserts a new row
+    for offset, (name, grouped) in enumerate((('per_request', False), ('group_commit', True)), 1):
+        app.config['FAVORITES_GROUP_COMMIT'] = grouped
+        results[name] = r = run(app, tokens, volumes["users"], args.threads, args.requests, offset * 10 ** 6)
+        print('%-12s %8.1f favorites/s  %8.1f commits/s  %6.2f per commit  p50 %8.3f ms  p99 %8.3f ms  err %d' % (
+            name, r["throughput_rps"], r["commits_per_sec"], r["favorites_per_commit"] or 0, r["p50_ms"], r["p99_ms"], r["errors"]), file=sys.stderr)
+
+    output = json.dumps({"database": db_url.split(':')[0], "threads": args.threads, "wait_ms": args.wait_ms,
+        "max_items": args.max_items, "results": results}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
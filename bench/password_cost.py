@@ -0,0 +1,79 @@
+"""
+Login cost per password hashing setting, to size the gunicorn workers.
+
+    $ pipenv run python bench/password_cost.py
+    $ pipenv run python bench/password_cost.py --method pbkdf2_sha256 --costs 100000,300000,600000 --threads 4
+
+For every cost it verifies a password (what /login does) in a loop and reports the latency
+percentiles of a single check and the checks per second one worker can do with --threads
+threads (hashlib releases the GIL, so threads scale up to the number of cores).
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common import percentile
+from auth import derive, SALT_BYTES
+
+DEFAULT_COSTS = {
+    'scrypt': [12, 13, 14, 15],
+    'pbkdf2_sha256': [100000, 300000, 600000, 1200000],
+}
+
+def make_hash(method, cost, password):
+    salt = os.urandom(SALT_BYTES)
+    return method, cost, salt, derive(method, cost, password, salt)
+
+def check(stored, password):
+    method, cost, salt, expected = stored
+    return derive(method, cost, password, salt) == expected
+
+def run(method, cost, iterations, threads):
+    stored = make_hash(method, cost, 'starwars')
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        check(stored, 'starwars')
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(lambda _: check(stored, 'starwars'), range(iterations * threads)))
+    elapsed = time.perf_counter() - start
+
+    return {
+        "method": method,
+        "cost": cost,
+        "p50_ms": round(statistics.median(latencies), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "logins_per_sec_1_thread": round(1000 / statistics.mean(latencies), 1),
+        "logins_per_sec_per_worker": round(iterations * threads / elapsed, 1),
+        "threads": threads,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--method', default='scrypt', choices=sorted(DEFAULT_COSTS))
+    parser.add_argument('--costs', help='comma separated, log2(N) for scrypt or iterations for pbkdf2_sha256')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--threads', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    costs = [int(x) for x in args.costs.split(',')] if args.costs else DEFAULT_COSTS[args.method]
+    results = [run(args.method, cost, args.iterations, args.threads) for cost in costs]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print('%-14s %9s %9s %9s %9s %12s %16s' % ('method', 'cost', 'p50 ms', 'p95 ms', 'p99 ms', 'login/s x1', 'login/s worker'))
+    for r in results:
+        print('%-14s %9d %9.2f %9.2f %9.2f %12.1f %16.1f' % (r["method"], r["cost"], r["p50_ms"], r["p95_ms"],
+            r["p99_ms"], r["logins_per_sec_1_thread"], r["logins_per_sec_per_worker"]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Cost of one token bucket check per rate limiter backend.
+
+    $ pipenv run python bench/ratelimit.py
+    $ pipenv run python bench/ratelimit.py --keys 10000 --threads 8
+
+The whole per-request overhead (JWT identity, bucket, headers) is measured by running
+bench/endpoints.py with and without --rate-limit, see docs/BENCHMARKS.md.
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common import percentile
+from ratelimit import MemoryBackend, SQLiteBackend, BackendUnavailable
+
+def take(backend, i, keys):
+    # True when the backend answered, the API lets the request through otherwise (fail open)
+    try:
+        backend.take('get_film:user:%d' % (i % keys), 1000000.0, 1000000)
+        return True
+    except BackendUnavailable:
+        return False
+
+def run(backend, keys, iterations, threads):
+    latencies = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        take(backend, i, keys)
+        latencies.append((time.perf_counter() - start) * 1e6)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        answered = list(pool.map(lambda i: take(backend, i, keys), range(iterations)))
+    elapsed = time.perf_counter() - start
+    return {
+        "p50_us": round(percentile(latencies, 50), 2),
+        "p99_us": round(percentile(latencies, 99), 2),
+        "checks_per_sec_%d_threads" % threads: round(iterations / elapsed, 1),
+        "unavailable_%d_threads" % threads: answered.count(False),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--keys', type=int, default=1000, help='distinct clients')
+    parser.add_argument('--iterations', type=int, default=20000)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    backends = {
+        "memory": MemoryBackend(),
+        "sqlite": SQLiteBackend(os.path.join(tempfile.mkdtemp(prefix='swapi-bench-'), 'buckets.db')),
+    }
+    print(json.dumps({name: run(backend, args.keys, args.iterations, args.threads) for name, backend in backends.items()}, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Rows per second of the collection serialization, ORM serialize() against the serializer registry.
+
+    $ pipenv run python bench/serialization.py
+    $ pipenv run python bench/serialization.py --characters 100000 --model character,planet --output serialization.json
+
+Every strategy serializes the whole table of each --model inside one request context and
+encodes it to a JSON body, the best of --repeat runs is kept:
+
+    orm        Model.query with the loader options of main.py, serialize() per instance, stdlib json
+    registry   row tuples through serializers.py, stdlib json
+    orjson     row tuples through serializers.py, orjson (skipped when it is not installed)
+
+Load (query + objects/dicts) and encode are timed separately, rows/sec is for both.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from common import DEFAULT_VOLUMES, load_app, seed, peak_rss_kb
+
+MODELS = ('character', 'planet', 'specie', 'film')
+
+def best_of(repeat, run):
+    best = None
+    for _ in range(repeat):
+        result = run()
+        if best is None or result["load_seconds"] + result["encode_seconds"] < best["load_seconds"] + best["encode_seconds"]:
+            best = result
+    return best
+
+def measure(load, encode):
+    start = time.perf_counter()
+    items = load()
+    loaded = time.perf_counter()
+    body = encode(items)
+    encoded = time.perf_counter()
+    return {"rows": len(items), "bytes": len(body), "load_seconds": loaded - start, "encode_seconds": encoded - loaded}
+
+def run_model(app, kind, repeat):
+    import main
+    import serializers
+    from models import db
+
+    model, options = {
+        'character': (main.Character, ()),
+        'planet': (main.Planet, main.PLANET_OPTIONS),
+        'specie': (main.Specie, main.SPECIE_OPTIONS),
+        'film': (main.Film, main.FILM_OPTIONS),
+    }[kind]
+    encoder = serializers.serializer(model)
+
+    def orm():
+        db.session.expunge_all()
+        return [x.serialize() for x in model.query.options(*options).order_by(model.id)]
+
+    def registry():
+        return encoder.rows(encoder.query().order_by(model.id).all())
+
+    stdlib = lambda items: json.dumps(items, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    strategies = [('orm', orm, stdlib), ('registry', registry, stdlib)]
+    if serializers.orjson is not None:
+        orjson = serializers.orjson
+        strategies.append(('orjson', registry, lambda items: orjson.dumps(items, option=orjson.OPT_SORT_KEYS)))
+
+    results = {}
+    with app.test_request_context():
+        for name, load, encode in strategies:
+            result = best_of(repeat, lambda: measure(load, encode))
+            seconds = result["load_seconds"] + result["encode_seconds"]
+            result.update({
+                "rows_per_sec": round(result["rows"] / seconds, 1) if seconds else None,
+                "load_seconds": round(result["load_seconds"], 4),
+                "encode_seconds": round(result["encode_seconds"], 4),
+            })
+            results[name] = result
+            print('%-10s %-9s %8d rows  load %8.4f s  encode %8.4f s  %12.1f rows/s' % (
+                kind, name, result["rows"], result["load_seconds"], result["encode_seconds"], result["rows_per_sec"]), file=sys.stderr)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', help='database URL, a scratch SQLite file by default (it is dropped and re-seeded)')
+    parser.add_argument('--characters', type=int, default=100000)
+    parser.add_argument('--model', default='character', help='comma separated, any of %s' % ','.join(MODELS))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='write the JSON results here instead of stdout')
+    args = parser.parse_args()
+
+    db_url = args.db or 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='swapi-bench-'), 'bench.db')
+    app = load_app(db_url, CACHE_ENABLED=0)
+    volumes = dict(DEFAULT_VOLUMES, characters=args.characters)
+    seeded = seed(app, volumes)
+    print('seeded %s in %.1f s' % (volumes, seeded["seconds"]), file=sys.stderr)
+
+    results = {kind: run_model(app, kind, args.repeat) for kind in args.model.split(',')}
+    output = json.dumps({"volumes": volumes, "database": db_url.split(':')[0], "peak_rss_kb": peak_rss_kb(), "models": results}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
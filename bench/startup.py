@@ -0,0 +1,141 @@
+"""
+Cold start time and memory of the app, in one process and under gunicorn.
+
+    $ pipenv run python bench/startup.py
+    $ pipenv run python bench/startup.py --roles api,api+admin+migrate --workers 4 --output startup.json
+
+For each --roles (APP_ROLES, '+' separated here) it reports:
+
+    import     seconds to import wsgi.py in a fresh interpreter (the app built) and its peak RSS,
+               the best of --repeat runs
+    gunicorn   seconds from starting `gunicorn wsgi` to the first answer on every worker, and the
+               memory of each worker, without and with --preload: RSS, and PSS/private from
+               /proc/<pid>/smaps_rollup, so the pages shared with the master are not counted twice
+"""
+import argparse
+import http.client
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import SRC, BENCH_JWT_SECRET
+
+def environment(db_url, roles):
+    return dict(os.environ, DB_CONNECTION_STRING=db_url, JWT_SECRET_KEY=os.environ.get('JWT_SECRET_KEY', BENCH_JWT_SECRET),
+        APP_ROLES=roles.replace('+', ','))
+
+def cold_import(db_url, roles, repeat):
+    script = 'import time, resource; t = time.perf_counter(); import wsgi; ' \
+        'print(time.perf_counter() - t, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)'
+    best = None
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', script], cwd=SRC, env=environment(db_url, roles))
+        seconds, rss = output.split()
+        if best is None or float(seconds) < best["seconds"]:
+            best = {"seconds": round(float(seconds), 3), "peak_rss_kb": int(rss)}
+    return best
+
+def smaps(pid):
+    # kB values of /proc/<pid>/smaps_rollup, Linux >= 4.14
+    values = {}
+    try:
+        with open('/proc/%d/smaps_rollup' % pid) as rollup:
+            for line in rollup:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == 'kB':
+                    values[parts[0].rstrip(':')] = int(parts[1])
+    except OSError:
+        pass
+    return {
+        "rss_kb": values.get('Rss', None),
+        "pss_kb": values.get('Pss', None),
+        "private_kb": values.get('Private_Clean', 0) + values.get('Private_Dirty', 0) if values else None,
+    }
+
+def children(pid):
+    try:
+        with open('/proc/%d/task/%d/children' % (pid, pid)) as f:
+            return [int(x) for x in f.read().split()]
+    except OSError:
+        return []
+
+def free_port():
+    import socket
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def gunicorn(db_url, roles, workers, preload):
+    port = free_port()
+    # with the hooks of gunicorn.conf.py, the command line wins over its other settings
+    command = ['gunicorn', 'wsgi', '--config', os.path.join(SRC, '..', 'gunicorn.conf.py'), '--chdir', SRC,
+        '--bind', '127.0.0.1:%d' % port, '--workers', str(workers), '--log-level', 'warning']
+    if preload:
+        command.append('--preload')
+    start = time.perf_counter()
+    process = subprocess.Popen(command, env=environment(db_url, roles))
+    try:
+        # ready when every worker is up and one of them answers
+        deadline = time.time() + 60
+        while time.time() < deadline:
+            try:
+                if len(children(process.pid)) == workers:
+                    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+                    connection.request('GET', '/health')
+                    connection.getresponse().read()
+                    break
+            except OSError:
+                pass
+            time.sleep(0.02)
+        else:
+            raise RuntimeError('gunicorn did not start')
+        ready = time.perf_counter() - start
+        # let the other workers finish booting before reading their memory
+        time.sleep(1)
+        memory = [smaps(pid) for pid in children(process.pid)]
+        master = smaps(process.pid)
+    finally:
+        process.terminate()
+        process.wait()
+    average = lambda key: int(sum(m[key] or 0 for m in memory) / len(memory)) if memory else None
+    return {
+        "ready_seconds": round(ready, 3),
+        "master": master,
+        "worker_rss_kb": average("rss_kb"),
+        "worker_pss_kb": average("pss_kb"),
+        "worker_private_kb": average("private_kb"),
+        "total_pss_kb": sum(m["pss_kb"] or 0 for m in memory) + (master["pss_kb"] or 0),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', help='database URL, a scratch SQLite file by default')
+    parser.add_argument('--roles', default='api,api+admin+migrate', help="comma separated APP_ROLES to compare, '+' between roles")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='write the JSON results here instead of stdout')
+    args = parser.parse_args()
+
+    db_url = args.db or 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='swapi-bench-'), 'bench.db')
+    results = {}
+    for roles in args.roles.split(','):
+        result = results[roles] = {"import": cold_import(db_url, roles, args.repeat)}
+        print('%-20s import   %6.3f s  peak rss %7d kB' % (roles, result["import"]["seconds"], result["import"]["peak_rss_kb"]), file=sys.stderr)
+        for preload in (False, True):
+            name = 'gunicorn_preload' if preload else 'gunicorn'
+            r = result[name] = gunicorn(db_url, roles, args.workers, preload)
+            print('%-20s %-16s ready %6.3f s  per worker rss %7d kB  pss %7d kB  private %7d kB  total pss %7d kB' % (
+                roles, name, r["ready_seconds"], r["worker_rss_kb"], r["worker_pss_kb"], r["worker_private_kb"], r["total_pss_kb"]), file=sys.stderr)
+
+    output = json.dumps({"database": db_url.split(':')[0], "workers": args.workers, "roles": results}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
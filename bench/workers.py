@@ -0,0 +1,87 @@
+"""
+Compare gunicorn worker modes: requests per second and memory per concurrent connection.
+
+    $ pipenv run python bench/workers.py
+    $ pipenv run python bench/workers.py --db postgresql://localhost/swapi_bench --workers 4 --concurrency 64 \
+        --modes sync:1,gthread:4,gthread:16
+
+Every mode ("<worker class>:<threads>") gets a fresh gunicorn with the same number of workers and
+the same mix of read requests sent by --concurrency parallel clients. The memory is the resident
+size of the gunicorn master and workers, divided by the number of requests the server can
+actually run at once (workers * threads, capped by --concurrency).
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from common import DEFAULT_VOLUMES, load_app, seed, mint_tokens
+from endpoints import Context, start_gunicorn, run_server, server_rss_kb
+
+DEFAULT_MIX = 'get_all_planets,get_planet,get_character,get_film,get_user_favorite'
+
+def run_mode(db_url, ctx, mode, args):
+    worker_class, threads = mode.split(':')
+    options = argparse.Namespace(workers=args.workers, worker_class=worker_class, threads=int(threads))
+    process, port = start_gunicorn(db_url, options)
+    try:
+        idle_rss = server_rss_kb(process.pid)
+        start = time.perf_counter()
+        results = run_server(port, process.pid, ctx, args.mix.split(','), args.iterations, args.warmup, args.concurrency)
+        elapsed = time.perf_counter() - start
+        peak_rss = server_rss_kb(process.pid, 'VmHWM')
+    finally:
+        process.terminate()
+        process.wait()
+
+    requests = sum(r["requests"] for r in results.values())
+    in_flight = min(args.concurrency, args.workers * int(threads))
+    return {
+        "mode": mode,
+        "workers": args.workers,
+        "max_in_flight": in_flight,
+        "requests_per_sec": round(requests / elapsed, 1),
+        "p95_ms": max(r["p95_ms"] for r in results.values()),
+        "errors": sum(r["errors"] for r in results.values()),
+        "idle_rss_kb": idle_rss,
+        "peak_rss_kb": peak_rss,
+        "rss_per_concurrent_request_kb": int(peak_rss / in_flight) if peak_rss else None,
+        "endpoints": results,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', help='database URL, a scratch SQLite file by default (it is dropped and re-seeded)')
+    parser.add_argument('--modes', default='sync:1,gthread:4')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='comma separated scenarios of bench/endpoints.py')
+    parser.add_argument('--output', help='write the JSON results here instead of stdout')
+    args = parser.parse_args()
+
+    db_url = args.db or 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='swapi-bench-'), 'bench.db')
+    app = load_app(db_url)
+    volumes = dict(DEFAULT_VOLUMES)
+    seeded = seed(app, volumes)
+    ctx = Context(volumes, mint_tokens(app, range(1, volumes["users"] + 1)), [], seeded["favorite_ids"])
+
+    modes = []
+    for mode in args.modes.split(','):
+        result = run_mode(db_url, ctx, mode, args)
+        print('%-12s %8.1f req/s  p95 %8.2f ms  %8s KB per concurrent request  errors %d' % (
+            mode, result["requests_per_sec"], result["p95_ms"], result["rss_per_concurrent_request_kb"], result["errors"]), file=sys.stderr)
+        modes.append(result)
+
+    output = json.dumps({"concurrency": args.concurrency, "database": db_url.split(':')[0], "modes": modes}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
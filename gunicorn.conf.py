@@ -0,0 +1,35 @@
+# Gunicorn settings, loaded automatically by `gunicorn wsgi --chdir ./src/` (see Procfile).
+# Every value can be overridden from the environment, see docs/CONCURRENCY.md before changing them.
+import gc
+import os
+
+# one process per core is a good start, Heroku sets WEB_CONCURRENCY from the dyno size
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+
+# gthread: each worker serves GUNICORN_THREADS requests at once, a thread waiting on the database
+# doesn't block the others. Set GUNICORN_WORKER_CLASS=sync to get the one request per worker mode back.
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+# idle keep-alive connections are parked by gthread workers without holding a thread
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+
+# GUNICORN_PRELOAD=1 builds the app once in the master (same as --preload): the workers are forked
+# from it already warm, they are ready sooner and share its memory pages. A HUP then restarts the
+# workers without reloading the code, deploy with a full restart.
+preload_app = os.environ.get('GUNICORN_PRELOAD', '0') == '1'
+
+def when_ready(server):
+    if server.cfg.preload_app:
+        # the objects of the warm app go to the permanent generation, otherwise the first
+        # collection of every worker touches their pages and they stop being shared
+        gc.freeze()
+
+def post_fork(server, worker):
+    if server.cfg.preload_app:
+        # connections opened by the master must not be used by two processes
+        from wsgi import application
+        from models import db
+        with application.app_context():
+            db.engine.dispose(close=False)
@@ -0,0 +1,30 @@
+"""denormalized read model for planet, specie and film detail
+
+Revision ID: 42dcd76ea3d2
+Revises: 8aff28b04e93
+Create Date: 2026-10-18 14:21:53.017742
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '42dcd76ea3d2'
+down_revision = '8aff28b04e93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # filled by `flask rebuild-read-model`, then kept up to date on every commit
+    op.create_table('read_model',
+    sa.Column('kind', sa.String(length=16), nullable=False),
+    sa.Column('entity_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('body', sa.Text(), nullable=False),
+    sa.PrimaryKeyConstraint('kind', 'entity_id')
+    )
+
+
+def downgrade():
+    op.drop_table('read_model')
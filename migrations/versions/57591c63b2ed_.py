@@ -0,0 +1,31 @@
+"""table versions for ETags
+
+Revision ID: 57591c63b2ed
+Revises: 788c31667ae1
+Create Date: 2026-10-18 10:12:41.204311
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '57591c63b2ed'
+down_revision = '788c31667ae1'
+branch_labels = None
+depends_on = None
+
+VERSIONED_TABLES = ['user', 'favorite', 'planet', 'character', 'specie', 'film']
+
+
+def upgrade():
+    table_version = op.create_table('table_version',
+    sa.Column('name', sa.String(length=64), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    op.bulk_insert(table_version, [{'name': name, 'version': 0} for name in VERSIONED_TABLES])
+
+
+def downgrade():
+    op.drop_table('table_version')
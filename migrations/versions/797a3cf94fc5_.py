@@ -0,0 +1,34 @@
+"""favorite lookup and planet_id indexes
+
+Revision ID: 797a3cf94fc5
+Revises: 57591c63b2ed
+Create Date: 2026-10-18 11:02:17.581932
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '797a3cf94fc5'
+down_revision = '57591c63b2ed'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # keep the oldest row of every duplicated favorite so the unique index can be built
+    # (the derived table is needed by MySQL, which can't select from the table it deletes from)
+    op.execute(
+        "DELETE FROM favorite WHERE id NOT IN ("
+        "SELECT id FROM (SELECT MIN(id) AS id FROM favorite GROUP BY user_id, favorite_type, favorite_id) AS keep)"
+    )
+    op.create_index('ix_favorite_user_type_id', 'favorite', ['user_id', 'favorite_type', 'favorite_id'], unique=True)
+    op.create_index(op.f('ix_character_planet_id'), 'character', ['planet_id'], unique=False)
+    op.create_index(op.f('ix_specie_planet_id'), 'specie', ['planet_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_specie_planet_id'), table_name='specie')
+    op.drop_index(op.f('ix_character_planet_id'), table_name='character')
+    op.drop_index('ix_favorite_user_type_id', table_name='favorite')
@@ -0,0 +1,27 @@
+"""room for password hashes
+
+Revision ID: 8aff28b04e93
+Revises: 797a3cf94fc5
+Create Date: 2026-10-18 11:48:05.310276
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8aff28b04e93'
+down_revision = '797a3cf94fc5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # existing plain text passwords are kept, they are rehashed on the next successful login
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.alter_column('password', existing_type=sa.String(length=80), type_=sa.String(length=255), existing_nullable=False)
+
+
+def downgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.alter_column('password', existing_type=sa.String(length=255), type_=sa.String(length=80), existing_nullable=False)
@@ -0,0 +1,34 @@
+"""catalog filter indexes
+
+Revision ID: b5e1c9d04a7f
+Revises: 42dcd76ea3d2
+Create Date: 2026-10-18 15:12:40.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b5e1c9d04a7f'
+down_revision = '42dcd76ea3d2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(op.f('ix_planet_climate'), 'planet', ['climate'], unique=False)
+    op.create_index(op.f('ix_planet_terrain'), 'planet', ['terrain'], unique=False)
+    op.create_index(op.f('ix_character_gender'), 'character', ['gender'], unique=False)
+    op.create_index(op.f('ix_specie_classification'), 'specie', ['classification'], unique=False)
+    op.create_index(op.f('ix_film_episode_id'), 'film', ['episode_id'], unique=False)
+    op.create_index(op.f('ix_film_director'), 'film', ['director'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_film_director'), table_name='film')
+    op.drop_index(op.f('ix_film_episode_id'), table_name='film')
+    op.drop_index(op.f('ix_specie_classification'), table_name='specie')
+    op.drop_index(op.f('ix_character_gender'), table_name='character')
+    op.drop_index(op.f('ix_planet_terrain'), table_name='planet')
+    op.drop_index(op.f('ix_planet_climate'), table_name='planet')
@@ -0,0 +1,33 @@
+"""favorite counts per entity
+
+Revision ID: c7a4e2f09b13
+Revises: b5e1c9d04a7f
+Create Date: 2026-10-18 16:40:12.503871
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7a4e2f09b13'
+down_revision = 'b5e1c9d04a7f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('favorite_count',
+    sa.Column('favorite_type', sa.String(length=1), nullable=False),
+    sa.Column('favorite_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('favorite_type', 'favorite_id')
+    )
+    # the counts of the favorites already there, then kept up to date on every commit
+    op.execute(
+        "INSERT INTO favorite_count (favorite_type, favorite_id, count) "
+        "SELECT favorite_type, favorite_id, COUNT(*) FROM favorite WHERE favorite_type IS NOT NULL GROUP BY favorite_type, favorite_id")
+
+
+def downgrade():
+    op.drop_table('favorite_count')
@@ -0,0 +1,179 @@
+"""
+Password hashing (scrypt or PBKDF2-SHA256, rehashed on login when the cost changes), the
+cached JWT identities and the token blocklist.
+"""
+import base64
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import namedtuple
+from flask import current_app
+from flask_jwt_extended import get_jwt
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from cache import LRUCache, flushed_objects
+from models import User
+
+SALT_BYTES = 16
+HASH_BYTES = 32
+SCRYPT_R = 8
+SCRYPT_P = 1
+
+def b64encode(data):
+    return base64.b64encode(data).decode('ascii')
+
+def b64decode(data):
+    return base64.b64decode(data.encode('ascii'))
+
+def default_method():
+    return current_app.config['PASSWORD_HASH_METHOD']
+
+def default_cost(method):
+    if method == 'scrypt':
+        return current_app.config['PASSWORD_SCRYPT_COST']
+    return current_app.config['PASSWORD_PBKDF2_ITERATIONS']
+
+def derive(method, cost, password, salt):
+    password = password.encode('utf-8')
+    if method == 'scrypt':
+        # cost is log2(N), scrypt needs 128 * r * N bytes of memory
+        n = 2 ** cost
+        return hashlib.scrypt(password, salt=salt, n=n, r=SCRYPT_R, p=SCRYPT_P, maxmem=256 * SCRYPT_R * n, dklen=HASH_BYTES)
+    if method == 'pbkdf2_sha256':
+        return hashlib.pbkdf2_hmac('sha256', password, salt, cost, dklen=HASH_BYTES)
+    raise ValueError('Unknown password hash method: %s' % method)
+
+def hash_password(password, method=None, cost=None):
+    method = method or default_method()
+    cost = cost or default_cost(method)
+    salt = os.urandom(SALT_BYTES)
+    return '%s$%d$%s$%s' % (method, cost, b64encode(salt), b64encode(derive(method, cost, password, salt)))
+
+def split_hash(stored):
+    # None for rows created before hashing was introduced (plain text)
+    parts = stored.split('$')
+    if len(parts) != 4 or parts[0] not in ('scrypt', 'pbkdf2_sha256') or not parts[1].isdigit():
+        return None
+    return parts[0], int(parts[1]), b64decode(parts[2]), b64decode(parts[3])
+
+def verify_password(stored, password):
+    if stored is None or password is None:
+        return False
+    parts = split_hash(stored)
+    if parts is None:
+        return hmac.compare_digest(stored.encode('utf-8'), password.encode('utf-8'))
+    method, cost, salt, expected = parts
+    return hmac.compare_digest(derive(method, cost, password, salt), expected)
+
+def needs_rehash(stored):
+    parts = split_hash(stored)
+    if parts is None:
+        return True
+    method = default_method()
+    return parts[0] != method or parts[1] != default_cost(method)
+
+dummy_hashes = {}
+
+def burn_password_check(password):
+    # same work as a real check, so a login for an unknown email takes as long as a wrong password
+    method = default_method()
+    key = (method, default_cost(method))
+    if key not in dummy_hashes:
+        dummy_hashes[key] = hash_password('not a password', *key)
+    verify_password(dummy_hashes[key], password or '')
+
+#----------------------------------------------JWT IDENTITY----------------------------------------
+
+# what the handlers need to know about the user behind a token, never the password
+Identity = namedtuple('Identity', ['id', 'email', 'is_active'])
+
+# keyed by str(user id), an entry is dropped when a local commit changes that user (see below),
+# the TTL bounds staleness across nodes
+identity_cache = LRUCache()
+
+def load_identity(user_id):
+    identity = identity_cache.get(str(user_id))
+    if identity is None:
+        user = User.query.get(user_id)
+        if user is None:
+            return None
+        identity = Identity(user.id, user.email, user.is_active)
+        identity_cache.set(str(user_id), identity)
+    return identity
+
+@event.listens_for(Session, 'after_flush')
+def collect_changed_users(session, flush_context):
+    changed = session.info.setdefault('changed_user_ids', set())
+    changed.update(str(obj.id) for state, obj in flushed_objects(session, User) if obj.id is not None)
+
+@event.listens_for(Session, 'before_commit')
+def check_bulk_user_changes(session):
+    # the users changed by bulk statements (mark_changed) are unknown, drop every identity
+    if 'user' in session.info.get('bulk_changed_tables', ()):
+        session.info['identities_stale'] = True
+
+@event.listens_for(Session, 'after_commit')
+def drop_changed_identities(session):
+    changed = session.info.pop('changed_user_ids', ())
+    if session.info.pop('identities_stale', False):
+        identity_cache.clear()
+    else:
+        for key in changed:
+            identity_cache.discard(key)
+
+@event.listens_for(Session, 'after_rollback')
+def forget_changed_users(session):
+    session.info.pop('changed_user_ids', None)
+    session.info.pop('identities_stale', None)
+
+class TokenBlocklist:
+    """
+    Revoked token ids (jti) with their expiry, entries are purged once the token would have expired anyway.
+    Lives in the worker memory: revocations are not shared with other workers or nodes.
+    """
+
+    def __init__(self):
+        self.revoked = {}
+        self.lock = threading.Lock()
+        self.next_purge = 0
+
+    def revoke(self, jti, expires):
+        with self.lock:
+            self.revoked[jti] = expires
+
+    def is_revoked(self, jti):
+        now = time.time()
+        with self.lock:
+            if now > self.next_purge:
+                self.revoked = {k: v for k, v in self.revoked.items() if v > now}
+                self.next_purge = now + 60
+            return jti in self.revoked
+
+    def __len__(self):
+        return len(self.revoked)
+
+token_blocklist = TokenBlocklist()
+
+def setup_auth(app, jwt):
+    identity_cache.maxsize = app.config['IDENTITY_CACHE_MAXSIZE']
+    identity_cache.ttl = app.config['IDENTITY_CACHE_TTL']
+
+    @jwt.user_lookup_loader
+    def user_lookup(jwt_header, jwt_data):
+        # flask_jwt_extended keeps the result for the rest of the request
+        return load_identity(jwt_data[app.config['JWT_IDENTITY_CLAIM']])
+
+    @jwt.user_lookup_error_loader
+    def user_lookup_error(jwt_header, jwt_data):
+        return {"msg": "User not found"}, 401
+
+    @jwt.token_in_blocklist_loader
+    def token_revoked(jwt_header, jwt_data):
+        return app.config['JWT_BLOCKLIST_ENABLED'] and token_blocklist.is_revoked(jwt_data["jti"])
+
+def revoke_current_token():
+    claims = get_jwt()
+    # tokens without exp never expire, keep them for a day which is way longer than our access tokens
+    token_blocklist.revoke(claims["jti"], claims.get("exp", time.time() + 86400))
@@ -0,0 +1,270 @@
+"""
+ETags built from the per-table versions in table_version, and an in-process cache of the
+encoded catalog responses. Both follow the commits that change those tables.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import request, make_response, current_app, g
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from models import db, TableVersion
+from utils import response_format
+from compression import accepted_encoding, negotiated_encoding, compress, encoded_etag
+
+# headers that are part of the cached representation (pagination cursors)
+CACHED_HEADERS = ('Link', 'X-Next-Cursor')
+
+# every LRUCache, so a commit can drop the entries built from the tables it changed
+all_caches = []
+
+class LRUCache:
+    """
+    Bounded LRU mapping with a TTL, thread safe. Entries can be tagged with the tables
+    they were built from, see invalidate().
+    """
+
+    def __init__(self, maxsize=1024, ttl=300):
+        all_caches.append(self)
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        # table -> keys of the entries tagged with it, so invalidate() only visits those
+        self.tagged = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry["expires"] < time.monotonic():
+                self.drop(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry["value"]
+
+    def set(self, key, value, tables=()):
+        with self.lock:
+            if key in self.entries:
+                self.drop(key)
+            self.entries[key] = {
+                "value": value,
+                "tables": frozenset(tables),
+                "expires": time.monotonic() + self.ttl,
+            }
+            for table in tables:
+                self.tagged.setdefault(table, set()).add(key)
+            while len(self.entries) > self.maxsize:
+                self.drop(next(iter(self.entries)))
+                self.evictions += 1
+
+    def drop(self, key):
+        # with the lock held
+        entry = self.entries.pop(key)
+        for table in entry["tables"]:
+            keys = self.tagged[table]
+            keys.discard(key)
+            if not keys:
+                del self.tagged[table]
+
+    def discard(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.drop(key)
+                self.invalidations += 1
+
+    def invalidate(self, tables):
+        # drop the entries tagged with any of `tables`, O(entries dropped)
+        with self.lock:
+            stale = set()
+            for table in tables:
+                stale.update(self.tagged.get(table, ()))
+            for key in stale:
+                self.drop(key)
+            self.invalidations += len(stale)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tagged.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+response_cache = LRUCache()
+
+def setup_cache(app):
+    response_cache.maxsize = app.config['CACHE_MAXSIZE']
+    response_cache.ttl = app.config['CACHE_TTL']
+
+def current_versions(tables):
+    versions = dict.fromkeys(tables, 0)
+    rows = db.session.query(TableVersion.name, TableVersion.version).filter(TableVersion.name.in_(tables))
+    for name, version in rows:
+        versions[name] = version
+    return tuple(sorted(versions.items()))
+
+def cache_key():
+    # the versions are part of the key, so an entry built before a commit on another worker is never served
+    return (request.path, tuple(sorted(request.args.items(multi=True))), response_format(), g.table_versions)
+
+def make_etag(key):
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+def conditional(*tables):
+    """
+    ETag / If-None-Match support for a GET view, `tables` are the tables the response is built from.
+    Goes below @jwt_required() so the token is still checked before answering 304.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            g.table_versions = current_versions(tables)
+            etag = make_etag(cache_key())
+            # the coding the body would be sent with, so a stored ETag with that suffix still matches
+            encoding = accepted_encoding()
+            if request.if_none_match.contains(etag):
+                response = current_app.response_class(status=304)
+                response.set_etag(etag)
+            elif encoding and request.if_none_match.contains(encoded_etag(etag, encoding)):
+                response = current_app.response_class(status=304)
+                response.set_etag(encoded_etag(etag, encoding))
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                # bodies compressed by the cache get the ETag of their content coding
+                encoding = response.headers.get('Content-Encoding', None)
+                response.set_etag(encoded_etag(etag, encoding) if encoding else etag)
+            response.vary.add('Accept')
+            # the responses depend on the JWT, shared caches must not keep them
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return wrapper
+    return decorator
+
+def cached(*tables):
+    """
+    Cache the 200 responses of a GET view in memory, on top of conditional(*tables).
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not current_app.config['CACHE_ENABLED']:
+                return view(*args, **kwargs)
+            key = cache_key()
+            entry = response_cache.get(key)
+            if entry is not None:
+                return cached_response(entry, 'HIT')
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200 or response.is_streamed:
+                response.headers['X-Cache'] = 'MISS'
+                return response
+            entry = {
+                "body": response.get_data(),
+                "mimetype": response.mimetype,
+                "headers": {h: response.headers[h] for h in CACHED_HEADERS if h in response.headers},
+            }
+            response_cache.set(key, entry, tables)
+            return cached_response(entry, 'MISS')
+        return conditional(*tables)(wrapper)
+    return decorator
+
+def cached_response(entry, status):
+    body = entry["body"]
+    headers = dict(entry["headers"])
+    encoding = negotiated_encoding(len(body))
+    if encoding is not None:
+        # compressed variants live next to the plain body, each one is compressed once
+        if encoding not in entry:
+            entry[encoding] = compress(body, encoding)
+        body = entry[encoding]
+        headers['Content-Encoding'] = encoding
+    response = current_app.response_class(body, mimetype=entry["mimetype"], headers=headers)
+    if len(entry["body"]) >= current_app.config['COMPRESS_MIN_SIZE']:
+        response.vary.add('Accept-Encoding')
+    response.headers['X-Cache'] = status
+    return response
+
+def bump_versions(session, tables):
+    # once per table and transaction, see bump_changed_tables
+    bumped = session.info.setdefault('bumped_tables', set())
+    tables = sorted(set(tables) - bumped)
+    if not tables:
+        return
+    versions = TableVersion.__table__
+    connection = session.connection()
+    for name in tables:
+        result = connection.execute(versions.update().where(versions.c.name == name).values(version=versions.c.version + 1))
+        if result.rowcount == 0:
+            connection.execute(versions.insert().values(name=name, version=1))
+    bumped.update(tables)
+
+def mark_changed(session, *tables):
+    # statements that bypass the unit of work (bulk insert/update/delete) have to report their tables here
+    session.info.setdefault('changed_tables', set()).update(tables)
+    session.info.setdefault('bulk_changed_tables', set()).update(tables)
+
+#----------------------------------------------INVALIDATION----------------------------------------
+
+def flushed_objects(session, *models):
+    """
+    (state, obj) of the objects written by the flush, state is 'new', 'dirty' or 'deleted'.
+    For the after_flush listeners, session.new/dirty/deleted still hold the pre-flush state then.
+    """
+    for state, objects in (('new', session.new), ('dirty', session.dirty), ('deleted', session.deleted)):
+        for obj in objects:
+            if not models or isinstance(obj, models):
+                yield state, obj
+
+@event.listens_for(Session, 'after_flush')
+def collect_changed_tables(session, flush_context):
+    changed = session.info.setdefault('changed_tables', set())
+    changed.update(obj.__table__.name for state, obj in flushed_objects(session) if hasattr(obj, '__table__'))
+    if 'bumped_tables' in session.info:
+        # a flush after bump_changed_tables (a later before_commit listener wrote rows), bump right away
+        bump_versions(session, changed)
+
+@event.listens_for(Session, 'before_commit')
+def bump_changed_tables(session):
+    # one sorted pass over every table of the transaction, so two writers lock the table_version
+    # rows in the same order and can't deadlock; per flush, the order would follow the flushes.
+    # before_commit runs ahead of the final flush, flush now so every change has been collected
+    session.flush()
+    bump_versions(session, session.info.get('changed_tables', ()))
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_changed_tables(session):
+    session.info.pop('bumped_tables', None)
+    session.info.pop('bulk_changed_tables', None)
+    changed = session.info.pop('changed_tables', ())
+    for cache in all_caches:
+        cache.invalidate(changed)
+
+@event.listens_for(Session, 'after_rollback')
+def forget_changed_tables(session):
+    session.info.pop('bumped_tables', None)
+    session.info.pop('bulk_changed_tables', None)
+    session.info.pop('changed_tables', None)
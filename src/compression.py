@@ -0,0 +1,119 @@
+"""
+Negotiated response compression: gzip through the standard zlib module, and brotli when the
+optional `brotli` package is installed. Bodies smaller than COMPRESS_MIN_SIZE are sent as they are.
+Cached responses keep their compressed variants next to the plain body (see cache.py), so each
+variant is compressed once instead of on every request.
+"""
+import threading
+import time
+import zlib
+from flask import request, current_app
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+class CompressionStats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.responses = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_seconds = 0.0
+
+    def record(self, bytes_in, bytes_out, cpu_seconds):
+        with self.lock:
+            self.responses += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.cpu_seconds += cpu_seconds
+
+    def stats(self):
+        with self.lock:
+            return {
+                "responses": self.responses,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "bytes_saved": self.bytes_in - self.bytes_out,
+                "cpu_seconds": round(self.cpu_seconds, 6),
+            }
+
+compression_stats = CompressionStats()
+
+def gzip_compress(body, level):
+    # wbits=31 writes the gzip header and trailer around the deflate stream
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(body) + compressor.flush()
+
+def gzip_stream(chunks, level):
+    # compresses a streamed body on the fly, each chunk is sent as soon as zlib emits output
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    bytes_in = bytes_out = 0
+    cpu_seconds = 0.0
+    for chunk in chunks:
+        start = time.thread_time()
+        compressed = compressor.compress(chunk)
+        cpu_seconds += time.thread_time() - start
+        bytes_in += len(chunk)
+        if compressed:
+            bytes_out += len(compressed)
+            yield compressed
+    compressed = compressor.flush()
+    compression_stats.record(bytes_in, bytes_out + len(compressed), cpu_seconds)
+    yield compressed
+
+def brotli_compress(body, level):
+    return brotli.compress(body, quality=min(level, 11))
+
+def available_encodings():
+    if brotli is not None:
+        return ['br', 'gzip']
+    return ['gzip']
+
+def accepted_encoding():
+    # the content coding this request gets for a body big enough to compress, None for identity
+    if not current_app.config['COMPRESS_ENABLED']:
+        return None
+    return request.accept_encodings.best_match(available_encodings())
+
+def negotiated_encoding(size):
+    if size < current_app.config['COMPRESS_MIN_SIZE']:
+        return None
+    return accepted_encoding()
+
+def compress(body, encoding):
+    start = time.thread_time()
+    if encoding == 'br':
+        compressed = brotli_compress(body, current_app.config['COMPRESS_LEVEL'])
+    else:
+        compressed = gzip_compress(body, current_app.config['COMPRESS_LEVEL'])
+    compression_stats.record(len(body), len(compressed), time.thread_time() - start)
+    return compressed
+
+def encoded_etag(etag, encoding):
+    # a strong ETag identifies the exact bytes, so every content coding gets its own
+    return '%s-%s' % (etag, encoding)
+
+def setup_compression(app):
+
+    @app.after_request
+    def compress_response(response):
+        if response.status_code != 200 or response.is_streamed or response.direct_passthrough:
+            return response
+        if 'Content-Encoding' in response.headers or not response.mimetype.startswith('application/'):
+            return response
+        size = response.content_length or len(response.get_data())
+        if size < app.config['COMPRESS_MIN_SIZE']:
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = negotiated_encoding(size)
+        if encoding is None:
+            return response
+        response.set_data(compress(response.get_data(), encoding))
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag is not None:
+            response.set_etag(encoded_etag(etag, encoding), weak)
+        return response
@@ -0,0 +1,117 @@
+"""
+Engine configuration: connection pool sizing, pre-ping, recycle, checkout timeout and a
+per-statement timeout, all from the environment (see main.py). The pool records how long
+requests wait to check out a connection, which is exported in /metrics and /health.
+"""
+import threading
+import time
+from sqlalchemy import event, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+class PoolStats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.exhausted = 0
+        self.timeouts = 0
+
+    def record(self, seconds, timed_out=False, exhausted=False):
+        with self.lock:
+            self.checkouts += 1
+            if exhausted:
+                self.exhausted += 1
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+            if timed_out:
+                self.timeouts += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "checkouts": self.checkouts,
+                "wait_seconds": round(self.wait_seconds, 6),
+                "max_wait_seconds": round(self.max_wait_seconds, 6),
+                "exhausted": self.exhausted,
+                "timeouts": self.timeouts,
+            }
+
+pool_stats = PoolStats()
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that measures the time spent waiting for a free connection."""
+
+    statement_timeout_ms = 0
+    dialect_name = None
+
+    def _do_get(self):
+        # every connection in use (overflow included), this checkout queues until one is returned
+        exhausted = self._max_overflow >= 0 and self.checkedout() >= self.size() + self._max_overflow
+        start = time.perf_counter()
+        try:
+            connection = QueuePool._do_get(self)
+        except Exception:
+            pool_stats.record(time.perf_counter() - start, timed_out=True, exhausted=exhausted)
+            raise
+        pool_stats.record(time.perf_counter() - start, exhausted=exhausted)
+        return connection
+
+@event.listens_for(TimedQueuePool, 'connect')
+def set_statement_timeout(dbapi_connection, connection_record):
+    pool = TimedQueuePool
+    if not pool.statement_timeout_ms:
+        return
+    if pool.dialect_name == 'postgresql':
+        statement = 'SET statement_timeout = %d' % pool.statement_timeout_ms
+    elif pool.dialect_name == 'mysql':
+        # only applies to SELECT statements on MySQL
+        statement = 'SET SESSION max_execution_time = %d' % pool.statement_timeout_ms
+    else:
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute(statement)
+    cursor.close()
+    # psycopg2 opens a transaction for the SET, keep the connection clean for the pool
+    dbapi_connection.commit()
+
+def engine_options(config):
+    """SQLALCHEMY_ENGINE_OPTIONS for the configured database."""
+    url = config.get('SQLALCHEMY_DATABASE_URI', None)
+    if not url:
+        return {}
+    url = make_url(url)
+    if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+        # in-memory SQLite lives in a single connection, there is no pool to size
+        return {}
+    TimedQueuePool.dialect_name = url.get_backend_name()
+    TimedQueuePool.statement_timeout_ms = config['DB_STATEMENT_TIMEOUT_MS']
+    return {
+        "poolclass": TimedQueuePool,
+        "pool_size": config['DB_POOL_SIZE'],
+        "max_overflow": config['DB_MAX_OVERFLOW'],
+        "pool_timeout": config['DB_POOL_TIMEOUT'],
+        "pool_recycle": config['DB_POOL_RECYCLE'],
+        # a cheap round trip before each checkout, stale connections after a failover are replaced instead of failing
+        "pool_pre_ping": config['DB_POOL_PRE_PING'],
+    }
+
+def pool_status(engine):
+    pool = engine.pool
+    status = {"pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        capacity = pool.size() + max(pool._max_overflow, 0)
+        status.update({
+            "size": pool.size(),
+            "max_overflow": pool._max_overflow,
+            "checked_out": pool.checkedout(),
+            "idle": pool.checkedin(),
+            "saturation": round(pool.checkedout() / float(capacity), 3) if capacity else None,
+        })
+    status.update(pool_stats.stats())
+    return status
+
+def ping(session):
+    session.execute(text('SELECT 1'))
@@ -0,0 +1,119 @@
+"""
+Catalog export as NDJSON (every table) or CSV (one table), streamed from one consistent
+snapshot: GET /export and `flask export-catalog`.
+"""
+import csv
+import io
+import os
+import click
+from flask import json
+from models import db, Planet, Character, Specie, Film, species_characters, film_characters, film_planets, film_species
+from utils import HIDDEN_COLUMNS
+from compression import gzip_stream
+
+# the entities before the association tables referring to them
+EXPORT_TABLES = (
+    Planet.__table__, Character.__table__, Specie.__table__, Film.__table__,
+    species_characters, film_characters, film_planets, film_species,
+)
+FORMATS = ('ndjson', 'csv')
+
+def export_tables(names=None):
+    if not names:
+        return list(EXPORT_TABLES)
+    tables = {table.name: table for table in EXPORT_TABLES}
+    unknown = [name for name in names if name not in tables]
+    if unknown:
+        raise ValueError('Unknown table: %s' % ', '.join(unknown))
+    return [table for table in EXPORT_TABLES if table.name in names]
+
+def snapshot_connection(engine):
+    connection = engine.connect()
+    if engine.dialect.name in ('postgresql', 'mysql'):
+        # every SELECT of the transaction sees the same snapshot
+        connection = connection.execution_options(isolation_level='REPEATABLE READ')
+    return connection
+
+def table_rows(connection, table, batch_size):
+    """(column names, batches of row tuples) through a server-side cursor."""
+    columns = [c for c in table.columns if c.key not in HIDDEN_COLUMNS]
+    query = table.select().with_only_columns(*columns).order_by(*table.primary_key.columns)
+    result = connection.execution_options(stream_results=True, yield_per=batch_size).execute(query)
+    return [c.key for c in columns], result.partitions(batch_size)
+
+def ndjson_chunks(connection, tables, batch_size):
+    for table in tables:
+        keys, batches = table_rows(connection, table, batch_size)
+        for batch in batches:
+            yield ''.join(json.dumps({"table": table.name, "row": dict(zip(keys, row))}) + '\n' for row in batch).encode('utf-8')
+
+def csv_chunks(connection, table, batch_size):
+    keys, batches = table_rows(connection, table, batch_size)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(keys)
+    for batch in batches:
+        writer.writerows(batch)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+def export_stream(engine, format, tables, batch_size, gzip_level=None):
+    """The body of an export as a generator of bytes, the snapshot lasts as long as the generator."""
+    connection = snapshot_connection(engine)
+    try:
+        with connection.begin():
+            if format == 'ndjson':
+                chunks = ndjson_chunks(connection, tables, batch_size)
+            else:
+                chunks = csv_chunks(connection, tables[0], batch_size)
+            if gzip_level is not None:
+                chunks = gzip_stream(chunks, gzip_level)
+            for chunk in chunks:
+                yield chunk
+    finally:
+        connection.close()
+
+def export_directory(engine, directory, format, tables, batch_size, gzip_level=None):
+    """Write one file per table (CSV) or one file for all (NDJSON), in a single snapshot. Returns the paths."""
+    connection = snapshot_connection(engine)
+    suffix = '.gz' if gzip_level is not None else ''
+    if format == 'ndjson':
+        parts = [('catalog.ndjson' + suffix, lambda: ndjson_chunks(connection, tables, batch_size))]
+    else:
+        parts = [(table.name + '.csv' + suffix, lambda table=table: csv_chunks(connection, table, batch_size)) for table in tables]
+    paths = []
+    try:
+        with connection.begin():
+            for name, chunks in parts:
+                path = os.path.join(directory, name)
+                chunks = chunks()
+                if gzip_level is not None:
+                    chunks = gzip_stream(chunks, gzip_level)
+                with open(path, 'wb') as f:
+                    for chunk in chunks:
+                        f.write(chunk)
+                paths.append(path)
+    finally:
+        connection.close()
+    return paths
+
+def setup_export(app):
+
+    @app.cli.command('export-catalog')
+    @click.argument('directory', type=click.Path(file_okay=False))
+    @click.option('--format', 'format', type=click.Choice(FORMATS), default='ndjson')
+    @click.option('--tables', default='', help='comma separated, every catalog table by default')
+    @click.option('--gzip', 'gzip', is_flag=True, help='write .gz files')
+    def export_catalog(directory, format, tables, gzip):
+        """Export the catalog tables to DIRECTORY as one consistent snapshot."""
+        try:
+            selected = export_tables([name for name in tables.split(',') if name])
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        os.makedirs(directory, exist_ok=True)
+        level = app.config['COMPRESS_LEVEL'] if gzip else None
+        for path in export_directory(db.engine, directory, format, selected, app.config['STREAM_BATCH_SIZE'], level):
+            click.echo('%s %d bytes' % (path, os.path.getsize(path)))
@@ -0,0 +1,146 @@
+"""
+Optional group commit of POST /user/<tid>/favorites (FAVORITES_GROUP_COMMIT=1): a writer
+thread per worker inserts and commits the queued favorites together.
+"""
+import collections
+import os
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+from sqlalchemy import tuple_
+from models import db, Favorite
+from utils import APIException, insert_ignore
+from cache import mark_changed
+from popular import add_counts, recount
+
+class GroupCommitter:
+
+    def __init__(self, app=None, wait_ms=5, max_items=100, timeout=10):
+        self.app = app
+        self.wait = wait_ms / 1000.0
+        self.max_items = max_items
+        self.timeout = timeout
+        self.queue = collections.deque()
+        self.ready = threading.Condition()
+        self.thread = None
+        self.pid = None
+        self.batches = 0
+        self.items = 0
+        self.errors = 0
+        self.split_batches = 0
+        self.max_batch = 0
+
+    def start(self):
+        # the writer of this process, a new one after gunicorn forks the workers
+        if self.thread is None or self.pid != os.getpid():
+            self.queue.clear()
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self.run, name='favorite-group-commit', daemon=True)
+            self.thread.start()
+
+    def submit(self, row):
+        """Queue a favorite row and wait for the commit of its batch, returns the serialized favorite."""
+        future = Future()
+        with self.ready:
+            self.start()
+            self.queue.append((row, future))
+            self.ready.notify()
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            raise APIException('Favorite not stored in time, retry later', status_code=503)
+
+    def take(self):
+        with self.ready:
+            while not self.queue:
+                self.ready.wait()
+            # wait a little for the rows of the other requests of the burst
+            deadline = time.monotonic() + self.wait
+            while len(self.queue) < self.max_items:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                self.ready.wait(left)
+            return [self.queue.popleft() for _ in range(min(self.max_items, len(self.queue)))]
+
+    def run(self):
+        while True:
+            batch = self.take()
+            try:
+                results = self.commit([row for row, future in batch])
+            except Exception as error:
+                if len(batch) == 1:
+                    self.fail(batch, error)
+                    continue
+                # one bad row must not fail the other requests of the batch, retry them one by one
+                self.split_batches += 1
+                for item in batch:
+                    try:
+                        self.resolve([item], self.commit([item[0]]))
+                    except Exception as error:
+                        self.fail([item], error)
+                continue
+            self.resolve(batch, results)
+
+    def commit(self, rows):
+        with self.app.app_context():
+            try:
+                return self.write(rows)
+            except Exception:
+                db.session.rollback()
+                raise
+            finally:
+                db.session.remove()
+
+    def resolve(self, batch, results):
+        self.batches += 1
+        self.items += len(batch)
+        self.max_batch = max(self.max_batch, len(batch))
+        for row, future in batch:
+            favorite = results.get((row["user_id"], row["favorite_type"], row["favorite_id"]), None)
+            if favorite is None:
+                future.set_exception(APIException('Favorite not stored', status_code=500))
+            else:
+                future.set_result(favorite)
+
+    def fail(self, batch, error):
+        self.errors += 1
+        for row, future in batch:
+            future.set_exception(error)
+
+    def write(self, rows):
+        session = db.session
+        # the same favorite twice in a batch is inserted once, like two requests in a row
+        rows = dict(((row["user_id"], row["favorite_type"], row["favorite_id"]), row) for row in rows)
+        key = tuple_(Favorite.user_id, Favorite.favorite_type, Favorite.favorite_id)
+        existing = set(session.query(Favorite.user_id, Favorite.favorite_type, Favorite.favorite_id).filter(key.in_(list(rows))))
+        new = [row for k, row in rows.items() if k not in existing]
+        if new:
+            result = session.execute(insert_ignore(Favorite.__table__).values(new))
+            mark_changed(session, 'favorite')
+            counted = [(row["favorite_type"], row["favorite_id"]) for row in new]
+            if result.rowcount == len(new):
+                add_counts(session, collections.Counter(counted))
+            else:
+                recount(session, counted)
+        favorites = dict(((x.user_id, x.favorite_type, x.favorite_id), x.serialize()) for x in
+            session.query(Favorite).filter(key.in_(list(rows))))
+        session.commit()
+        return favorites
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "errors": self.errors,
+            "split_batches": self.split_batches,
+            "max_batch": self.max_batch,
+            "queued": len(self.queue),
+        }
+
+favorite_writer = GroupCommitter()
+
+def setup_group_commit(app):
+    favorite_writer.app = app
+    favorite_writer.wait = app.config['FAVORITES_GROUP_COMMIT_MS'] / 1000.0
+    favorite_writer.max_items = app.config['FAVORITES_GROUP_COMMIT_MAX']
@@ -0,0 +1,256 @@
+"""
+Bulk import of SWAPI dumps (JSON arrays or NDJSON, SWAPI or this API's format):
+`flask import-swapi <directory>`. Can be run again, rows are matched by name.
+"""
+import json
+import os
+import time
+import click
+from models import db, Planet, Character, Specie, Film, species_characters, film_characters, film_planets, film_species
+from utils import insert_ignore
+from cache import mark_changed
+from read_model import rebuild_all, settings as read_model_settings
+
+# largest value of an Integer column on every database
+MAX_INT = 2 ** 31 - 1
+READ_SIZE = 64 * 1024
+
+def read_json_array(path):
+    """Objects of a JSON array one by one, without loading the file."""
+    decoder = json.JSONDecoder()
+    with open(path, encoding='utf-8') as f:
+        buffer = f.read(READ_SIZE).lstrip()
+        if not buffer.startswith('['):
+            raise click.ClickException('%s is not a JSON array' % path)
+        buffer = buffer[1:]
+        eof = False
+        while True:
+            buffer = buffer.lstrip().lstrip(',').lstrip()
+            if buffer.startswith(']'):
+                return
+            try:
+                obj, end = decoder.raw_decode(buffer)
+            except ValueError:
+                # the object is cut by the end of the buffer
+                if eof:
+                    raise click.ClickException('%s is not a valid JSON array' % path)
+                chunk = f.read(READ_SIZE)
+                eof = chunk == ''
+                buffer += chunk
+                continue
+            yield obj
+            buffer = buffer[end:]
+            if len(buffer) < READ_SIZE and not eof:
+                chunk = f.read(READ_SIZE)
+                eof = chunk == ''
+                buffer += chunk
+
+def read_ndjson(path):
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+def find_dump(directory, names):
+    for name in names:
+        for extension, reader in (('.ndjson', read_ndjson), ('.jsonl', read_ndjson), ('.json', read_json_array)):
+            path = os.path.join(directory, name + extension)
+            if os.path.exists(path):
+                return path, reader
+    return None, None
+
+#----------------------------------------------VALUES----------------------------------------
+
+def to_int(value, default=None):
+    # SWAPI numbers are strings like "1,000", "78.2", "unknown" or "n/a"
+    if isinstance(value, bool):
+        return default
+    if isinstance(value, (int, float)):
+        return min(int(value), MAX_INT)
+    try:
+        return min(int(float(str(value).replace(',', ''))), MAX_INT)
+    except ValueError:
+        return default
+
+def to_text(value, default=None):
+    return default if value is None else str(value)
+
+def source_key(value):
+    # identity of a row inside the dump: its url (SWAPI) or its id (this API)
+    if isinstance(value, dict):
+        return value.get('url', value.get('id', None))
+    return value
+
+def row_key(obj):
+    return source_key(obj.get('url', None) or obj.get('id', None))
+
+#----------------------------------------------RESOURCES----------------------------------------
+
+def planet_row(obj, ids):
+    return {
+        "name": obj["name"],
+        "diameter": to_int(obj.get("diameter")),
+        "rotation_period": to_int(obj.get("rotation_period")),
+        "orbital_period": to_int(obj.get("orbital_period")),
+        "gravity": to_text(obj.get("gravity")),
+        "population": to_int(obj.get("population"), 0),
+        "climate": to_text(obj.get("climate")),
+        "terrain": to_text(obj.get("terrain"), 'unknown'),
+        "surface_water": to_int(obj.get("surface_water")),
+    }
+
+def homeworld(obj, ids):
+    value = obj.get("homeworld", obj.get("planet_id", None))
+    return ids["planet"].get(source_key(value), None) if value is not None else None
+
+def character_row(obj, ids):
+    return {
+        "name": obj["name"],
+        "height": to_int(obj.get("height"), 0),
+        "mass": to_int(obj.get("mass"), 0),
+        "hair_color": to_text(obj.get("hair_color")),
+        "skin_color": to_text(obj.get("skin_color")),
+        "eye_color": to_text(obj.get("eye_color")),
+        "birth_year": to_text(obj.get("birth_year"), 'unknown'),
+        "gender": to_text(obj.get("gender"), 'n/a'),
+        "planet_id": homeworld(obj, ids),
+    }
+
+def specie_row(obj, ids):
+    return {
+        "name": obj["name"],
+        "classification": to_text(obj.get("classification"), 'unknown'),
+        "designation": to_text(obj.get("designation")),
+        "average_height": to_int(obj.get("average_height")),
+        "average_lifespan": to_int(obj.get("average_lifespan")),
+        "hair_colors": to_text(obj.get("hair_colors")),
+        "skin_colors": to_text(obj.get("skin_colors")),
+        "eye_colors": to_text(obj.get("eye_colors")),
+        "language": to_text(obj.get("language")),
+        "planet_id": homeworld(obj, ids),
+    }
+
+def film_row(obj, ids):
+    return {
+        "title": obj["title"],
+        "episode_id": to_int(obj.get("episode_id"), 0),
+        "producer": to_text(obj.get("producer"), ''),
+        "director": to_text(obj.get("director"), ''),
+        "release_date": to_text(obj.get("release_date"), ''),
+        "opening": to_text(obj.get("opening_crawl", obj.get("opening"))),
+    }
+
+# in load order, a resource only refers to the ones before it:
+# (kind, model, natural key, file names, row builder, [(dump field, association table, own column, related kind, related column)])
+RESOURCES = (
+    ('planet', Planet, 'name', ('planets',), planet_row, ()),
+    ('character', Character, 'name', ('people', 'characters'), character_row, ()),
+    ('specie', Specie, 'name', ('species',), specie_row, (
+        (('people', 'characters'), species_characters, 'specie_id', 'character', 'character_id'),
+    )),
+    ('film', Film, 'title', ('films',), film_row, (
+        (('characters',), film_characters, 'film_id', 'character', 'character_id'),
+        (('planets',), film_planets, 'film_id', 'planet', 'planet_id'),
+        (('species',), film_species, 'film_id', 'specie', 'specie_id'),
+    )),
+)
+
+class Importer:
+
+    def __init__(self, session, batch_size):
+        self.session = session
+        self.batch_size = batch_size
+        # kind -> {key in the dump: id in the database}
+        self.ids = {kind: {} for kind, *_ in RESOURCES}
+        self.report = []
+
+    def run(self, directory):
+        for kind, model, natural_key, names, build, associations in RESOURCES:
+            path, reader = find_dump(directory, names)
+            if path is None:
+                click.echo('%-10s no %s file, skipped' % (kind, '/'.join(names)))
+                continue
+            self.load(kind, model, natural_key, reader(path), build, associations)
+        return self.report
+
+    def load(self, kind, model, natural_key, objects, build, associations):
+        start = time.perf_counter()
+        table = model.__table__
+        key_column = table.columns[natural_key]
+        # natural key -> id, rows already there are mapped instead of inserted again
+        existing = dict(self.session.query(key_column, table.c.id))
+        # the rows of a batch get their ids from the database when it is flushed, until then the
+        # dump keys and the association rows refer to them by natural key
+        rows, keys, links = {}, [], {}
+        counts = {"read": 0, "inserted": 0, "links": 0}
+
+        for obj in objects:
+            counts["read"] += 1
+            row = build(obj, self.ids)
+            name = row[natural_key]
+            if name not in existing and name not in rows:
+                rows[name] = row
+            key = row_key(obj)
+            if key is not None:
+                keys.append((key, name))
+            for fields, association, own_column, related_kind, related_column in associations:
+                values = next((obj[f] for f in fields if f in obj), ())
+                for value in values:
+                    related = self.ids[related_kind].get(source_key(value), None)
+                    if related is not None:
+                        links.setdefault(association, []).append((own_column, name, related_column, related))
+            if len(rows) >= self.batch_size or sum(map(len, links.values())) >= self.batch_size:
+                self.flush(kind, table, key_column, existing, rows, keys, links, counts)
+                rows, keys, links = {}, [], {}
+        self.flush(kind, table, key_column, existing, rows, keys, links, counts)
+
+        seconds = time.perf_counter() - start
+        counts.update({"kind": kind, "seconds": round(seconds, 3), "rows_per_sec": round(counts["read"] / seconds, 1) if seconds else None})
+        self.report.append(counts)
+        click.echo('%-10s %8d read  %8d inserted  %8d links  %8.2f s  %10.1f rows/s' % (
+            kind, counts["read"], counts["inserted"], counts["links"], seconds, counts["rows_per_sec"] or 0))
+
+    def insert(self, table, key_column, rows):
+        """Insert `rows` without ids, returns {natural key: id assigned by the database}."""
+        # SQLAlchemy 2.0 and later, 1.4 (Pipfile.lock) has neither the flag nor sort_by_parameter_order
+        if getattr(self.session.get_bind().dialect, 'insert_executemany_returning_sort_by_parameter_order', False):
+            result = self.session.execute(table.insert().returning(key_column, table.c.id, sort_by_parameter_order=True), rows)
+            return dict(result.all())
+        # no ordered RETURNING with executemany (MySQL, SQLAlchemy 1.4): read the new ids back by natural key
+        self.session.execute(table.insert(), rows)
+        names = [row[key_column.key] for row in rows]
+        return dict(self.session.query(key_column, table.c.id).filter(key_column.in_(names)))
+
+    def flush(self, kind, table, key_column, existing, rows, keys, links, counts):
+        # one executemany per table and batch, committed so a failure keeps the batches before it
+        if rows:
+            existing.update(self.insert(table, key_column, list(rows.values())))
+            counts["inserted"] += len(rows)
+        for key, name in keys:
+            self.ids[kind][key] = existing[name]
+        if not rows and not links:
+            return
+        for association, pairs in links.items():
+            self.session.execute(insert_ignore(association), [
+                {own_column: existing[name], related_column: related} for own_column, name, related_column, related in pairs])
+            counts["links"] += len(pairs)
+        mark_changed(self.session, table.name, *[association.name for association in links])
+        self.session.commit()
+
+def setup_import(app):
+
+    @app.cli.command('import-swapi')
+    @click.argument('directory', type=click.Path(exists=True, file_okay=False))
+    @click.option('--batch-size', default=1000, help='rows per INSERT batch and transaction')
+    def import_swapi(directory, batch_size):
+        """Bulk load planets, people, species and films from the JSON/NDJSON dumps in DIRECTORY."""
+        start = time.perf_counter()
+        report = Importer(db.session, batch_size).run(directory)
+        seconds = time.perf_counter() - start
+        rows = sum(r["read"] for r in report)
+        click.echo('total      %8d rows in %.2f s, %.1f rows/s' % (rows, seconds, rows / seconds if seconds else 0))
+        if read_model_settings["enabled"]:
+            # the bulk inserts bypass the session events that keep the documents up to date
+            for kind, count in rebuild_all(db.session):
+                click.echo('read model %s: %d documents' % (kind, count))
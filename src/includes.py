@@ -0,0 +1,55 @@
+"""
+Loader options for the summaries serialize() embeds and for ?include= on the detail
+endpoints: /character/1?include=planet,species,films
+"""
+from sqlalchemy.orm import selectinload
+from models import Planet, Character, Specie, Film
+from utils import APIException
+
+# relationships embedded as summaries by serialize(): model -> {attribute: related model}
+SUMMARIES = {
+    Planet: {'characters': Character},
+    Specie: {'characters': Character},
+    Film: {'characters': Character, 'planets': Planet, 'species': Specie},
+}
+
+# what ?include= accepts: model -> {name in the response: relationship attribute}
+INCLUDES = {
+    Character: {'planet': 'planet', 'species': 'Specie', 'films': 'Film'},
+    Planet: {'characters': 'characters', 'species': 'species', 'films': 'Film'},
+    Specie: {'planet': 'planet', 'characters': 'characters', 'films': 'Film'},
+    Film: {'characters': 'characters', 'planets': 'planets', 'species': 'species'},
+}
+
+def summary(relationship, model):
+    return selectinload(relationship).load_only(model.id, model.name)
+
+def summary_options(model, exclude=()):
+    return tuple(summary(getattr(model, name), related) for name, related in SUMMARIES.get(model, {}).items() if name not in exclude)
+
+def parse_includes(model, args):
+    names = [name.strip() for name in args.get('include', '').split(',') if name.strip()]
+    unknown = [name for name in names if name not in INCLUDES[model]]
+    if unknown:
+        raise APIException('include must be among: %s' % ', '.join(sorted(INCLUDES[model])), status_code=400)
+    return list(dict.fromkeys(names))
+
+def include_options(model, names):
+    """serialize() options of `model` with the relationships in `names` fully loaded instead of summarized."""
+    attributes = [INCLUDES[model][name] for name in names]
+    options = list(summary_options(model, exclude=attributes))
+    for attribute in attributes:
+        relationship = getattr(model, attribute)
+        related = relationship.property.mapper.class_
+        options.append(selectinload(relationship).options(*summary_options(related)))
+    return options
+
+def serialize_with(obj, names):
+    data = obj.serialize()
+    for name in names:
+        value = getattr(obj, INCLUDES[type(obj)][name])
+        if isinstance(value, list):
+            data[name] = [x.serialize() for x in value]
+        else:
+            data[name] = value.serialize() if value is not None else None
+    return data
@@ -2,50 +2,235 @@
 This module takes care of starting the API Server, Loading the DB and Adding the endpoints
 """
 import os
-from flask import Flask, request, jsonify, url_for
-from flask_migrate import Migrate
-from flask_swagger import swagger
+import hashlib
+from flask import Flask, Blueprint, current_app, request, jsonify, url_for, g, stream_with_context
 from flask_cors import CORS
-from utils import APIException, generate_sitemap
-from admin import setup_admin
+from werkzeug.middleware.proxy_fix import ProxyFix
+from sqlalchemy import tuple_
+from sqlalchemy.exc import IntegrityError
+from utils import APIException, generate_sitemap, keyset_page, wants_stream, stream_collection, parse_int_arg, insert_ignore, \
+    parse_id_list, fetch_by_ids, multi_get
+from auth import hash_password, verify_password, needs_rehash, burn_password_check, setup_auth, load_identity, revoke_current_token, identity_cache
+from metrics import setup_metrics, request_metrics
+from database import engine_options, pool_status, pool_stats, ping
+from compression import setup_compression, compression_stats
+from cache import setup_cache, cached, conditional, response_cache, mark_changed
+from read_model import setup_read_model, read_document
+from serializers import setup_serializers
+from importer import setup_import
+from ratelimit import setup_rate_limit, admission_stats
+from includes import summary_options, parse_includes, include_options, serialize_with
+from exporter import setup_export, export_stream, export_tables, FORMATS as EXPORT_FORMATS
+from search import SEARCHABLE, search_index
+from group_commit import setup_group_commit, favorite_writer
+from popular import setup_popular, popular, leaderboard, count_favorites, POPULAR_TYPES
 from models import db, User, Planet, Character, Favorite, Specie, Film
 from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
 #from models import Person
 
-app = Flask(__name__)
-app.url_map.strict_slashes = False
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DB_CONNECTION_STRING')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-MIGRATE = Migrate(app, db)
-db.init_app(app)
-CORS(app)
-setup_admin(app)
-
-app.config["JWT_SECRET_KEY"] = "darksiderules"
-jwt = JWTManager(app)
+# What a process serves, APP_ROLES is a comma separated subset (all of them by default):
+#   api      the REST endpoints and their middleware (rate limit, cache, metrics, JWT...)
+#   admin    the Flask-Admin views under /admin/
+#   migrate  the `flask db` commands (Flask-Migrate / Alembic)
+# API nodes run with APP_ROLES=api and never import flask_admin nor alembic.
+ROLES = ('api', 'admin', 'migrate')
+
+# every endpoint of this module, registered on the app by setup_api; the endpoint names are
+# prefixed with the blueprint name ('api.login'), in RATE_LIMITS and the metrics too
+api = Blueprint('api', __name__)
+
+def configure(app):
+    app.url_map.strict_slashes = False
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DB_CONNECTION_STRING')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # connection pool, see database.py; size it so workers * threads <= DB_POOL_SIZE + DB_MAX_OVERFLOW
+    app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 5))
+    app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+    app.config['DB_POOL_TIMEOUT'] = int(os.environ.get('DB_POOL_TIMEOUT', 10))
+    app.config['DB_POOL_RECYCLE'] = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+    app.config['DB_POOL_PRE_PING'] = os.environ.get('DB_POOL_PRE_PING', '1') == '1'
+    app.config['DB_STATEMENT_TIMEOUT_MS'] = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 0))
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
+    # collections are paginated with ?limit=&after=<last id>, see utils.keyset_page
+    app.config['PAGE_LIMIT_DEFAULT'] = int(os.environ.get('PAGE_LIMIT_DEFAULT', 100))
+    app.config['PAGE_LIMIT_MAX'] = int(os.environ.get('PAGE_LIMIT_MAX', 1000))
+    # ?stream=1 or "Accept: application/x-ndjson" streams the whole collection, see utils.stream_collection
+    app.config['STREAM_BATCH_SIZE'] = int(os.environ.get('STREAM_BATCH_SIZE', 500))
+    # password hashing work factor, see auth.py and bench/password_cost.py before changing it
+    app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt' if hasattr(hashlib, 'scrypt') else 'pbkdf2_sha256')
+    app.config['PASSWORD_SCRYPT_COST'] = int(os.environ.get('PASSWORD_SCRYPT_COST', 14))
+    app.config['PASSWORD_PBKDF2_ITERATIONS'] = int(os.environ.get('PASSWORD_PBKDF2_ITERATIONS', 600000))
+    # max number of favorites accepted by the /favorites/batch endpoints
+    app.config['FAVORITES_BATCH_MAX'] = int(os.environ.get('FAVORITES_BATCH_MAX', 500))
+    # POST /user/<tid>/favorites commits in groups of up to FAVORITES_GROUP_COMMIT_MAX rows queued
+    # within FAVORITES_GROUP_COMMIT_MS, see group_commit.py
+    app.config['FAVORITES_GROUP_COMMIT'] = os.environ.get('FAVORITES_GROUP_COMMIT', '0') == '1'
+    app.config['FAVORITES_GROUP_COMMIT_MS'] = float(os.environ.get('FAVORITES_GROUP_COMMIT_MS', 5))
+    app.config['FAVORITES_GROUP_COMMIT_MAX'] = int(os.environ.get('FAVORITES_GROUP_COMMIT_MAX', 100))
+    # catalog responses are cached in memory, see cache.py
+    app.config['CACHE_ENABLED'] = os.environ.get('CACHE_ENABLED', '1') == '1'
+    app.config['CACHE_MAXSIZE'] = int(os.environ.get('CACHE_MAXSIZE', 1024))
+    app.config['CACHE_TTL'] = int(os.environ.get('CACHE_TTL', 300))
+    # responses from COMPRESS_MIN_SIZE bytes up are gzip (or brotli) compressed, see compression.py
+    app.config['COMPRESS_ENABLED'] = os.environ.get('COMPRESS_ENABLED', '1') == '1'
+    app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+    app.config['COMPRESS_LEVEL'] = int(os.environ.get('COMPRESS_LEVEL', 6))
+    # per-request SQL/timing instrumentation, see metrics.py and /metrics
+    app.config['METRICS_SAMPLE_RATE'] = float(os.environ.get('METRICS_SAMPLE_RATE', 1.0))
+    app.config['METRICS_SERVER_TIMING'] = os.environ.get('METRICS_SERVER_TIMING', '0') == '1'
+    # auto: orjson when it is installed, stdlib: always the standard json module
+    app.config['JSON_BACKEND'] = os.environ.get('JSON_BACKEND', 'auto')
+    # denormalized film/planet/specie documents, see read_model.py
+    app.config['READ_MODEL_ENABLED'] = os.environ.get('READ_MODEL_ENABLED', '0') == '1'
+    # /search results per request
+    app.config['SEARCH_LIMIT_DEFAULT'] = int(os.environ.get('SEARCH_LIMIT_DEFAULT', 10))
+    app.config['SEARCH_LIMIT_MAX'] = int(os.environ.get('SEARCH_LIMIT_MAX', 100))
+    # ids a multi-get can ask for at once (/batch, ?ids= on the collections)
+    app.config['MULTI_GET_MAX'] = int(os.environ.get('MULTI_GET_MAX', 100))
+    # /popular leaderboard, reloaded from favorite_count every POPULAR_REFRESH_SECONDS, see popular.py
+    app.config['POPULAR_REFRESH_SECONDS'] = int(os.environ.get('POPULAR_REFRESH_SECONDS', 30))
+    app.config['POPULAR_LIMIT_MAX'] = int(os.environ.get('POPULAR_LIMIT_MAX', 100))
+    # token buckets per client and endpoint ('<count>/<second|minute|hour|day>[:<burst>]') and
+    # the requests a worker runs at once (0: no cap), see ratelimit.py
+    app.config['RATE_LIMIT_ENABLED'] = os.environ.get('RATE_LIMIT_ENABLED', '1') == '1'
+    app.config['RATE_LIMIT_BACKEND'] = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+    app.config['RATE_LIMIT_DEFAULT'] = os.environ.get('RATE_LIMIT_DEFAULT', '50/second:100')
+    app.config['RATE_LIMITS'] = os.environ.get('RATE_LIMITS', 'api.login=10/minute,api.create_user=10/minute')
+    app.config['RATE_LIMIT_EXEMPT'] = ('api.health', 'api.get_metrics')
+    # proxies in front of the app (a load balancer: 1), whose X-Forwarded-For is trusted for the client address;
+    # 0 when clients connect directly, they could otherwise pick their rate limit bucket
+    app.config['PROXY_FIX_HOPS'] = int(os.environ.get('PROXY_FIX_HOPS', 0))
+    app.config['MAX_CONCURRENT_REQUESTS'] = int(os.environ.get('MAX_CONCURRENT_REQUESTS', 0))
+
+def create_app(roles=None):
+    """
+    Build the app for `roles` (a list, or the comma separated APP_ROLES by default). The session
+    listeners that keep the caches, read model and counters in sync are registered at import,
+    so every role that writes to the database keeps them up to date.
+    """
+    if roles is None:
+        roles = [role.strip() for role in os.environ.get('APP_ROLES', ','.join(ROLES)).split(',') if role.strip()]
+    unknown = set(roles) - set(ROLES)
+    if unknown:
+        raise RuntimeError('Unknown APP_ROLES: %s, expected some of: %s' % (', '.join(sorted(unknown)), ', '.join(ROLES)))
+    app = Flask(__name__)
+    configure(app)
+    app.config['APP_ROLES'] = tuple(roles)
+    db.init_app(app)
+    if 'api' in roles:
+        setup_api(app)
+    if 'admin' in roles:
+        # imported here, flask_admin and its WTForms are only loaded by the processes serving /admin/
+        from admin import setup_admin
+        setup_admin(app)
+    if 'migrate' in roles:
+        from flask_migrate import Migrate
+        Migrate(app, db)
+    # denormalized documents have to follow the writes of the admin too
+    setup_read_model(app, {
+        'planet': (Planet, PLANET_OPTIONS),
+        'specie': (Specie, SPECIE_OPTIONS),
+        'film': (Film, FILM_OPTIONS),
+    })
+    setup_import(app)
+    setup_export(app)
+    setup_popular(app)
+    return app
+
+def setup_api(app):
+    CORS(app, expose_headers=['Link', 'X-Next-Cursor'])
+    if app.config['PROXY_FIX_HOPS']:
+        # request.remote_addr is the client, not the load balancer, so each client gets its own bucket
+        hops = app.config['PROXY_FIX_HOPS']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops)
+    # the routes first, setup_rate_limit checks the endpoints named in RATE_LIMITS against them
+    app.register_blueprint(api)
+    # first before_request hook, rejected requests don't reach the database
+    setup_rate_limit(app)
+    setup_cache(app)
+    setup_serializers(app)
+    # registered before compression so its after_request runs last and sees the final body size
+    setup_metrics(app)
+    setup_compression(app)
+    setup_group_commit(app)
+
+    # the secret must be the same on every worker and node, so it comes from the environment
+    app.config["JWT_SECRET_KEY"] = os.environ.get('JWT_SECRET_KEY')
+    if not app.config["JWT_SECRET_KEY"]:
+        raise RuntimeError('JWT_SECRET_KEY is not set, add it to your .env file')
+    app.config['JWT_BLOCKLIST_ENABLED'] = os.environ.get('JWT_BLOCKLIST_ENABLED', '1') == '1'
+    app.config['IDENTITY_CACHE_MAXSIZE'] = int(os.environ.get('IDENTITY_CACHE_MAXSIZE', 10000))
+    app.config['IDENTITY_CACHE_TTL'] = int(os.environ.get('IDENTITY_CACHE_TTL', 60))
+    jwt = JWTManager(app)
+    setup_auth(app, jwt)
+
+    app.register_error_handler(APIException, handle_invalid_usage)
+
+request_metrics.add_collector('swapi_response_cache', response_cache.stats)
+request_metrics.add_collector('swapi_compression', compression_stats.stats)
+request_metrics.add_collector('swapi_identity_cache', identity_cache.stats)
+request_metrics.add_collector('swapi_db_pool', pool_stats.stats)
+request_metrics.add_collector('swapi_search_index', search_index.stats)
+request_metrics.add_collector('swapi_admission', admission_stats.stats)
+request_metrics.add_collector('swapi_leaderboard', leaderboard.stats)
+request_metrics.add_collector('swapi_group_commit', favorite_writer.stats)
+
+# Single rows load their related summaries (serializeAbs) with one "SELECT ... WHERE id IN (...)"
+# per relationship, the collections do the same from row tuples (see serializers.py)
+PLANET_OPTIONS = summary_options(Planet)
+SPECIE_OPTIONS = summary_options(Specie)
+FILM_OPTIONS = summary_options(Film)
 
 # Handle/serialize errors like a JSON object
-@app.errorhandler(APIException)
 def handle_invalid_usage(error):
     return jsonify(error.to_dict()), error.status_code
 
 # generate sitemap with all your endpoints
-@app.route('/')
+@api.route('/')
 def sitemap():
-    return generate_sitemap(app)
+    return generate_sitemap(current_app)
+
+#Health check for the load balancer, 503 when the database can't be reached
+@api.route('/health', methods=['GET'])
+def health():
+    status = {"database": "ok"}
+    code = 200
+    try:
+        ping(db.session)
+    except Exception as error:
+        status["database"] = "error: %s" % type(error).__name__
+        code = 503
+    status["pool"] = pool_status(db.engine)
+    return jsonify(status), code
+
+#Prometheus metrics
+@api.route('/metrics', methods=['GET'])
+def get_metrics():
+    return request_metrics.prometheus(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+#Cache and compression counters, used to size CACHE_MAXSIZE/CACHE_TTL and COMPRESS_MIN_SIZE
+@api.route('/cache/stats', methods=['GET'])
+@jwt_required()
+def get_cache_stats():
+    return jsonify({
+        "responses": response_cache.stats(),
+        "identities": identity_cache.stats(),
+        "compression": compression_stats.stats(),
+        "search_index": search_index.stats(),
+        "leaderboard": leaderboard.stats()
+    }), 200
 
 #----------------------------------------------USER ENDPOINTS----------------------------------------
 
 #Create an user
-@app.route('/register', methods=['POST'])
+@api.route('/register', methods=['POST'])
 def create_user():
-    email= request.json.get("email",None)
-    password= request.json.get("password",None)
+    email, password = check_credentials(request.get_json(silent=True))
     user = User.query.filter_by(email=email).first()
     if user is None:
         new_user=User()
         new_user.email=email
-        new_user.password=password
+        new_user.password=hash_password(password)
         new_user.is_active=True
         db.session.add(new_user)
         db.session.commit()
@@ -54,62 +239,101 @@ def create_user():
         return jsonify({"msj":"User already exists"}),401
 
 #Login
-@app.route('/login',methods=['POST'])
+@api.route('/login',methods=['POST'])
 def login():
-    email= request.json.get("email",None)
-    password= request.json.get("password",None)
-    user = User.query.filter_by(email=email,password=password).first()
+    email, password = check_credentials(request.get_json(silent=True))
+    user = User.query.filter_by(email=email).first()
+    if user is None:
+        burn_password_check(password)
+    elif not verify_password(user.password, password):
+        user = None
+    elif needs_rehash(user.password):
+        # plain text rows and rows hashed with an older cost are upgraded on a successful login
+        user.password = hash_password(password)
+        db.session.commit()
     if user:
         access_token = create_access_token(identity=user.id)
         return jsonify({"token":access_token, "user":user.id}),200
     else:
         return jsonify({"msj":"Error"}),401
 
+def check_credentials(body):
+    # {"email": ..., "password": ...}, both non-empty strings before anything is hashed or compared
+    if not isinstance(body, dict) or not body.get("email", None) or not isinstance(body["email"], str) \
+            or not body.get("password", None) or not isinstance(body["password"], str):
+        raise APIException('Email and password are required', status_code=400)
+    return body["email"], body["password"]
+
+#Logout, the token can't be used anymore
+@api.route('/logout', methods=['POST'])
+@jwt_required()
+def logout():
+    revoke_current_token()
+    return jsonify({"msj":"Logged out"}),200
 
 #Return all users
-@app.route('/user', methods=['GET'])
+@api.route('/user', methods=['GET'])
 @jwt_required()
+@conditional('user')
 def get_all_users():
 
-    result = User.query.all()
-    all_users = list(map(lambda x: x.serialize(), result))
-    return jsonify(all_users), 200
+    if wants_stream():
+        return stream_collection(User, request.args)
+    all_users, headers = keyset_page(User, request.args)
+    return jsonify(all_users), 200, headers
 
 
 #----------------------------------------------FAVORITES ENDPOINTS----------------------------------------
 
 #Return favorites of a user
-@app.route('/user/<int:tid>/favorites', methods=['GET'])
+@api.route('/user/<int:tid>/favorites', methods=['GET'])
 @jwt_required()
+@conditional('user', 'favorite')
 def get_user_favorite(tid):
 
-    user = User.query.get(tid)
+    user = load_identity(tid)
 
     if user is None:
         raise APIException('User not found', status_code=404)
 
-    return jsonify(user.serializeFavorites()), 200  
+    favorites = Favorite.query.filter_by(user_id=tid).all()
+    return jsonify({"favorites": list(map(lambda x: x.serialize(), favorites))}), 200  
 
 #Insert a favorite
-@app.route('/user/<int:tid>/favorites', methods=['POST'])
+@api.route('/user/<int:tid>/favorites', methods=['POST'])
 @jwt_required()
 def post_user_favorite(tid):
 
-    user = User.query.get(tid)
+    user = load_identity(tid)
 
     if user is None:
         raise APIException('User not found', status_code=404)
 
 
-    request_body = request.get_json()
-    favorite = Favorite(user_id=tid, favorite_id=request_body["favorite_id"],favorite_name=request_body["favorite_name"],favorite_type=request_body["favorite_type"])
-    db.session.add(favorite)
-    db.session.commit()
+    request_body = check_favorite(request.get_json(silent=True), with_name=True)
+    key = dict(user_id=tid, favorite_type=request_body["favorite_type"], favorite_id=request_body["favorite_id"])
+    # (user_id, favorite_type, favorite_id) is unique, adding the same favorite twice returns the existing one
+    favorite = Favorite.query.filter_by(**key).first()
+    if favorite is None and current_app.config['FAVORITES_GROUP_COMMIT']:
+        # give the connection back while waiting, the writer thread commits the row with the others of its batch
+        db.session.close()
+        return jsonify(favorite_writer.submit(dict(key, favorite_name=request_body["favorite_name"]))), 200
+    if favorite is None:
+        favorite = Favorite(favorite_name=request_body["favorite_name"], **key)
+        db.session.add(favorite)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # a concurrent request stored the same favorite first, answer like for an existing one
+            db.session.rollback()
+            favorite = Favorite.query.filter_by(**key).first()
+            if favorite is None:
+                raise
 
     return jsonify(favorite.serialize()), 200 
 
 #Delete a favorite
-@app.route('/favorite/<int:fid>', methods=['DELETE'])
+@api.route('/favorite/<int:fid>', methods=['DELETE'])
 @jwt_required()
 def delete_favorite(fid):
 
@@ -126,15 +350,118 @@ def delete_favorite(fid):
 
     return jsonify(response), 200    
 
+# favorite_id is an INTEGER column
+INT32_MIN, INT32_MAX = -2 ** 31, 2 ** 31 - 1
+
+def check_favorite(item, with_name=False):
+    # {"favorite_type": "p", "favorite_id": 1, "favorite_name": "Tatooine"}, the same checks with or without group commit;
+    # within the column limits too, a value the database refuses would fail the whole group commit batch
+    if not isinstance(item, dict) or not isinstance(item.get("favorite_id", None), int) or isinstance(item["favorite_id"], bool) \
+            or not isinstance(item.get("favorite_type", None), str):
+        raise APIException('Each favorite needs an integer favorite_id and a favorite_type', status_code=400)
+    if not INT32_MIN <= item["favorite_id"] <= INT32_MAX:
+        raise APIException('favorite_id must be between %d and %d' % (INT32_MIN, INT32_MAX), status_code=400)
+    if len(item["favorite_type"]) > Favorite.favorite_type.type.length:
+        raise APIException('favorite_type must be at most %d character' % Favorite.favorite_type.type.length, status_code=400)
+    if with_name and (not item.get("favorite_name", None) or not isinstance(item["favorite_name"], str)):
+        raise APIException('Each favorite needs a favorite_name', status_code=400)
+    if with_name and len(item["favorite_name"]) > Favorite.favorite_name.type.length:
+        raise APIException('favorite_name must be at most %d characters' % Favorite.favorite_name.type.length, status_code=400)
+    return item
+
+def parse_favorite_batch(with_name=False):
+    # body: [{"favorite_type": "p", "favorite_id": 1, "favorite_name": "Tatooine"}, ...], duplicates are dropped
+    request_body = request.get_json(silent=True)
+    if not isinstance(request_body, list):
+        raise APIException('Expected a list of favorites', status_code=400)
+    if len(request_body) > current_app.config['FAVORITES_BATCH_MAX']:
+        raise APIException('At most %d favorites per batch' % current_app.config['FAVORITES_BATCH_MAX'], status_code=400)
+    batch = {}
+    for item in request_body:
+        check_favorite(item, with_name)
+        batch[(item["favorite_type"], item["favorite_id"])] = item
+    return batch
+
+def favorites_in(tid, keys):
+    # one round trip whatever the number of keys: WHERE user_id = ? AND (favorite_type, favorite_id) IN (...)
+    if not keys:
+        return []
+    return Favorite.query.filter(Favorite.user_id == tid, tuple_(Favorite.favorite_type, Favorite.favorite_id).in_(list(keys))).all()
+
+#Insert many favorites, the ones the user already has are skipped so retries are safe
+@api.route('/user/<int:tid>/favorites/batch', methods=['POST'])
+@jwt_required()
+def post_user_favorites_batch(tid):
+
+    user = load_identity(tid)
+
+    if user is None:
+        raise APIException('User not found', status_code=404)
+
+    batch = parse_favorite_batch(with_name=True)
+    # the favorite counts (popular.py) need to know which rows are new
+    existing = set((x.favorite_type, x.favorite_id) for x in favorites_in(tid, batch.keys()))
+    new_keys = [key for key in batch if key not in existing]
+    rows = [{
+        "user_id": tid,
+        "favorite_id": batch[key]["favorite_id"],
+        "favorite_name": batch[key]["favorite_name"],
+        "favorite_type": batch[key]["favorite_type"]
+    } for key in new_keys]
+    created = 0
+    if rows:
+        result = db.session.execute(insert_ignore(Favorite.__table__).values(rows))
+        created = result.rowcount
+        mark_changed(db.session, 'favorite')
+        count_favorites(db.session, new_keys, 1, created)
+    db.session.commit()
+
+    favorites = favorites_in(tid, batch.keys())
+    return jsonify({"created": created, "favorites": list(map(lambda x: x.serialize(), favorites))}), 200
+
+#Delete many favorites in one statement
+@api.route('/user/<int:tid>/favorites/batch', methods=['DELETE'])
+@jwt_required()
+def delete_user_favorites_batch(tid):
+
+    batch = parse_favorite_batch()
+    deleted = 0
+    existing = [(x.favorite_type, x.favorite_id) for x in favorites_in(tid, batch.keys())]
+    if existing:
+        result = db.session.execute(Favorite.__table__.delete().where(Favorite.user_id == tid).where(
+            tuple_(Favorite.favorite_type, Favorite.favorite_id).in_(existing)))
+        deleted = result.rowcount
+        mark_changed(db.session, 'favorite')
+        count_favorites(db.session, existing, -1, deleted)
+    db.session.commit()
+
+    return jsonify({"deleted": deleted}), 200
+
+#Which of these favorites does the user have
+@api.route('/user/<int:tid>/favorites/check', methods=['POST'])
+@jwt_required()
+def check_user_favorites(tid):
+
+    batch = parse_favorite_batch()
+    found = dict(((x.favorite_type, x.favorite_id), x.id) for x in favorites_in(tid, batch.keys()))
+    result = [{
+        "favorite_type": favorite_type,
+        "favorite_id": favorite_id,
+        "favorited": (favorite_type, favorite_id) in found,
+        "id": found.get((favorite_type, favorite_id), None)
+    } for favorite_type, favorite_id in batch.keys()]
+
+    return jsonify(result), 200
+
 #Get a favorite
-@app.route('/favorite',methods=['POST'])
+@api.route('/favorite',methods=['POST'])
 @jwt_required()
 def get_favorite():
-    favorite_name= request.json.get("favorite_name",None)
     favorite_type= request.json.get("favorite_type",None)
     favorite_id= request.json.get("favorite_id",None)
     user_id= request.json.get("user_id",None)
-    favorite = Favorite.query.filter_by(favorite_name=favorite_name,favorite_id=favorite_id,favorite_type=favorite_type,user_id=user_id).first()
+    # looked up by the unique (user_id, favorite_type, favorite_id) index, favorite_name is not needed
+    favorite = Favorite.query.filter_by(user_id=user_id,favorite_type=favorite_type,favorite_id=favorite_id).first()
     if favorite:
         return jsonify(favorite.serialize()),200
     else:
@@ -143,91 +470,220 @@ def get_favorite():
 #----------------------------------------------PLANETS ENDPOINTS----------------------------------------
 
 #Get all Planets
-@app.route('/planet', methods=['GET'])
+@api.route('/planet', methods=['GET'])
 @jwt_required()
+@cached('planet', 'character')
 def get_all_planets():
-    result = Planet.query.all()
-    all_planets = list(map(lambda x: x.serialize(), result))
-    return jsonify(all_planets), 200
+    if 'ids' in request.args:
+        return jsonify(multi_get(Planet, request.args)), 200
+    if wants_stream():
+        return stream_collection(Planet, request.args)
+    all_planets, headers = keyset_page(Planet, request.args)
+    return jsonify(all_planets), 200, headers
 
 #Get one Planet
-@app.route('/planet/<int:id>', methods=['GET'])
+@api.route('/planet/<int:id>', methods=['GET'])
 @jwt_required()
+@cached('film', 'character', 'planet', 'specie')
 def get_planet(id):
+    includes = parse_includes(Planet, request.args)
+
+    document = read_document('planet', id) if not includes else None
+    if document is not None:
+        return current_app.response_class(document, mimetype='application/json'), 200
 
-    planet = Planet.query.get(id)
+    planet = Planet.query.options(*include_options(Planet, includes)).get(id)
 
     if planet is None:
         raise APIException('Planet not found', status_code=404)
   
-    return jsonify(planet.serialize()), 200    
+    return jsonify(serialize_with(planet, includes)), 200    
 
 #----------------------------------------------CHARACTERS ENDPOINTS----------------------------------------
 
 #Get all characters
-@app.route('/character', methods=['GET'])
+@api.route('/character', methods=['GET'])
 @jwt_required()
+@cached('character')
 def get_all_characters():
-    result = Character.query.all()
-    all_characters = list(map(lambda x: x.serialize(), result))
-    return jsonify(all_characters), 200
+    if 'ids' in request.args:
+        return jsonify(multi_get(Character, request.args)), 200
+    if wants_stream():
+        return stream_collection(Character, request.args)
+    all_characters, headers = keyset_page(Character, request.args)
+    return jsonify(all_characters), 200, headers
 
 #Get one Character
-@app.route('/character/<int:id>', methods=['GET'])
+@api.route('/character/<int:id>', methods=['GET'])
 @jwt_required()
+@cached('film', 'character', 'planet', 'specie')
 def get_character(id):
+    includes = parse_includes(Character, request.args)
 
-    character = Character.query.get(id)
+    character = Character.query.options(*include_options(Character, includes)).get(id)
 
     if character is None:
         raise APIException('Character not found', status_code=404)
   
-    return jsonify(character.serialize()), 200   
+    return jsonify(serialize_with(character, includes)), 200   
 
 #----------------------------------------------SPECIES ENDPOINTS----------------------------------------
 
 #Get all Species
-@app.route('/specie', methods=['GET'])
+@api.route('/specie', methods=['GET'])
 @jwt_required()
+@cached('specie', 'character')
 def get_all_species():
-    result = Specie.query.all()
-    all_species = list(map(lambda x: x.serialize(), result))
-    return jsonify(all_species), 200
+    if 'ids' in request.args:
+        return jsonify(multi_get(Specie, request.args)), 200
+    if wants_stream():
+        return stream_collection(Specie, request.args)
+    all_species, headers = keyset_page(Specie, request.args)
+    return jsonify(all_species), 200, headers
 
 #Get one Specie
-@app.route('/specie/<int:id>', methods=['GET'])
+@api.route('/specie/<int:id>', methods=['GET'])
 @jwt_required()
+@cached('film', 'character', 'planet', 'specie')
 def get_specie(id):
+    includes = parse_includes(Specie, request.args)
+
+    document = read_document('specie', id) if not includes else None
+    if document is not None:
+        return current_app.response_class(document, mimetype='application/json'), 200
 
-    specie = Specie.query.get(id)
+    specie = Specie.query.options(*include_options(Specie, includes)).get(id)
 
     if specie is None:
         raise APIException('Specie not found', status_code=404)
   
-    return jsonify(specie.serialize()), 200   
+    return jsonify(serialize_with(specie, includes)), 200   
 
 
 #----------------------------------------------FILMS ENDPOINTS----------------------------------------
 
 #Get all Films
-@app.route('/film', methods=['GET'])
+@api.route('/film', methods=['GET'])
 @jwt_required()
+@cached('film', 'character', 'planet', 'specie')
 def get_all_film():
-    result = Film.query.all()
-    all_films = list(map(lambda x: x.serialize(), result))
-    return jsonify(all_films), 200
+    if 'ids' in request.args:
+        return jsonify(multi_get(Film, request.args)), 200
+    if wants_stream():
+        return stream_collection(Film, request.args)
+    all_films, headers = keyset_page(Film, request.args)
+    return jsonify(all_films), 200, headers
 
 #Get one Film
-@app.route('/film/<int:id>', methods=['GET'])
+@api.route('/film/<int:id>', methods=['GET'])
 @jwt_required()
+@cached('film', 'character', 'planet', 'specie')
 def get_film(id):
+    includes = parse_includes(Film, request.args)
 
-    film = Film.query.get(id)
+    document = read_document('film', id) if not includes else None
+    if document is not None:
+        return current_app.response_class(document, mimetype='application/json'), 200
+
+    film = Film.query.options(*include_options(Film, includes)).get(id)
 
     if film is None:
         raise APIException('Film not found', status_code=404)
   
-    return jsonify(film.serialize()), 200   
+    return jsonify(serialize_with(film, includes)), 200   
+
+
+#----------------------------------------------SEARCH ENDPOINT----------------------------------------
+
+#Typeahead over the names of characters, planets, species and film titles: /search?q=sky&type=character,planet
+@api.route('/search', methods=['GET'])
+@jwt_required()
+@conditional('character', 'planet', 'specie', 'film')
+def search():
+    query = request.args.get('q', '')
+    if not query.strip():
+        raise APIException('q is required', status_code=400)
+    kinds = None
+    if request.args.get('type', None):
+        kinds = set(request.args['type'].split(','))
+        if not kinds <= set(SEARCHABLE):
+            raise APIException('type must be one of: %s' % ', '.join(sorted(SEARCHABLE)), status_code=400)
+    limit = parse_int_arg(request.args, 'limit', default=current_app.config['SEARCH_LIMIT_DEFAULT'],
+        minimum=1, maximum=current_app.config['SEARCH_LIMIT_MAX'])
+    # g.table_versions comes from @conditional, a version the index has not seen makes it rebuild
+    results = search_index.search(db.session, query, g.table_versions, kinds, limit)
+    return jsonify(results), 200
+
+
+#----------------------------------------------POPULAR ENDPOINT----------------------------------------
+
+#Most favorited planets (p), characters (c) or films (f): /popular?type=p&limit=10
+@api.route('/popular', methods=['GET'])
+@jwt_required()
+def get_popular():
+    favorite_type = request.args.get('type', None)
+    if favorite_type not in POPULAR_TYPES:
+        raise APIException('type must be one of: %s' % ', '.join(sorted(POPULAR_TYPES)), status_code=400)
+    limit = parse_int_arg(request.args, 'limit', default=10, minimum=1, maximum=current_app.config['POPULAR_LIMIT_MAX'])
+    return jsonify(popular(db.session, favorite_type, limit)), 200
+
+
+#----------------------------------------------BATCH ENDPOINT----------------------------------------
+
+BATCH_MODELS = {'character': Character, 'planet': Planet, 'specie': Specie, 'film': Film}
+
+#Several resources of any type in one round trip: /batch?ids=character:1,character:4,planet:2,film:1
+@api.route('/batch', methods=['GET'])
+@jwt_required()
+@conditional('film', 'character', 'planet', 'specie')
+def get_batch():
+    wanted = {}
+    for item in request.args.get('ids', '').split(','):
+        if not item.strip():
+            continue
+        kind, _, id = item.strip().partition(':')
+        if kind not in BATCH_MODELS:
+            raise APIException('ids must look like <%s>:<id>' % '|'.join(sorted(BATCH_MODELS)), status_code=400)
+        wanted.setdefault(kind, []).append(id)
+    if sum(map(len, wanted.values())) > current_app.config['MULTI_GET_MAX']:
+        raise APIException('At most %d ids per request' % current_app.config['MULTI_GET_MAX'], status_code=400)
+
+    # one IN query per type, whatever the number of ids
+    response = {"missing": []}
+    for kind, ids in wanted.items():
+        ids = parse_id_list(','.join(ids), 'ids', current_app.config['MULTI_GET_MAX'])
+        response[kind], missing = fetch_by_ids(BATCH_MODELS[kind], ids)
+        response["missing"].extend('%s:%d' % (kind, id) for id in missing)
+    return jsonify(response), 200
+
+
+#----------------------------------------------EXPORT ENDPOINT----------------------------------------
+
+#Snapshot of the catalog tables: /export?format=ndjson|csv&tables=planet,film_planets (csv takes one table)
+@api.route('/export', methods=['GET'])
+@jwt_required()
+def export_catalog():
+    format = request.args.get('format', 'ndjson')
+    if format not in EXPORT_FORMATS:
+        raise APIException('format must be one of: %s' % ', '.join(EXPORT_FORMATS), status_code=400)
+    try:
+        tables = export_tables([name for name in request.args.get('tables', '').split(',') if name])
+    except ValueError as e:
+        raise APIException(str(e), status_code=400)
+    if format == 'csv' and len(tables) != 1:
+        raise APIException('csv exports one table, pass it in ?tables=', status_code=400)
+
+    headers = {}
+    level = None
+    if current_app.config['COMPRESS_ENABLED'] and request.accept_encodings['gzip']:
+        level = current_app.config['COMPRESS_LEVEL']
+        headers['Content-Encoding'] = 'gzip'
+    name = 'catalog.ndjson' if format == 'ndjson' else tables[0].name + '.csv'
+    headers['Content-Disposition'] = 'attachment; filename="%s"' % name
+    headers['Vary'] = 'Accept-Encoding'
+    body = export_stream(db.engine, format, tables, current_app.config['STREAM_BATCH_SIZE'], level)
+    mimetype = 'application/x-ndjson' if format == 'ndjson' else 'text/csv'
+    return current_app.response_class(stream_with_context(body), mimetype=mimetype, headers=headers)
 
 
 #----------------------------------------------DATA TESTING ENDPOINT----------------------------------------
@@ -259,4 +715,4 @@ def get_film(id):
 # this only runs if `$ python src/main.py` is executed
 if __name__ == '__main__':
     PORT = int(os.environ.get('PORT', 3000))
-    app.run(host='0.0.0.0', port=PORT, debug=False)
+    create_app().run(host='0.0.0.0', port=PORT, debug=False)
@@ -0,0 +1,187 @@
+"""
+Per-request SQL statement counts and timings (database, serialize, encoding), exported at
+/metrics in the Prometheus text format.
+"""
+import random
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# upper bounds in seconds of the request duration histogram
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, float('inf'))
+PHASES = ('db', 'serialize', 'encode')
+
+class RequestMetrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.collectors = []
+
+    def endpoint(self, name):
+        if name not in self.endpoints:
+            self.endpoints[name] = {
+                "requests": 0,
+                "sampled": 0,
+                "statements": 0,
+                "seconds": 0.0,
+                "db_seconds": 0.0,
+                "serialize_seconds": 0.0,
+                "encode_seconds": 0.0,
+                "response_bytes": 0,
+                "buckets": [0] * len(BUCKETS),
+            }
+        return self.endpoints[name]
+
+    def count(self, name):
+        with self.lock:
+            self.endpoint(name)["requests"] += 1
+
+    def record(self, name, current, seconds, size):
+        with self.lock:
+            data = self.endpoint(name)
+            data["sampled"] += 1
+            data["statements"] += current["statements"]
+            data["seconds"] += seconds
+            data["response_bytes"] += size
+            for phase in PHASES:
+                data[phase + "_seconds"] += current[phase]
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    data["buckets"][i] += 1
+                    break
+
+    def add_collector(self, prefix, stats):
+        # stats() returns a dict of counters kept elsewhere (cache, compression...), exported as <prefix>_<key>
+        self.collectors.append((prefix, stats))
+
+    def prometheus(self):
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in samples:
+                lines.append('%s%s %s' % (name, labels, value))
+
+        with self.lock:
+            endpoints = sorted(self.endpoints.items())
+            label = lambda name: '{endpoint="%s"}' % name
+            metric('swapi_requests_total', 'counter', 'Requests handled.',
+                [(label(n), d["requests"]) for n, d in endpoints])
+            metric('swapi_sampled_requests_total', 'counter', 'Requests instrumented (see METRICS_SAMPLE_RATE).',
+                [(label(n), d["sampled"]) for n, d in endpoints])
+            metric('swapi_sql_statements_total', 'counter', 'SQL statements run by sampled requests.',
+                [(label(n), d["statements"]) for n, d in endpoints])
+            for phase in PHASES:
+                metric('swapi_%s_seconds_total' % phase, 'counter', 'Time spent in %s by sampled requests.' % phase,
+                    [(label(n), round(d[phase + "_seconds"], 6)) for n, d in endpoints])
+            metric('swapi_response_bytes_total', 'counter', 'Response bytes of sampled requests (streamed bodies count as 0).',
+                [(label(n), d["response_bytes"]) for n, d in endpoints])
+
+            lines.append('# HELP swapi_request_duration_seconds Duration of sampled requests.')
+            lines.append('# TYPE swapi_request_duration_seconds histogram')
+            for name, data in endpoints:
+                cumulative = 0
+                for bound, count in zip(BUCKETS, data["buckets"]):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('swapi_request_duration_seconds_bucket{endpoint="%s",le="%s"} %d' % (name, le, cumulative))
+                lines.append('swapi_request_duration_seconds_sum{endpoint="%s"} %s' % (name, round(data["seconds"], 6)))
+                lines.append('swapi_request_duration_seconds_count{endpoint="%s"} %d' % (name, data["sampled"]))
+
+        for prefix, stats in self.collectors:
+            for key, value in sorted(stats().items()):
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append('# TYPE %s_%s gauge' % (prefix, key))
+                    lines.append('%s_%s %s' % (prefix, key, value))
+        return '\n'.join(lines) + '\n'
+
+request_metrics = RequestMetrics()
+
+def sampled():
+    return has_request_context() and g.get('metrics', None) is not None
+
+@contextmanager
+def timer(phase):
+    # adds the time spent in the block to `phase` of the current request, free when not sampled
+    if not sampled():
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        g.metrics[phase] += time.perf_counter() - start
+
+#----------------------------------------------SQLALCHEMY----------------------------------------
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if sampled():
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('query_start', None)
+    if starts and sampled():
+        g.metrics["db"] += time.perf_counter() - starts.pop()
+        g.metrics["statements"] += 1
+
+#----------------------------------------------FLASK----------------------------------------
+
+def timed_json(app):
+    # JSON encoding time, through the JSON provider on Flask >= 2.2 or the encoder class before that
+    try:
+        from flask.json.provider import DefaultJSONProvider
+    except ImportError:
+        from flask.json import JSONEncoder
+
+        class TimedJSONEncoder(JSONEncoder):
+            def encode(self, o):
+                with timer('encode'):
+                    return JSONEncoder.encode(self, o)
+
+        app.json_encoder = TimedJSONEncoder
+        return
+
+    # wraps whatever provider is installed (see serializers.setup_serializers)
+    base = type(app.json) if isinstance(app.json, DefaultJSONProvider) else DefaultJSONProvider
+
+    class TimedJSONProvider(base):
+        def dumps(self, obj, **kwargs):
+            with timer('encode'):
+                return base.dumps(self, obj, **kwargs)
+
+    app.json = TimedJSONProvider(app)
+
+def setup_metrics(app):
+    timed_json(app)
+
+    @app.before_request
+    def start_request_metrics():
+        g.request_start = time.perf_counter()
+        if app.config['METRICS_SAMPLE_RATE'] >= 1 or random.random() < app.config['METRICS_SAMPLE_RATE']:
+            g.metrics = {"statements": 0, "db": 0.0, "serialize": 0.0, "encode": 0.0}
+
+    @app.after_request
+    def record_request_metrics(response):
+        name = request.endpoint or 'not_found'
+        request_metrics.count(name)
+        current = g.get('metrics', None)
+        if current is None or 'request_start' not in g:
+            return response
+        seconds = time.perf_counter() - g.request_start
+        size = 0 if response.is_streamed else (response.content_length or 0)
+        request_metrics.record(name, current, seconds, size)
+        if app.config['METRICS_SERVER_TIMING']:
+            response.headers['Server-Timing'] = ', '.join([
+                'db;dur=%.3f;desc="%d statements"' % (current["db"] * 1000, current["statements"]),
+                'serialize;dur=%.3f' % (current["serialize"] * 1000),
+                'encode;dur=%.3f' % (current["encode"] * 1000),
+                'total;dur=%.3f' % (seconds * 1000),
+            ])
+        return response
@@ -7,7 +7,7 @@ db = SQLAlchemy()
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(120), unique=True, nullable=False)
-    password = db.Column(db.String(80), unique=False, nullable=False)
+    password = db.Column(db.String(255), unique=False, nullable=False)
     is_active = db.Column(db.Boolean(), unique=False, nullable=False)
     favorites = db.relationship('Favorite',backref='user', lazy=True)
 
@@ -37,8 +37,8 @@ class Planet(db.Model):
     orbital_period = db.Column(db.Integer)
     gravity = db.Column(db.String(250))
     population = db.Column(db.Integer, nullable=False)
-    climate = db.Column(db.String(250))
-    terrain = db.Column(db.String(250), nullable=False)
+    climate = db.Column(db.String(250), index=True)
+    terrain = db.Column(db.String(250), nullable=False, index=True)
     surface_water = db.Column(db.Integer)  
     characters = db.relationship('Character',backref='planet', lazy=True)
     species = db.relationship('Specie',backref='planet', lazy=True)
@@ -80,8 +80,8 @@ class Character(db.Model):
     skin_color = db.Column(db.String(250))
     eye_color = db.Column(db.String(250))
     birth_year = db.Column(db.String(250), nullable=False)
-    gender = db.Column(db.String(30), nullable=False)
-    planet_id = db.Column(db.Integer, db.ForeignKey('planet.id'),nullable=True)
+    gender = db.Column(db.String(30), nullable=False, index=True)
+    planet_id = db.Column(db.Integer, db.ForeignKey('planet.id'),nullable=True, index=True)
 
     def __repr__(self):
         return '<Character %r>' % self.name
@@ -114,6 +114,8 @@ class Favorite(db.Model):
     favorite_id=db.Column(db.Integer, nullable=False)
     favorite_name=db.Column(db.String(250),nullable=False)
     favorite_type = db.Column(db.String(1))
+    # a user can favorite an entity only once, also serves the User.favorites lookup by user_id
+    __table_args__ = (db.Index('ix_favorite_user_type_id', 'user_id', 'favorite_type', 'favorite_id', unique=True),)
 
     def __repr__(self):
         return '<Favorite %r>' % self.user_id
@@ -127,6 +129,16 @@ class Favorite(db.Model):
             "favorite_type": self.favorite_type
         }
 
+class FavoriteCount(db.Model):
+    # users who have (favorite_type, favorite_id) in their favorites, kept up to date by popular.py
+    __tablename__ = 'favorite_count'
+    favorite_type = db.Column(db.String(1), primary_key=True)
+    favorite_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<FavoriteCount %r %r %r>' % (self.favorite_type, self.favorite_id, self.count)
+
 #----------------------------------------------SPECIE----------------------------------------
 
 species_characters = db.Table('species_characters',
@@ -137,7 +149,7 @@ species_characters = db.Table('species_characters',
 class Specie(db.Model):
     id=db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(250), nullable=False)
-    classification = db.Column(db.String(250), nullable=False)
+    classification = db.Column(db.String(250), nullable=False, index=True)
     designation = db.Column(db.String(250))
     average_height = db.Column(db.Integer)
     average_lifespan = db.Column(db.Integer)
@@ -145,8 +157,8 @@ class Specie(db.Model):
     skin_colors = db.Column(db.String(250))
     eye_colors = db.Column(db.String(250))
     language = db.Column(db.String(250))
-    planet_id = db.Column(db.Integer, db.ForeignKey('planet.id'),nullable=True)
-    characters = db.relationship('Character', secondary=species_characters, lazy='subquery',backref=db.backref('Specie', lazy=True))
+    planet_id = db.Column(db.Integer, db.ForeignKey('planet.id'),nullable=True, index=True)
+    characters = db.relationship('Character', secondary=species_characters, lazy=True,backref=db.backref('Specie', lazy=True))
 
     def __repr__(self):
         return '<Specie %r>' % self.name
@@ -193,14 +205,14 @@ film_species = db.Table('film_species',
 class Film(db.Model):
     id=db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(250), nullable=False)
-    episode_id = db.Column(db.Integer, nullable=False)
+    episode_id = db.Column(db.Integer, nullable=False, index=True)
     producer = db.Column(db.String(250), nullable=False)
-    director = db.Column(db.String(250), nullable=False)
+    director = db.Column(db.String(250), nullable=False, index=True)
     release_date = db.Column(db.String(250), nullable=False)
     opening = db.Column(db.String(8000))
-    characters = db.relationship('Character', secondary=film_characters, lazy='subquery',backref=db.backref('Film', lazy=True))
-    planets = db.relationship('Planet', secondary=film_planets, lazy='subquery',backref=db.backref('Film', lazy=True))
-    species = db.relationship('Specie', secondary=film_species, lazy='subquery',backref=db.backref('Film', lazy=True))
+    characters = db.relationship('Character', secondary=film_characters, lazy=True,backref=db.backref('Film', lazy=True))
+    planets = db.relationship('Planet', secondary=film_planets, lazy=True,backref=db.backref('Film', lazy=True))
+    species = db.relationship('Specie', secondary=film_species, lazy=True,backref=db.backref('Film', lazy=True))
 
     def __repr__(self):
         return '<Film %r>' % self.title
@@ -217,4 +229,27 @@ class Film(db.Model):
             "characters": list(map(lambda x: x.serializeAbs(), self.characters)),
             "planets": list(map(lambda x: x.serializeAbs(), self.planets)),
             "species": list(map(lambda x: x.serializeAbs(), self.species)),
-        }
\ No newline at end of file
+        }
+
+#----------------------------------------------TABLE VERSION----------------------------------------
+
+class TableVersion(db.Model):
+    # bumped in the same transaction as any write to `name`, used to build the ETags (see cache.py)
+    __tablename__ = 'table_version'
+    name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<TableVersion %r>' % self.name
+
+#----------------------------------------------READ MODEL----------------------------------------
+
+class ReadModel(db.Model):
+    # serialize() output of a planet, specie or film, kept up to date by read_model.py
+    __tablename__ = 'read_model'
+    kind = db.Column(db.String(16), primary_key=True)
+    entity_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    body = db.Column(db.Text, nullable=False)
+
+    def __repr__(self):
+        return '<ReadModel %r %r>' % (self.kind, self.entity_id)
@@ -0,0 +1,233 @@
+"""
+Favorite counts (favorite_count, updated with the favorite rows) and the in-memory
+leaderboard behind /popular. `flask reconcile-favorite-counts` recounts them.
+"""
+import collections
+import heapq
+import threading
+import time
+import click
+from sqlalchemy import event, select, func, tuple_, bindparam
+from sqlalchemy.orm import Session, attributes
+from models import db, Favorite, FavoriteCount, Planet, Character, Film
+from cache import flushed_objects
+
+# favorite_type -> (model, column with its name) for /popular
+POPULAR_TYPES = {
+    'p': (Planet, 'name'),
+    'c': (Character, 'name'),
+    'f': (Film, 'title'),
+}
+
+class Leaderboard:
+
+    def __init__(self, refresh_seconds=30):
+        self.lock = threading.Lock()
+        self.refresh_seconds = refresh_seconds
+        self.counts = {}      # favorite_type -> {favorite_id: count}
+        self.heaps = {}       # favorite_type -> [(-count, favorite_id)], stale entries included
+        self.loaded = None    # time.monotonic() of the last load, None until loaded
+        self.loads = 0
+        self.updates = 0
+        self.compactions = 0
+
+    def push(self, favorite_type, favorite_id, count):
+        heap = self.heaps.setdefault(favorite_type, [])
+        heapq.heappush(heap, (-count, favorite_id))
+        if len(heap) > 2 * len(self.counts[favorite_type]) + 64:
+            # amortized over the pushes that made the entries stale
+            self.heaps[favorite_type] = heap = [(-c, id) for id, c in self.counts[favorite_type].items()]
+            heapq.heapify(heap)
+            self.compactions += 1
+
+    def apply(self, deltas):
+        """Add the count changes of a local commit, {(favorite_type, favorite_id): delta}."""
+        with self.lock:
+            if self.loaded is None:
+                return
+            for (favorite_type, favorite_id), delta in deltas.items():
+                counts = self.counts.setdefault(favorite_type, {})
+                count = counts.get(favorite_id, 0) + delta
+                if count > 0:
+                    counts[favorite_id] = count
+                    self.push(favorite_type, favorite_id, count)
+                else:
+                    # its heap entries are stale now, they are dropped when they reach the top
+                    counts.pop(favorite_id, None)
+            self.updates += 1
+
+    def load(self, session):
+        counts = {}
+        for favorite_type, favorite_id, count in session.query(FavoriteCount.favorite_type, FavoriteCount.favorite_id, FavoriteCount.count).filter(FavoriteCount.count > 0):
+            counts.setdefault(favorite_type, {})[favorite_id] = count
+        heaps = {}
+        for favorite_type, ids in counts.items():
+            heaps[favorite_type] = [(-count, id) for id, count in ids.items()]
+            heapq.heapify(heaps[favorite_type])
+        with self.lock:
+            self.counts, self.heaps = counts, heaps
+            self.loaded = time.monotonic()
+            self.loads += 1
+
+    def expire(self):
+        with self.lock:
+            self.loaded = None
+
+    def top(self, session, favorite_type, k):
+        """[(favorite_id, count)] of the k most favorited, ties by id."""
+        if self.loaded is None or time.monotonic() - self.loaded > self.refresh_seconds:
+            self.load(session)
+        with self.lock:
+            heap = self.heaps.get(favorite_type, [])
+            counts = self.counts.get(favorite_type, {})
+            best = []
+            while heap and len(best) < k:
+                count, id = heapq.heappop(heap)
+                if counts.get(id, None) == -count and (not best or best[-1][0] != id):
+                    best.append((id, -count))
+            for id, count in best:
+                heapq.heappush(heap, (-count, id))
+            return best
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": sum(map(len, self.counts.values())),
+                "heap_entries": sum(map(len, self.heaps.values())),
+                "loads": self.loads,
+                "updates": self.updates,
+                "compactions": self.compactions,
+            }
+
+leaderboard = Leaderboard()
+
+def popular(session, favorite_type, k):
+    """The k most favorited entities of a type with their names, one IN query for the names."""
+    best = leaderboard.top(session, favorite_type, k)
+    model, column = POPULAR_TYPES[favorite_type]
+    names = dict(session.query(model.id, getattr(model, column)).filter(model.id.in_([id for id, count in best]))) if best else {}
+    return [{"favorite_type": favorite_type, "favorite_id": id, "name": names.get(id, None), "count": count} for id, count in best]
+
+#----------------------------------------------COUNTS----------------------------------------
+
+def add_counts(session, deltas):
+    """Add {(favorite_type, favorite_id): delta} to favorite_count in the current transaction."""
+    deltas = dict((key, delta) for key, delta in deltas.items() if delta and key[0] is not None)
+    if not deltas:
+        return
+    table = FavoriteCount.__table__
+    connection = session.connection()
+    # sorted, the same lock order as bump_versions
+    keys = sorted(deltas)
+    update = table.update().where(table.c.favorite_type == bindparam('t')).where(table.c.favorite_id == bindparam('i')) \
+        .values(count=table.c.count + bindparam('d'))
+    if len(keys) == 1:
+        # a single favorite: one UPDATE, plus an INSERT the first time the entity is favorited
+        (t, i), = keys
+        if connection.execute(update, {"t": t, "i": i, "d": deltas[(t, i)]}).rowcount == 0:
+            connection.execute(table.insert().values(favorite_type=t, favorite_id=i, count=max(0, deltas[(t, i)])))
+    else:
+        existing = set(tuple(row) for row in connection.execute(
+            select(table.c.favorite_type, table.c.favorite_id).where(tuple_(table.c.favorite_type, table.c.favorite_id).in_(keys))))
+        updates = [{"t": t, "i": i, "d": deltas[(t, i)]} for t, i in keys if (t, i) in existing]
+        inserts = [{"favorite_type": t, "favorite_id": i, "count": max(0, deltas[(t, i)])} for t, i in keys if (t, i) not in existing]
+        if updates:
+            connection.execute(update, updates)
+        if inserts:
+            connection.execute(table.insert(), inserts)
+    pending = session.info.setdefault('favorite_count_deltas', {})
+    for key, delta in deltas.items():
+        pending[key] = pending.get(key, 0) + delta
+
+def recount(session, keys):
+    """Set the counts of `keys` from the favorite table, when the rows a bulk statement changed are unknown."""
+    keys = sorted(set(key for key in keys if key[0] is not None))
+    if not keys:
+        return
+    table = FavoriteCount.__table__
+    connection = session.connection()
+    counts = dict(((t, i), n) for t, i, n in connection.execute(
+        select(Favorite.favorite_type, Favorite.favorite_id, func.count())
+        .where(tuple_(Favorite.favorite_type, Favorite.favorite_id).in_(keys))
+        .group_by(Favorite.favorite_type, Favorite.favorite_id)))
+    connection.execute(table.delete().where(tuple_(table.c.favorite_type, table.c.favorite_id).in_(keys)))
+    if counts:
+        connection.execute(table.insert(), [{"favorite_type": t, "favorite_id": i, "count": n} for (t, i), n in sorted(counts.items())])
+    # the in-memory counts can't be patched with a delta, they are reloaded on the next /popular
+    session.info['favorite_counts_stale'] = True
+
+def count_favorites(session, keys, delta, rowcount):
+    """
+    Account for a bulk insert (delta 1) or delete (delta -1) of the favorites `keys` of one user.
+    `keys` are the ones expected to change, `rowcount` the rows the statement did change: when they
+    differ a concurrent request changed some of them too and the keys are recounted instead.
+    """
+    if rowcount == len(keys):
+        add_counts(session, dict((key, delta) for key in keys))
+    else:
+        recount(session, keys)
+
+def reconcile(session):
+    """Recount favorite_count from the favorite table, returns the number of counts fixed."""
+    table = FavoriteCount.__table__
+    actual = dict(((t, i), n) for t, i, n in session.query(Favorite.favorite_type, Favorite.favorite_id, func.count())
+        .filter(Favorite.favorite_type.isnot(None)).group_by(Favorite.favorite_type, Favorite.favorite_id))
+    stored = dict(((t, i), n) for t, i, n in session.query(table.c.favorite_type, table.c.favorite_id, table.c.count))
+    wrong = [key for key in set(actual) | set(stored) if actual.get(key, 0) != stored.get(key, 0)]
+    connection = session.connection()
+    for start in range(0, len(wrong), 500):
+        keys = wrong[start:start + 500]
+        connection.execute(table.delete().where(tuple_(table.c.favorite_type, table.c.favorite_id).in_(keys)))
+        rows = [{"favorite_type": t, "favorite_id": i, "count": actual[(t, i)]} for t, i in keys if (t, i) in actual]
+        if rows:
+            connection.execute(table.insert(), rows)
+    session.commit()
+    leaderboard.expire()
+    return len(wrong)
+
+#----------------------------------------------INCREMENTAL UPDATES----------------------------------------
+
+def favorite_key(obj, history=False):
+    if not history:
+        return obj.favorite_type, obj.favorite_id
+    # the key as it was loaded, before the changes being flushed
+    def loaded(name):
+        h = attributes.get_history(obj, name)
+        return (h.deleted or h.unchanged or [getattr(obj, name)])[0]
+    return loaded('favorite_type'), loaded('favorite_id')
+
+@event.listens_for(Session, 'after_flush')
+def count_flushed_favorites(session, flush_context):
+    deltas = collections.Counter()
+    for state, obj in flushed_objects(session, Favorite):
+        if state == 'new':
+            deltas[favorite_key(obj)] += 1
+        elif state == 'deleted':
+            deltas[favorite_key(obj, history=True)] -= 1
+        elif session.is_modified(obj):
+            old, new = favorite_key(obj, history=True), favorite_key(obj)
+            if old != new:
+                deltas[old] -= 1
+                deltas[new] += 1
+    add_counts(session, deltas)
+
+@event.listens_for(Session, 'after_commit')
+def apply_favorite_counts(session):
+    deltas = session.info.pop('favorite_count_deltas', {})
+    if session.info.pop('favorite_counts_stale', False):
+        leaderboard.expire()
+    elif deltas:
+        leaderboard.apply(deltas)
+
+@event.listens_for(Session, 'after_rollback')
+def forget_favorite_counts(session):
+    session.info.pop('favorite_count_deltas', None)
+    session.info.pop('favorite_counts_stale', None)
+
+def setup_popular(app):
+    leaderboard.refresh_seconds = app.config['POPULAR_REFRESH_SECONDS']
+
+    @app.cli.command('reconcile-favorite-counts')
+    def reconcile_favorite_counts():
+        """Recount favorite_count from the favorite table."""
+        click.echo('%d counts fixed' % reconcile(db.session))
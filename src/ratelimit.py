@@ -0,0 +1,250 @@
+"""
+Request admission: per-client token buckets (429) and MAX_CONCURRENT_REQUESTS (503),
+checked before any query.
+"""
+import math
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from flask import request, jsonify, g, current_app
+from flask_jwt_extended import verify_jwt_in_request, get_jwt_identity
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+class Limit:
+    """'<count>/<period>[:<burst>]', for example '10/minute' or '100/second:200'."""
+
+    def __init__(self, text):
+        spec, _, burst = text.strip().partition(':')
+        count, _, period = spec.partition('/')
+        if period not in PERIODS:
+            raise ValueError('Invalid rate limit %r, expected <count>/<second|minute|hour|day>' % text)
+        self.text = text.strip()
+        self.count = int(count)
+        self.rate = self.count / float(PERIODS[period])
+        self.burst = int(burst) if burst else self.count
+
+def parse_limits(text, endpoints=None):
+    # 'api.login=10/minute,api.get_film=50/second' -> {'api.login': Limit, ...}, the names must be in `endpoints` if given
+    limits = {}
+    for item in text.split(','):
+        if item.strip():
+            endpoint, _, limit = item.partition('=')
+            limits[endpoint.strip()] = Limit(limit)
+    unknown = set(limits) - set(endpoints) if endpoints is not None else ()
+    if unknown:
+        # a typo would silently leave the endpoint on the default limit
+        raise ValueError('Unknown endpoints in RATE_LIMITS: %s' % ', '.join(sorted(unknown)))
+    return limits
+
+#----------------------------------------------BACKENDS----------------------------------------
+
+class BackendUnavailable(Exception):
+    """A backend could not answer in time, the request is let through (see admit_request)."""
+
+class MemoryBackend:
+    """Token buckets of this process, the least recently used are dropped above `maxsize`."""
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, burst, now=None):
+        """Take one token, returns (allowed, tokens left, seconds until the next token)."""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self.maxsize:
+                self.buckets.popitem(last=False)
+        return allowed, int(tokens), 0.0 if allowed else (1 - tokens) / rate
+
+class SQLiteBackend:
+    """
+    Token buckets in a SQLite file, shared by all the processes of a host. Each take() is one
+    IMMEDIATE transaction, so concurrent workers never hand out the same token twice.
+    """
+
+    def __init__(self, path, busy_timeout=0.1, retries=3, backoff=0.005):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.local = threading.local()
+
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or getattr(self.local, 'pid', None) != os.getpid():
+            # one connection per thread, and new ones after gunicorn forks the workers
+            connection = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            # no fsync per commit, a crash can only lose the last bucket updates
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS bucket (key TEXT PRIMARY KEY, tokens REAL, updated REAL)')
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    def take(self, key, rate, burst, now=None):
+        # a few short retries when the file stays locked past busy_timeout, then BackendUnavailable
+        for attempt in range(self.retries + 1):
+            try:
+                return self.take_once(key, rate, burst, now)
+            except sqlite3.OperationalError as error:
+                if 'locked' not in str(error) and 'busy' not in str(error):
+                    raise
+                if attempt == self.retries:
+                    raise BackendUnavailable(str(error))
+                time.sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+
+    def take_once(self, key, rate, burst, now=None):
+        # wall clock, the monotonic clocks of two processes are not comparable
+        now = time.time() if now is None else now
+        connection = self.connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT tokens, updated FROM bucket WHERE key = ?', (key,)).fetchone()
+            tokens, updated = row if row is not None else (burst, now)
+            tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            connection.execute('INSERT OR REPLACE INTO bucket (key, tokens, updated) VALUES (?, ?, ?)', (key, tokens, now))
+            connection.execute('COMMIT')
+        except Exception:
+            if connection.in_transaction:
+                connection.execute('ROLLBACK')
+            raise
+        return allowed, int(tokens), 0.0 if allowed else (1 - tokens) / rate
+
+def make_backend(url):
+    # 'memory' or 'sqlite:///path/to/buckets.db'
+    if url == 'memory':
+        return MemoryBackend()
+    if url.startswith('sqlite:///'):
+        return SQLiteBackend(url[len('sqlite:///'):])
+    raise ValueError('Unknown RATE_LIMIT_BACKEND: %s' % url)
+
+#----------------------------------------------ADMISSION----------------------------------------
+
+class AdmissionStats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.allowed = 0
+        self.limited = 0
+        self.shed = 0
+        self.backend_errors = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def count(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def enter(self):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def leave(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "allowed": self.allowed,
+                "limited": self.limited,
+                "shed": self.shed,
+                "backend_errors": self.backend_errors,
+                "in_flight": self.in_flight,
+                "max_in_flight": self.max_in_flight,
+            }
+
+admission_stats = AdmissionStats()
+
+def client_key():
+    # the JWT identity when the request has a valid token, so clients behind one NAT don't share a bucket
+    try:
+        # verify_jwt_in_request returns None in flask_jwt_extended 4.1 (Pipfile.lock) whatever the token
+        verify_jwt_in_request(optional=True)
+        identity = get_jwt_identity()
+        if identity is not None:
+            return 'user:%s' % identity
+    except Exception:
+        # invalid or expired tokens are rejected by @jwt_required() later, here they count as the IP
+        pass
+    # the client address once ProxyFix (PROXY_FIX_HOPS) has read X-Forwarded-For, the proxy's without it
+    return 'ip:%s' % request.remote_addr
+
+def too_many(status, message, retry_after, headers=None):
+    response = jsonify({"message": message})
+    response.status_code = status
+    response.headers['Retry-After'] = str(max(1, int(math.ceil(retry_after))))
+    response.headers.extend(headers or {})
+    return response
+
+def setup_rate_limit(app):
+    """
+    Registers the admission hooks, call it before the other setup_* so it runs first and after
+    the routes, the endpoints of RATE_LIMITS must exist.
+    """
+    if not app.config['RATE_LIMIT_ENABLED'] and not app.config['MAX_CONCURRENT_REQUESTS']:
+        return
+    backend = app.config['RATE_LIMIT_BACKEND']
+    backend = make_backend(backend) if isinstance(backend, str) else backend
+    limits = parse_limits(app.config['RATE_LIMITS'], app.view_functions)
+    default = Limit(app.config['RATE_LIMIT_DEFAULT']) if app.config['RATE_LIMIT_DEFAULT'] else None
+    exempt = set(app.config['RATE_LIMIT_EXEMPT'])
+    slots = threading.BoundedSemaphore(app.config['MAX_CONCURRENT_REQUESTS']) if app.config['MAX_CONCURRENT_REQUESTS'] else None
+    app.extensions['rate_limit_backend'] = backend
+
+    @app.before_request
+    def admit_request():
+        endpoint = request.endpoint
+        if endpoint in exempt:
+            return None
+        if slots is not None:
+            if not slots.acquire(blocking=False):
+                admission_stats.count('shed')
+                return too_many(503, 'Server busy, retry later', 1)
+            g.admission_slot = True
+            admission_stats.enter()
+        limit = limits.get(endpoint, default) if app.config['RATE_LIMIT_ENABLED'] else None
+        if limit is None:
+            return None
+        try:
+            allowed, remaining, retry_after = backend.take('%s:%s' % (endpoint, client_key()), limit.rate, limit.burst)
+        except BackendUnavailable as error:
+            # fail open, a busy limiter must not turn into errors for every client
+            admission_stats.count('backend_errors')
+            current_app.logger.warning('Rate limit backend unavailable, request let through: %s', error)
+            return None
+        headers = {'X-RateLimit-Limit': limit.text, 'X-RateLimit-Remaining': str(remaining)}
+        if not allowed:
+            admission_stats.count('limited')
+            return too_many(429, 'Too many requests', retry_after, headers)
+        admission_stats.count('allowed')
+        g.rate_limit_headers = headers
+        return None
+
+    @app.after_request
+    def rate_limit_headers(response):
+        response.headers.extend(g.pop('rate_limit_headers', {}))
+        return response
+
+    @app.teardown_request
+    def release_slot(exc):
+        # teardown runs once the body is sent, streamed responses keep their slot until the end
+        if g.pop('admission_slot', None):
+            slots.release()
+            admission_stats.leave()
@@ -0,0 +1,115 @@
+"""
+Optional denormalized read model (READ_MODEL_ENABLED=1): the serialized planet, specie
+and film documents, rebuilt in the transaction that changes them. Run `flask rebuild-read-model`
+after enabling it.
+"""
+import click
+from flask import json
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+from models import db, ReadModel, Planet, Character, Specie, Film, species_characters, film_characters, film_planets, film_species
+
+# kind -> (model, loader options used to serialize it), filled by setup_read_model
+documents = {}
+settings = {"enabled": False}
+
+def kind_of(obj):
+    for kind, (model, options) in documents.items():
+        if isinstance(obj, model):
+            return kind
+    return None
+
+def related(connection, column, match_column, value, kind):
+    return set((kind, row[0]) for row in connection.execute(select(column).where(match_column == value)))
+
+def affected_documents(connection, obj):
+    """The documents that embed `obj`, looked up in the association tables as they are now."""
+    if isinstance(obj, Film):
+        return {('film', obj.id)}
+    if isinstance(obj, Planet):
+        return {('planet', obj.id)} | related(connection, film_planets.c.film_id, film_planets.c.planet_id, obj.id, 'film')
+    if isinstance(obj, Specie):
+        return {('specie', obj.id)} | related(connection, film_species.c.film_id, film_species.c.specie_id, obj.id, 'film')
+    if isinstance(obj, Character):
+        # the planet in the database (before the flush, the previous one) and the one being set; the
+        # attribute history has no previous value when planet_id was not loaded (load_only summaries)
+        character = Character.__table__
+        planets = set(key for key in related(connection, character.c.planet_id, character.c.id, obj.id, 'planet') if key[1] is not None)
+        if obj.planet_id is not None:
+            planets.add(('planet', obj.planet_id))
+        return planets | related(connection, species_characters.c.specie_id, species_characters.c.character_id, obj.id, 'specie') \
+            | related(connection, film_characters.c.film_id, film_characters.c.character_id, obj.id, 'film')
+    return set()
+
+def rebuild(session, keys):
+    table = ReadModel.__table__
+    connection = session.connection()
+    for kind, entity_id in sorted(keys):
+        model, options = documents[kind]
+        # populate_existing: an instance already in the session gets its collections reloaded too,
+        # they may still hold the rows as they were before this transaction
+        obj = session.query(model).options(*options).populate_existing().filter(model.id == entity_id).one_or_none()
+        connection.execute(table.delete().where(table.c.kind == kind).where(table.c.entity_id == entity_id))
+        if obj is not None:
+            connection.execute(table.insert().values(kind=kind, entity_id=entity_id, body=json.dumps(obj.serialize())))
+
+def read_document(kind, entity_id):
+    # the JSON body of the document, None when disabled or not built yet (the caller falls back to the ORM)
+    if not settings["enabled"]:
+        return None
+    return db.session.query(ReadModel.body).filter_by(kind=kind, entity_id=entity_id).scalar()
+
+#----------------------------------------------INCREMENTAL REBUILD----------------------------------------
+
+@event.listens_for(Session, 'before_flush')
+def collect_affected_documents(session, flush_context, instances):
+    if not settings["enabled"]:
+        return
+    pending = session.info.setdefault('read_model_pending', set())
+    created = session.info.setdefault('read_model_created', [])
+    # before the flush, so the association rows of deleted objects can still be found
+    connection = session.connection()
+    for obj in session.dirty | session.deleted:
+        if kind_of(obj) is not None or isinstance(obj, Character):
+            pending.update(affected_documents(connection, obj))
+    # new objects have no id yet, they are resolved at commit time
+    created.extend(obj for obj in session.new if kind_of(obj) is not None or isinstance(obj, Character))
+
+@event.listens_for(Session, 'before_commit')
+def rebuild_affected_documents(session):
+    if not settings["enabled"]:
+        return
+    # before_commit runs ahead of the final flush, flush now so every change has been collected
+    session.flush()
+    pending = session.info.pop('read_model_pending', set())
+    created = session.info.pop('read_model_created', [])
+    connection = session.connection()
+    for obj in created:
+        pending.update(affected_documents(connection, obj))
+    if pending:
+        rebuild(session, pending)
+
+@event.listens_for(Session, 'after_rollback')
+def forget_affected_documents(session):
+    session.info.pop('read_model_pending', None)
+    session.info.pop('read_model_created', None)
+
+def setup_read_model(app, kinds):
+    settings["enabled"] = app.config['READ_MODEL_ENABLED']
+    documents.update(kinds)
+
+    @app.cli.command('rebuild-read-model')
+    @click.option('--batch-size', default=500, help='documents per transaction')
+    def rebuild_read_model(batch_size):
+        """Rebuild every read model document."""
+        for kind, count in rebuild_all(db.session, batch_size):
+            click.echo('%s: %d documents' % (kind, count))
+
+def rebuild_all(session, batch_size=500):
+    # every document, one transaction per batch; yields (kind, documents) as each kind is done
+    for kind, (model, options) in sorted(documents.items()):
+        ids = [row[0] for row in session.query(model.id).order_by(model.id)]
+        for start in range(0, len(ids), batch_size):
+            rebuild(session, [(kind, x) for x in ids[start:start + batch_size]])
+            session.commit()
+        yield kind, len(ids)
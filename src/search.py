@@ -0,0 +1,186 @@
+"""
+Typeahead search: an in-process word index over the catalog names, updated by the commits
+of this worker and rebuilt when another one changes the tables.
+"""
+import bisect
+import heapq
+import re
+import threading
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from models import TableVersion, Planet, Character, Specie, Film
+from cache import flushed_objects, current_versions
+
+# kind -> (model, column searched)
+SEARCHABLE = {
+    'character': (Character, 'name'),
+    'planet': (Planet, 'name'),
+    'specie': (Specie, 'name'),
+    'film': (Film, 'title'),
+}
+WORD = re.compile(r'\w+', re.UNICODE)
+
+def words(text):
+    return set(WORD.findall((text or '').lower()))
+
+class PrefixIndex:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.names = {}       # (kind, id) -> name
+        self.postings = {}    # word -> set of (kind, id)
+        self.words = []       # sorted keys of postings
+        self.versions = None  # table -> version the index reflects, None until built
+        self.rebuilds = 0
+        self.updates = 0
+
+    def add(self, key, name):
+        self.remove(key)
+        self.names[key] = name
+        for word in words(name):
+            if word not in self.postings:
+                self.postings[word] = set()
+                bisect.insort(self.words, word)
+            self.postings[word].add(key)
+
+    def remove(self, key):
+        name = self.names.pop(key, None)
+        if name is None:
+            return
+        for word in words(name):
+            keys = self.postings.get(word, None)
+            if keys is None:
+                continue
+            keys.discard(key)
+            if not keys:
+                del self.postings[word]
+                del self.words[bisect.bisect_left(self.words, word)]
+
+    def prefixed(self, prefix):
+        # union of the postings of every word starting with `prefix`
+        keys = set()
+        start = bisect.bisect_left(self.words, prefix)
+        for word in self.words[start:]:
+            if not word.startswith(prefix):
+                break
+            keys |= self.postings[word]
+        return keys
+
+    def rebuild(self, session, versions):
+        names = []
+        for kind, (model, column) in SEARCHABLE.items():
+            names.extend(((kind, id), name) for id, name in session.query(model.id, getattr(model, column)))
+        with self.lock:
+            self.names, self.postings, self.words = {}, {}, []
+            for key, name in names:
+                self.add(key, name)
+            self.versions = dict(versions)
+            self.rebuilds += 1
+
+    def apply(self, changes, versions):
+        """Apply the rows changed by a local commit, `versions` are the table versions it committed."""
+        with self.lock:
+            if self.versions is None:
+                return
+            for key, name in changes:
+                if name is None:
+                    self.remove(key)
+                else:
+                    self.add(key, name)
+            self.updates += 1
+            for table, version in versions.items():
+                # every transaction bumps a table once, any other gap is a commit this index has not seen
+                if self.versions is not None and self.versions.get(table, 0) + 1 == version:
+                    self.versions[table] = version
+                else:
+                    self.versions = None
+
+    def invalidate(self):
+        with self.lock:
+            self.versions = None
+
+    def matches(self, session, query, versions, kinds=None):
+        """[((kind, id), name)] of the rows where every word of `query` prefixes a word of the name."""
+        if self.versions != dict(versions):
+            self.rebuild(session, versions)
+        terms = sorted(words(query), key=len, reverse=True)
+        if not terms:
+            return []
+        with self.lock:
+            keys = self.prefixed(terms[0])
+            for term in terms[1:]:
+                if not keys:
+                    break
+                keys &= self.prefixed(term)
+            return [(key, self.names[key]) for key in keys if kinds is None or key[0] in kinds]
+
+    def search(self, session, query, versions, kinds=None, limit=10):
+        matches = self.matches(session, query, versions, kinds)
+        query = query.strip().lower()
+        # names starting with the query first, then the shortest (closest) names
+        best = heapq.nsmallest(limit, matches, key=lambda m: (not m[1].lower().startswith(query), len(m[1]), m[1], m[0]))
+        return [{"type": kind, "id": id, "name": name} for (kind, id), name in best]
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.names), "words": len(self.words), "rebuilds": self.rebuilds, "updates": self.updates}
+
+search_index = PrefixIndex()
+
+def matching_ids(session, kind, query):
+    """Ids of the `kind` rows matching `query` like /search does, for ?q= on the collections."""
+    versions = current_versions(list(SEARCHABLE))
+    return sorted(id for (kind, id), name in search_index.matches(session, query, versions, {kind}))
+
+def searchable_kind(obj):
+    for kind, (model, column) in SEARCHABLE.items():
+        if isinstance(obj, model):
+            return kind, column
+    return None, None
+
+#----------------------------------------------INCREMENTAL UPDATES----------------------------------------
+
+@event.listens_for(Session, 'after_flush')
+def collect_search_changes(session, flush_context):
+    changes = session.info.setdefault('search_changes', [])
+    tables = session.info.setdefault('search_tables', set())
+    for state, obj in flushed_objects(session, *[model for model, column in SEARCHABLE.values()]):
+        kind, column = searchable_kind(obj)
+        changes.append(((kind, obj.id), None if state == 'deleted' else getattr(obj, column)))
+        tables.add(kind)
+    if 'search_versions' in session.info:
+        # a flush after before_commit, cache.collect_changed_tables has bumped its tables already
+        read_search_versions(session)
+
+@event.listens_for(Session, 'before_commit')
+def collect_search_versions(session):
+    # registered after cache.bump_changed_tables, so table_version is already bumped in this transaction
+    read_search_versions(session)
+    # rows written by bulk statements (mark_changed) are unknown here, rebuild on the next search
+    if set(session.info.get('bulk_changed_tables', ())) & set(SEARCHABLE):
+        session.info['search_stale'] = True
+
+def read_search_versions(session):
+    versions = session.info.setdefault('search_versions', {})
+    tables = session.info.get('search_tables', set()) - set(versions)
+    if tables:
+        rows = session.connection().execute(
+            TableVersion.__table__.select().where(TableVersion.__table__.c.name.in_(sorted(tables))))
+        versions.update((row.name, row.version) for row in rows)
+
+@event.listens_for(Session, 'after_commit')
+def apply_search_changes(session):
+    changes = session.info.pop('search_changes', ())
+    session.info.pop('search_tables', None)
+    versions = session.info.pop('search_versions', {})
+    if session.info.pop('search_stale', False):
+        search_index.invalidate()
+    elif changes or versions:
+        search_index.apply(changes, versions)
+
+@event.listens_for(Session, 'after_rollback')
+def forget_search_changes(session):
+    session.info.pop('search_changes', None)
+    session.info.pop('search_tables', None)
+    session.info.pop('search_versions', None)
+    session.info.pop('search_stale', None)
@@ -0,0 +1,109 @@
+"""
+Serializers for the collection endpoints, building the serialize() output from row tuples,
+and the optional orjson backend.
+"""
+from sqlalchemy import select
+from models import db, User, Planet, Character, Specie, Film
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+class Serializer:
+
+    def __init__(self, model, fields, summaries=()):
+        table = model.__table__
+        self.model = model
+        self.columns = [table.columns[name] for name in fields]
+        self.keys = tuple(fields)
+        self.summaries = [(name, self.summary_query(getattr(model, name).property)) for name in summaries]
+
+    @staticmethod
+    def summary_query(relationship):
+        """
+        SELECT <parent id>, <related id>, <related name> for a relationship, filtered by parent ids later.
+        Works for one-to-many (planet.characters) and many-to-many through a secondary table.
+        """
+        target = relationship.mapper.local_table
+        (parent_key, foreign_key), = relationship.synchronize_pairs
+        if relationship.secondary is None:
+            query = select(foreign_key, target.c.id, target.c.name)
+        else:
+            (target_key, secondary_key), = relationship.secondary_synchronize_pairs
+            query = select(foreign_key, target.c.id, target.c.name).select_from(
+                relationship.secondary.join(target, secondary_key == target_key))
+        # no ORDER BY, it can make the planner walk the whole related table by primary key
+        return query, foreign_key
+
+    def query(self, columns=None):
+        return db.session.query(*(columns or self.columns))
+
+    def rows(self, rows, columns=None):
+        """
+        Dicts for a batch of row tuples selected with query(columns). The relationship
+        summaries are only added to the full representation (no ?fields=).
+        """
+        keys = self.keys if columns is None else tuple(c.key for c in columns)
+        items = [dict(zip(keys, row)) for row in rows]
+        if columns is not None or not self.summaries or not items:
+            return items
+        by_id = {item["id"]: item for item in items}
+        for name, (query, parent) in self.summaries:
+            for item in items:
+                item[name] = []
+            for parent_id, id, value in sorted(db.session.execute(query.where(parent.in_(list(by_id)))), key=lambda r: r[1]):
+                by_id[parent_id][name].append({"id": id, "name": value})
+        return items
+
+# model -> Serializer, compiled once at import
+registry = {}
+
+def register(model, fields, summaries=()):
+    registry[model] = Serializer(model, fields, summaries)
+
+def serializer(model):
+    return registry[model]
+
+register(User, ('id', 'email'))
+register(Planet, ('id', 'name', 'diameter', 'rotation_period', 'orbital_period', 'gravity', 'population',
+    'climate', 'terrain', 'surface_water'), summaries=('characters',))
+register(Character, ('id', 'name', 'height', 'mass', 'hair_color', 'skin_color', 'eye_color', 'birth_year',
+    'gender', 'planet_id'))
+register(Specie, ('id', 'name', 'classification', 'designation', 'average_height', 'average_lifespan',
+    'hair_colors', 'skin_colors', 'eye_colors', 'language', 'planet_id'), summaries=('characters',))
+register(Film, ('id', 'title', 'episode_id', 'producer', 'director', 'release_date', 'opening'),
+    summaries=('characters', 'planets', 'species'))
+
+#----------------------------------------------JSON BACKEND----------------------------------------
+
+def json_backend(app):
+    backend = app.config['JSON_BACKEND']
+    if backend == 'orjson' and orjson is None:
+        raise RuntimeError('JSON_BACKEND=orjson but orjson is not installed')
+    if backend in ('auto', 'orjson') and orjson is not None:
+        return 'orjson'
+    return 'stdlib'
+
+def setup_serializers(app):
+    """Switch app.json to orjson when available, has to run before setup_metrics (which wraps it)."""
+    backend = json_backend(app)
+    if not hasattr(app, 'json'):
+        # Flask < 2.2 has no JSON provider to plug into
+        backend = 'stdlib'
+    app.config['JSON_BACKEND_IN_USE'] = backend
+    if backend != 'orjson':
+        return
+    base = type(app.json)
+
+    class OrjsonProvider(base):
+        def dumps(self, obj, **kwargs):
+            # orjson output is always compact, pretty printed responses (debug) stay on the stdlib
+            if kwargs.get('indent', None) is not None:
+                return base.dumps(self, obj, **kwargs)
+            option = orjson.OPT_NON_STR_KEYS
+            if kwargs.get('sort_keys', self.sort_keys):
+                option |= orjson.OPT_SORT_KEYS
+            return orjson.dumps(obj, default=kwargs.get('default', self.default), option=option).decode('utf-8')
+
+    app.json = OrjsonProvider(app)
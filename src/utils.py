@@ -1,4 +1,21 @@
-from flask import jsonify, url_for
+import bisect
+import itertools
+from flask import jsonify, url_for, request, current_app, json, stream_with_context
+from sqlalchemy.dialects import postgresql, sqlite
+from models import db
+from metrics import timer
+from serializers import serializer
+
+# columns that must never be returned by the API, even when asked for in ?fields=
+HIDDEN_COLUMNS = ('password',)
+
+# query parameters that filter a collection (all indexed), ?gender=female&planet_id=1,2
+FILTER_COLUMNS = {
+    'planet': ('climate', 'terrain'),
+    'character': ('gender', 'planet_id'),
+    'specie': ('classification', 'planet_id'),
+    'film': ('episode_id', 'director'),
+}
 
 class APIException(Exception):
     status_code = 400
@@ -15,13 +32,214 @@ class APIException(Exception):
         rv['message'] = self.message
         return rv
 
+def public_columns(model):
+    return [c for c in model.__table__.columns if c.key not in HIDDEN_COLUMNS]
+
+def parse_int_arg(args, name, default=None, minimum=0, maximum=None):
+    value = args.get(name, None)
+    if value is None or value == '':
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise APIException('%s must be an integer' % name, status_code=400)
+    if value < minimum:
+        raise APIException('%s must be >= %d' % (name, minimum), status_code=400)
+    if maximum is not None and value > maximum:
+        value = maximum
+    return value
+
+def parse_fields(model, args):
+    # ?fields=id,name -> list of columns, None when the full serialize() is wanted
+    fields = args.get('fields', None)
+    if not fields:
+        return None
+    columns = {c.key: c for c in public_columns(model)}
+    selected = [columns['id']]
+    for name in fields.split(','):
+        name = name.strip()
+        if name == '' or name == 'id':
+            continue
+        if name not in columns:
+            raise APIException('Unknown field: %s' % name, status_code=400)
+        if columns[name] not in selected:
+            selected.append(columns[name])
+    return selected
+
+def parse_id_list(value, name, maximum):
+    # '1,4,9' -> [1, 4, 9], duplicates dropped, the order kept
+    try:
+        ids = [int(x) for x in value.split(',') if x.strip()]
+    except ValueError:
+        raise APIException('%s must be a comma separated list of integers' % name, status_code=400)
+    ids = list(dict.fromkeys(ids))
+    if len(ids) > maximum:
+        raise APIException('At most %d ids per request' % maximum, status_code=400)
+    return ids
+
+def fetch_by_ids(model, ids, columns=None):
+    """
+    The serialized rows of `model` with these ids in the order of `ids`, with one IN query
+    (plus one per embedded relationship), and the ids that don't exist.
+    """
+    if not ids:
+        return [], []
+    encoder = serializer(model)
+    rows = encoder.query(columns).filter(model.id.in_(ids)).all()
+    with timer('serialize'):
+        found = {item["id"]: item for item in encoder.rows(rows, columns)}
+    return [found[id] for id in ids if id in found], [id for id in ids if id not in found]
+
+def multi_get(model, args):
+    """
+    ?ids=1,4,9 on a collection: {"results": [...], "missing": [...]}, the rows in the order
+    of the ids, at most MULTI_GET_MAX of them. ?fields= applies like on a page.
+    """
+    ids = parse_id_list(args['ids'], 'ids', current_app.config['MULTI_GET_MAX'])
+    items, missing = fetch_by_ids(model, ids, parse_fields(model, args))
+    return {"results": items, "missing": missing}
+
+def filter_query(model, query, args):
+    """Apply the FILTER_COLUMNS parameters present in `args` to `query`, ?q= is search_ids()."""
+    table = model.__table__
+    for name in FILTER_COLUMNS.get(table.name, ()):
+        value = args.get(name, None)
+        if value is None or value == '':
+            continue
+        column = table.columns[name]
+        values = value.split(',')
+        if column.type.python_type is int:
+            try:
+                values = [int(x) for x in values]
+            except ValueError:
+                raise APIException('%s must be a list of integers' % name, status_code=400)
+        query = query.filter(column == values[0] if len(values) == 1 else column.in_(values))
+    return query
+
+def search_ids(model, args, after=0):
+    """
+    The sorted ids above `after` whose name matches ?q=, None without ?q=. Word prefixes of the name,
+    from the in-memory index of /search: a substring LIKE scans the table.
+    """
+    text = args.get('q', '').strip()
+    # imported here, search.py imports cache.py which imports this module
+    from search import SEARCHABLE, matching_ids
+    if not text or model.__table__.name not in SEARCHABLE:
+        return None
+    ids = matching_ids(db.session, model.__table__.name, text)
+    return ids[bisect.bisect_right(ids, after):]
+
+def rows_in(query, model, ids, size):
+    # the rows of `query` with an id in `ids` (sorted), in order, one IN of at most `size` ids per statement
+    for start in range(0, len(ids), size):
+        for row in query.filter(model.id.in_(ids[start:start + size])).order_by(model.id).all():
+            yield row
+
+def insert_ignore(table):
+    # INSERT that skips the rows hitting a unique index instead of failing the whole statement
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if dialect == 'sqlite':
+        return sqlite.insert(table).on_conflict_do_nothing()
+    if dialect == 'mysql':
+        return table.insert().prefix_with('IGNORE')
+    return table.insert()
+
+def keyset_page(model, args):
+    """
+    Return one page of `model` ordered by id plus the response headers.
+    Pages are selected with `id > after` so the database walks the primary key index
+    instead of scanning (and the client never skips or repeats rows like with OFFSET).
+    Rows are read as tuples and turned into dicts by the model serializer (serializers.py).
+    """
+    limit = parse_int_arg(args, 'limit', default=current_app.config['PAGE_LIMIT_DEFAULT'],
+        minimum=1, maximum=current_app.config['PAGE_LIMIT_MAX'])
+    after = parse_int_arg(args, 'after', default=0)
+    columns = parse_fields(model, args)
+    encoder = serializer(model)
+
+    query = filter_query(model, encoder.query(columns), args)
+    ids = search_ids(model, args, after)
+    # fetch one extra row to know if there is a next page without a COUNT(*)
+    if ids is None:
+        rows = query.filter(model.id > after).order_by(model.id).limit(limit + 1).all()
+    else:
+        # the matches go limit + 1 at a time, the next ones are read only when the filters dropped some
+        rows = list(itertools.islice(rows_in(query, model, ids, limit + 1), limit + 1))
+    has_next = len(rows) > limit
+    rows = rows[:limit]
+
+    with timer('serialize'):
+        items = encoder.rows(rows, columns)
+
+    headers = {}
+    if has_next:
+        next_after = items[-1]['id']
+        headers['X-Next-Cursor'] = str(next_after)
+        next_url = url_for(request.endpoint, **dict(args.items(), after=next_after, limit=limit))
+        headers['Link'] = '<%s>; rel="next"' % next_url
+    return items, headers
+
+def response_format():
+    # NDJSON is only sent to clients that ask for it, anything else gets a JSON array
+    best = request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson'])
+    return 'ndjson' if best == 'application/x-ndjson' else 'json'
+
+def wants_stream():
+    return request.args.get('stream', None) == '1' or response_format() == 'ndjson'
+
+def stream_collection(model, args):
+    """
+    Stream every row of `model` after ?after= as a chunked JSON array (or NDJSON).
+    Rows come from a server-side cursor in batches of STREAM_BATCH_SIZE and are encoded one
+    by one, so the worker never holds the whole table nor the whole body in memory.
+    """
+    after = parse_int_arg(args, 'after', default=0)
+    columns = parse_fields(model, args)
+    batch_size = current_app.config['STREAM_BATCH_SIZE']
+    encoder = serializer(model)
+
+    query = filter_query(model, encoder.query(columns), args)
+    ids = search_ids(model, args, after)
+
+    def items():
+        if ids is None:
+            rows = iter(query.filter(model.id > after).order_by(model.id).yield_per(batch_size))
+        else:
+            rows = rows_in(query, model, ids, batch_size)
+        while True:
+            # the relationship summaries are loaded once per batch
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                return
+            for item in encoder.rows(batch, columns):
+                yield item
+
+    if response_format() == 'ndjson':
+        def generate():
+            for item in items():
+                yield json.dumps(item) + '\n'
+        mimetype = 'application/x-ndjson'
+    else:
+        def generate():
+            separator = '['
+            for item in items():
+                yield separator + json.dumps(item)
+                separator = ','
+            yield ']\n' if separator == ',' else '[]\n'
+        mimetype = 'application/json'
+
+    return current_app.response_class(stream_with_context(generate()), mimetype=mimetype)
+
 def has_no_empty_params(rule):
     defaults = rule.defaults if rule.defaults is not None else ()
     arguments = rule.arguments if rule.arguments is not None else ()
     return len(defaults) >= len(arguments)
 
 def generate_sitemap(app):
-    links = ['/admin/']
+    # Flask-Admin is only set up by the processes with the admin role
+    links = ['/admin/'] if 'admin' in app.config['APP_ROLES'] else []
     for rule in app.url_map.iter_rules():
         # Filter out rules we can't navigate to in a browser
         # and rules that require parameters
@@ -1,7 +1,11 @@
 # This file was created to run the application on heroku using gunicorn.
 # Read more about it here: https://devcenter.heroku.com/articles/python-gunicorn
 
-from main import app as application
+# built at import: with `gunicorn --preload` (GUNICORN_PRELOAD=1) once in the master, and the
+# workers are forked from it already warm. APP_ROLES picks what this node serves, see main.py
+from main import create_app
+
+application = create_app()
 
 if __name__ == "__main__":
     application.run()
@@ -0,0 +1,102 @@
+"""
+Fixtures: the app of main.py (api role) against a scratch SQLite database, and a few helpers
+to fill the catalog and talk to the endpoints with a valid token.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+TEST_JWT_SECRET = 'test-secret-test-secret-test-secret-test'
+
+@pytest.fixture
+def make_app(monkeypatch):
+    """Build the app for `roles` with the given settings (env variables), in-memory SQLite by default."""
+    import main
+    from models import db
+
+    def make(db_url='sqlite://', roles=('api',), **env):
+        monkeypatch.setenv('DB_CONNECTION_STRING', db_url)
+        monkeypatch.setenv('JWT_SECRET_KEY', TEST_JWT_SECRET)
+        monkeypatch.setenv('RATE_LIMIT_ENABLED', '0')
+        monkeypatch.setenv('CACHE_ENABLED', '0')
+        for key, value in env.items():
+            monkeypatch.setenv(key, str(value))
+        app = main.create_app(list(roles))
+        app.config['TESTING'] = True
+        with app.app_context():
+            db.create_all()
+        return app
+
+    yield make
+    reset_process_state()
+
+@pytest.fixture
+def app(make_app):
+    return make_app()
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+@pytest.fixture
+def auth(app):
+    return login(app)
+
+def login(app, email='luke@starwars.com'):
+    """Authorization header of a new user."""
+    from flask_jwt_extended import create_access_token
+    from models import db, User
+    with app.app_context():
+        user = User(email=email, password='-', is_active=True)
+        db.session.add(user)
+        db.session.commit()
+        return {"Authorization": "Bearer " + create_access_token(identity=user.id)}
+
+def reset_process_state():
+    # the caches and indexes live in the modules, one test must not see the rows of another
+    from cache import all_caches
+    from popular import leaderboard
+    from search import search_index
+    from read_model import settings
+    for cache in all_caches:
+        cache.clear()
+    leaderboard.expire()
+    search_index.invalidate()
+    settings["enabled"] = False
+
+def add_planets(count, characters_per_planet=2):
+    """Planets with a few characters each, in the current app context."""
+    from models import db, Planet, Character
+    planets = [Planet(name='Planet %d' % i, population=1000, terrain='desert') for i in range(count)]
+    db.session.add_all(planets)
+    db.session.flush()
+    db.session.add_all([Character(name='Character %d-%d' % (planet.id, i), height=170, mass=70, birth_year='19BBY', gender='male', planet_id=planet.id)
+        for planet in planets for i in range(characters_per_planet)])
+    db.session.commit()
+    return planets
+
+class StatementCounter:
+    """Records the (statement, parameters) sent to `engine` while active."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append((statement, parameters))
+
+    def __enter__(self):
+        from sqlalchemy import event
+        event.listen(self.engine, 'before_cursor_execute', self.on_execute)
+        return self
+
+    def __exit__(self, *args):
+        from sqlalchemy import event
+        event.remove(self.engine, 'before_cursor_execute', self.on_execute)
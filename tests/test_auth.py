@@ -0,0 +1,65 @@
+"""
+Login and registration: malformed credentials are refused before hashing, plain text rows
+are upgraded on the first successful login only. A commit drops the cached identities of the
+users it changed.
+"""
+import pytest
+
+def add_user(app, email, password):
+    from models import db, User
+    with app.app_context():
+        db.session.add(User(email=email, password=password, is_active=True))
+        db.session.commit()
+
+def stored_password(app, email):
+    from models import db, User
+    with app.app_context():
+        return db.session.query(User.password).filter_by(email=email).scalar()
+
+@pytest.mark.parametrize('path', ['/register', '/login'])
+@pytest.mark.parametrize('body', [
+    {"email": "leia@starwars.com", "password": ""},
+    {"email": "leia@starwars.com", "password": None},
+    {"email": "leia@starwars.com", "password": 1234},
+    {"email": "leia@starwars.com", "password": ["alderaan"]},
+    {"email": "", "password": "alderaan"},
+    {"email": "leia@starwars.com"},
+    ["leia@starwars.com", "alderaan"],
+])
+def test_bad_credentials_are_refused(client, path, body):
+    response = client.post(path, json=body)
+    assert response.status_code == 400
+
+def test_plain_text_password_is_rehashed_on_login(app, client):
+    from auth import split_hash, verify_password
+    add_user(app, 'han@starwars.com', 'falcon')
+    response = client.post('/login', json={"email": "han@starwars.com", "password": "falcon"})
+    assert response.status_code == 200
+    stored = stored_password(app, 'han@starwars.com')
+    assert split_hash(stored) is not None
+    assert verify_password(stored, 'falcon')
+    assert client.post('/login', json={"email": "han@starwars.com", "password": "falcon"}).status_code == 200
+
+def test_wrong_password_leaves_the_row_unchanged(app, client):
+    add_user(app, 'han@starwars.com', 'falcon')
+    response = client.post('/login', json={"email": "han@starwars.com", "password": "kessel"})
+    assert response.status_code == 401
+    assert stored_password(app, 'han@starwars.com') == 'falcon'
+
+def test_identity_cache_drops_only_the_changed_users(app):
+    from models import db, User
+    from auth import load_identity, identity_cache
+    add_user(app, 'han@starwars.com', 'falcon')
+    add_user(app, 'chewie@starwars.com', 'falcon')
+    with app.app_context():
+        han, chewie = [db.session.query(User.id).filter_by(email=email).scalar() for email in ('han@starwars.com', 'chewie@starwars.com')]
+        assert load_identity(han).is_active and load_identity(chewie).is_active
+        db.session.get(User, han).is_active = False
+        db.session.commit()
+        assert str(han) not in identity_cache.entries
+        assert str(chewie) in identity_cache.entries
+        assert not load_identity(han).is_active
+        # another user written to the same table leaves the cached ones alone
+        db.session.add(User(email='lando@starwars.com', password='-', is_active=True))
+        db.session.commit()
+        assert str(han) in identity_cache.entries and str(chewie) in identity_cache.entries
@@ -0,0 +1,61 @@
+"""
+Conditional GET on compressed responses: the ETag suffix is the content coding actually sent.
+"""
+import pytest
+from conftest import add_planets, login, StatementCounter
+
+BROWSER = 'gzip, deflate, br'
+
+@pytest.mark.parametrize('cache_enabled', ['0', '1'])
+def test_compressed_etag_revalidates(make_app, cache_enabled):
+    app = make_app(CACHE_ENABLED=cache_enabled)
+    headers = login(app)
+    with app.app_context():
+        add_planets(20)
+    client = app.test_client()
+    response = client.get('/planet', headers=dict(headers, **{"Accept-Encoding": BROWSER}))
+    assert response.status_code == 200
+    encoding = response.headers['Content-Encoding']
+    etag = response.headers['ETag']
+    assert etag.endswith('-%s"' % encoding)
+    response = client.get('/planet', headers=dict(headers, **{"Accept-Encoding": BROWSER, "If-None-Match": etag}))
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+
+def test_invalidate_drops_only_the_tagged_entries():
+    from cache import LRUCache, all_caches
+    cache = LRUCache(maxsize=3)
+    all_caches.remove(cache)
+    cache.set('planets', 1, ('planet', 'character'))
+    cache.set('films', 2, ('film',))
+    cache.set('plain', 3)
+    cache.set('films', 4, ('film', 'planet'))
+    cache.invalidate(['character'])
+    assert cache.get('planets') is None
+    assert cache.get('films') == 4
+    # the re-tagged entry goes with its new tables, evicted entries leave no tags behind
+    cache.set('users', 5, ('user',))
+    cache.set('more', 6, ('user',))
+    assert 'plain' not in cache.entries
+    cache.invalidate(['planet', 'user'])
+    assert list(cache.entries) == []
+    assert cache.tagged == {}
+
+def test_table_versions_are_bumped_once_in_sorted_order_at_commit(app):
+    from models import db, Planet, Film
+    from cache import current_versions
+    with app.app_context():
+        before = dict(current_versions(['film', 'planet']))
+        with StatementCounter(db.engine) as counter:
+            db.session.add(Planet(name='Tatooine', population=200000, terrain='desert'))
+            db.session.flush()
+            assert not [s for s, p in counter.statements if 'table_version' in s]
+            db.session.add(Film(title='A New Hope', episode_id=4, producer='Gary Kurtz', director='George Lucas', release_date='1977-05-25'))
+            db.session.flush()
+            db.session.add(Planet(name='Hoth', population=0, terrain='tundra'))
+            db.session.commit()
+        # an UPDATE per table, plus the INSERT of its row the first time
+        bumped = [next(v for v in p if isinstance(v, str)) for s, p in counter.statements if s.startswith('UPDATE table_version')]
+        assert bumped == ['film', 'planet']
+        after = dict(current_versions(['film', 'planet']))
+    assert after == {table: version + 1 for table, version in before.items()}
@@ -0,0 +1,133 @@
+"""
+POST /user/<tid>/favorites: the same validation with and without group commit, and a concurrent
+duplicate answers like an existing favorite, a row the database refuses fails only its own request
+in a group commit batch. Every favorite endpoint keeps favorite_count and
+/popular equal to a GROUP BY over the favorite table.
+"""
+import pytest
+from sqlalchemy import event
+from conftest import login
+
+FAVORITE = {"favorite_type": "p", "favorite_id": 1, "favorite_name": "Tatooine"}
+
+@pytest.mark.parametrize('group_commit', ['0', '1'])
+@pytest.mark.parametrize('body', [
+    None,
+    [FAVORITE],
+    dict(FAVORITE, favorite_id='1'),
+    dict(FAVORITE, favorite_type=None),
+    dict(FAVORITE, favorite_name=''),
+    {"favorite_type": "p", "favorite_id": 1},
+    dict(FAVORITE, favorite_id=True),
+    dict(FAVORITE, favorite_id=2 ** 31),
+    dict(FAVORITE, favorite_id=-2 ** 31 - 1),
+    dict(FAVORITE, favorite_type='pp'),
+    dict(FAVORITE, favorite_name='x' * 251),
+])
+def test_invalid_favorite_is_rejected(make_app, group_commit, body):
+    app = make_app(FAVORITES_GROUP_COMMIT=group_commit)
+    headers = login(app)
+    response = app.test_client().post('/user/1/favorites', headers=headers, json=body)
+    assert response.status_code == 400
+
+def test_concurrent_duplicate_returns_the_stored_favorite(make_app, tmp_path):
+    from models import db, Favorite
+    app = make_app('sqlite:///%s' % tmp_path.joinpath('favorites.db'))
+    headers = login(app)
+    with app.app_context():
+        engine = db.engine
+
+    # another request stores the same favorite between the lookup and the insert of this one
+    inserted = []
+
+    def insert_first(session, flush_context, instances):
+        if not inserted and any(isinstance(obj, Favorite) for obj in session.new):
+            inserted.append(True)
+            with engine.begin() as connection:
+                connection.execute(Favorite.__table__.insert().values(user_id=1, **FAVORITE))
+
+    event.listen(db.session, 'before_flush', insert_first)
+    try:
+        response = app.test_client().post('/user/1/favorites', headers=headers, json=FAVORITE)
+    finally:
+        event.remove(db.session, 'before_flush', insert_first)
+    assert inserted
+    assert response.status_code == 200
+    assert response.get_json()["favorite_id"] == 1
+    with app.app_context():
+        assert Favorite.query.count() == 1
+
+@pytest.mark.parametrize('group_commit', ['0', '1'])
+def test_popular_counts_follow_every_favorite_endpoint(make_app, tmp_path, group_commit):
+    from sqlalchemy import func
+    from models import db, User, Favorite, FavoriteCount
+    from conftest import add_planets
+    app = make_app('sqlite:///%s' % tmp_path.joinpath('favorites.db'), FAVORITES_GROUP_COMMIT=group_commit)
+    luke, leia = login(app, 'luke@starwars.com'), login(app, 'leia@starwars.com')
+    with app.app_context():
+        planets = [(planet.id, planet.name) for planet in add_planets(4, characters_per_planet=0)]
+        users = dict(db.session.query(User.email, User.id))
+    client = app.test_client()
+
+    def favorite(id, name):
+        return {"favorite_type": "p", "favorite_id": id, "favorite_name": name}
+
+    def post(headers, email, body):
+        response = client.post('/user/%d/favorites' % users[email], headers=headers, json=body)
+        assert response.status_code == 200
+        return response.get_json()
+
+    def check():
+        with app.app_context():
+            actual = dict(((t, i), n) for t, i, n in db.session.query(Favorite.favorite_type, Favorite.favorite_id, func.count())
+                .group_by(Favorite.favorite_type, Favorite.favorite_id))
+            stored = dict(((row.favorite_type, row.favorite_id), row.count) for row in FavoriteCount.query if row.count)
+        assert stored == actual
+        response = client.get('/popular?type=p&limit=10', headers=luke)
+        assert response.status_code == 200
+        assert dict((("p", row["favorite_id"]), row["count"]) for row in response.get_json()) == actual
+
+    # single POST, the same favorite twice is counted once
+    tatooine = post(luke, 'luke@starwars.com', favorite(*planets[0]))
+    post(luke, 'luke@starwars.com', favorite(*planets[0]))
+    post(leia, 'leia@starwars.com', favorite(*planets[0]))
+    check()
+    # batch POST, with one favorite the user already has
+    response = client.post('/user/%d/favorites/batch' % users['luke@starwars.com'], headers=luke,
+        json=[favorite(*planet) for planet in planets])
+    assert response.status_code == 200 and response.get_json()["created"] == 3
+    check()
+    # batch DELETE, with one favorite the user does not have
+    response = client.delete('/user/%d/favorites/batch' % users['luke@starwars.com'], headers=luke,
+        json=[favorite(*planets[1]), favorite(*planets[2]), {"favorite_type": "p", "favorite_id": 999}])
+    assert response.status_code == 200 and response.get_json()["deleted"] == 2
+    check()
+    # DELETE /favorite/<id>
+    assert client.delete('/favorite/%d' % tatooine["id"], headers=luke).status_code == 200
+    check()
+
+def test_group_commit_retries_a_failed_batch_row_by_row(make_app, tmp_path):
+    import threading
+    from group_commit import GroupCommitter
+    from utils import APIException
+    app = make_app('sqlite:///%s' % tmp_path.joinpath('favorites.db'))
+    login(app)
+    writer = GroupCommitter(app, wait_ms=500, max_items=2)
+    results = {}
+
+    def submit(name, row):
+        try:
+            results[name] = writer.submit(row)
+        except Exception as error:
+            results[name] = error
+
+    # favorite_name is NOT NULL: the bad row fails the INSERT of the whole batch
+    threads = [threading.Thread(target=submit, args=(name, dict(user_id=1, favorite_type='p', favorite_id=id, favorite_name=name)))
+        for name, id in (('Tatooine', 1), (None, 2))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results['Tatooine']["favorite_name"] == 'Tatooine'
+    assert isinstance(results[None], Exception) and not isinstance(results[None], APIException)
+    assert writer.stats()["split_batches"] == 1
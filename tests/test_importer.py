@@ -0,0 +1,58 @@
+"""
+flask import-swapi: ids come from the database, the import can be run again.
+"""
+import json
+import pytest
+
+PLANETS = [
+    {"name": "Tatooine", "population": "200000", "terrain": "desert", "url": "https://swapi.dev/api/planets/1/"},
+    {"name": "Alderaan", "population": "2000000000", "terrain": "grasslands", "url": "https://swapi.dev/api/planets/2/"},
+]
+PEOPLE = [
+    {"name": "Luke Skywalker", "height": "172", "mass": "77", "birth_year": "19BBY", "gender": "male",
+     "homeworld": "https://swapi.dev/api/planets/1/", "url": "https://swapi.dev/api/people/1/"},
+    {"name": "Leia Organa", "height": "150", "mass": "49", "birth_year": "19BBY", "gender": "female",
+     "homeworld": "https://swapi.dev/api/planets/2/", "url": "https://swapi.dev/api/people/5/"},
+]
+FILMS = [
+    {"title": "A New Hope", "episode_id": 4, "characters": ["https://swapi.dev/api/people/1/", "https://swapi.dev/api/people/5/"],
+     "planets": ["https://swapi.dev/api/planets/2/"], "url": "https://swapi.dev/api/films/1/"},
+]
+
+FLAG = 'insert_executemany_returning_sort_by_parameter_order'
+
+@pytest.mark.parametrize('returning', [True, False, None])
+def test_import_assigns_ids_in_the_database(app, tmp_path, monkeypatch, returning):
+    from models import db, Planet, Character, Film
+    tmp_path.joinpath('planets.json').write_text(json.dumps(PLANETS))
+    tmp_path.joinpath('people.ndjson').write_text('\n'.join(map(json.dumps, PEOPLE)))
+    tmp_path.joinpath('films.json').write_text(json.dumps(FILMS))
+    with app.app_context():
+        if returning is False:
+            # like MySQL: no RETURNING on executemany
+            monkeypatch.setattr(db.engine.dialect, FLAG, False)
+        elif returning is None:
+            # like SQLAlchemy 1.4: no such flag at all
+            for cls in type(db.engine.dialect).__mro__:
+                if FLAG in vars(cls):
+                    monkeypatch.delattr(cls, FLAG)
+            assert not hasattr(db.engine.dialect, FLAG)
+        db.session.add(Planet(name='Hoth', population=0, terrain='tundra'))
+        db.session.commit()
+
+    runner = app.test_cli_runner()
+    for _ in range(2):
+        result = runner.invoke(args=['import-swapi', str(tmp_path)])
+        assert result.exit_code == 0, result.output
+
+    with app.app_context():
+        planets = dict(db.session.query(Planet.name, Planet.id))
+        assert sorted(planets) == ['Alderaan', 'Hoth', 'Tatooine']
+        luke = Character.query.filter_by(name='Luke Skywalker').one()
+        assert luke.planet_id == planets['Tatooine']
+        film = Film.query.one()
+        assert sorted(c.name for c in film.characters) == ['Leia Organa', 'Luke Skywalker']
+        assert [p.name for p in film.planets] == ['Alderaan']
+        # the next insert of the API or the admin gets a free id
+        db.session.add(Planet(name='Bespin', population=0, terrain='gas giant'))
+        db.session.commit()
@@ -0,0 +1,54 @@
+"""
+EXPLAIN QUERY PLAN of the statements the endpoints send: the lookups search an index, none
+of them scans a table.
+"""
+from conftest import add_planets, StatementCounter
+
+def plan(engine, statement, parameters):
+    with engine.connect() as connection:
+        rows = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+    return [row[-1] for row in rows]
+
+def statements(app, headers, method, path, json=None):
+    from models import db
+    with app.app_context():
+        engine = db.engine
+    with StatementCounter(engine) as counter:
+        response = app.test_client().open(path, method=method, headers=headers, json=json)
+    assert response.status_code == 200, response.get_data()
+    return engine, counter.statements
+
+def plan_of(app, headers, method, path, marker, json=None):
+    engine, sent = statements(app, headers, method, path, json)
+    matching = [(statement, parameters) for statement, parameters in sent if marker in statement]
+    assert matching, 'no statement with %r in %s' % (marker, [s for s, p in sent])
+    return plan(engine, *matching[0])
+
+def assert_searches(details, index):
+    assert not any(detail.startswith('SCAN') for detail in details), details
+    assert any(index in detail for detail in details), details
+
+def test_favorite_lookups_use_the_unique_index(app, auth):
+    client = app.test_client()
+    response = client.post('/user/1/favorites', headers=auth, json={"favorite_type": "p", "favorite_id": 1, "favorite_name": "Tatooine"})
+    assert response.status_code == 200
+    details = plan_of(app, auth, 'POST', '/favorite', 'FROM favorite', json={"user_id": 1, "favorite_type": "p", "favorite_id": 1})
+    assert_searches(details, 'USING INDEX ix_favorite_user_type_id')
+    details = plan_of(app, auth, 'GET', '/user/1/favorites', 'FROM favorite')
+    assert_searches(details, 'USING INDEX ix_favorite_user_type_id')
+
+def test_planet_summaries_use_the_planet_id_index(app, auth):
+    with app.app_context():
+        add_planets(5)
+    details = plan_of(app, auth, 'GET', '/planet', 'character.planet_id IN')
+    assert_searches(details, 'USING INDEX ix_character_planet_id')
+    details = plan_of(app, auth, 'GET', '/planet/1?include=species', 'specie.planet_id IN')
+    assert_searches(details, 'USING INDEX ix_specie_planet_id')
+
+def test_keyset_pages_search_the_primary_key(app, auth):
+    with app.app_context():
+        add_planets(5)
+    details = plan_of(app, auth, 'GET', '/planet?after=2', 'planet.id >')
+    assert_searches(details, 'USING INTEGER PRIMARY KEY')
+    details = plan_of(app, auth, 'GET', '/character?planet_id=1&after=1', 'character.id >')
+    assert_searches(details, 'USING INDEX ix_character_planet_id')
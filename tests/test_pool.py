@@ -0,0 +1,46 @@
+"""
+Concurrent requests against a small pool queue for a connection, they don't fail.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import text
+from conftest import login
+
+def test_small_pool_bounds_checkout_wait(make_app, tmp_path):
+    from models import db
+    from database import pool_stats
+    app = make_app('sqlite:///%s' % tmp_path.joinpath('pool.db'), DB_POOL_SIZE=2, DB_MAX_OVERFLOW=0, DB_POOL_TIMEOUT=10)
+
+    in_use = []
+    lock = threading.Lock()
+
+    # a request holding its connection for a while, like a slow query
+    @app.route('/slow')
+    def slow():
+        db.session.execute(text('SELECT 1'))
+        with lock:
+            in_use.append(db.engine.pool.checkedout())
+        time.sleep(0.05)
+        return 'ok'
+
+    headers = login(app)
+    before = pool_stats.stats()
+    local = threading.local()
+
+    def request(i):
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+        return local.client.get('/slow', headers=headers).status_code
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        statuses = list(pool.map(request, range(32)))
+    after = pool_stats.stats()
+
+    assert statuses == [200] * 32
+    assert max(in_use) <= 2
+    assert after["timeouts"] == before["timeouts"]
+    assert after["exhausted"] > before["exhausted"]
+    # 8 threads for 2 connections: a checkout waits for the few requests ahead of it (~0.2 s)
+    assert after["max_wait_seconds"] < min(2, app.config['DB_POOL_TIMEOUT'])
+    assert app.test_client().get('/health').get_json()["pool"]["size"] == 2
@@ -0,0 +1,22 @@
+"""
+The collection endpoints run a fixed number of statements, whatever the number of rows.
+"""
+from conftest import add_planets, login, StatementCounter
+
+def test_planet_page_statements_do_not_grow_with_rows(make_app):
+    from models import db
+    counts = []
+    for rows in (10, 1000):
+        app = make_app()
+        headers = login(app)
+        with app.app_context():
+            add_planets(rows)
+            engine = db.engine
+        with StatementCounter(engine) as counter:
+            response = app.test_client().get('/planet?limit=1000', headers=headers)
+        assert response.status_code == 200
+        planets = response.get_json()
+        assert len(planets) == rows
+        assert all(len(planet["characters"]) == 2 for planet in planets)
+        counts.append(counter.count)
+    assert counts[0] == counts[1]
@@ -0,0 +1,60 @@
+"""
+The SQLite rate limit backend under lock contention: short retries, then the request goes through.
+RATE_LIMITS only names endpoints that exist, buckets are per user or per client address.
+"""
+import sqlite3
+import pytest
+from conftest import login
+
+def test_locked_sqlite_backend_fails_open(make_app, tmp_path):
+    from ratelimit import admission_stats
+    path = tmp_path.joinpath('buckets.db')
+    app = make_app(RATE_LIMIT_ENABLED=1, RATE_LIMIT_BACKEND='sqlite:///%s' % path, RATE_LIMIT_DEFAULT='1/minute')
+    client = app.test_client()
+    assert client.get('/').status_code == 200
+    assert client.get('/').status_code == 429
+
+    # another process holding the write lock for longer than the backend waits
+    other = sqlite3.connect(str(path), isolation_level=None)
+    other.execute('BEGIN IMMEDIATE')
+    try:
+        errors = admission_stats.stats()["backend_errors"]
+        assert client.get('/').status_code == 200
+        assert admission_stats.stats()["backend_errors"] == errors + 1
+    finally:
+        other.execute('ROLLBACK')
+        other.close()
+    assert client.get('/').status_code == 429
+
+def test_default_limits_apply_to_the_registration_endpoint(make_app):
+    app = make_app(RATE_LIMIT_ENABLED=1)
+    client = app.test_client()
+    for _ in range(10):
+        assert client.post('/register', json={}).status_code == 400
+    assert client.post('/register', json={}).status_code == 429
+
+def test_unknown_endpoint_in_rate_limits_fails_at_startup(make_app):
+    with pytest.raises(ValueError, match='api.register'):
+        make_app(RATE_LIMIT_ENABLED=1, RATE_LIMITS='api.login=10/minute,api.register=10/minute')
+
+def test_health_is_exempt(make_app):
+    app = make_app(RATE_LIMIT_ENABLED=1, RATE_LIMIT_DEFAULT='1/minute')
+    client = app.test_client()
+    assert [client.get('/health').status_code for _ in range(3)] == [200] * 3
+
+def test_users_behind_one_address_get_their_own_bucket(make_app):
+    app = make_app(RATE_LIMIT_ENABLED=1, RATE_LIMIT_DEFAULT='1/minute')
+    client = app.test_client()
+    luke, leia = login(app, 'luke@starwars.com'), login(app, 'leia@starwars.com')
+    assert client.get('/planet', headers=luke).status_code == 200
+    assert client.get('/planet', headers=leia).status_code == 200
+    assert client.get('/planet', headers=luke).status_code == 429
+
+@pytest.mark.parametrize('hops', [0, 1])
+def test_forwarded_clients_get_their_own_bucket_behind_a_proxy(make_app, hops):
+    app = make_app(RATE_LIMIT_ENABLED=1, RATE_LIMIT_DEFAULT='1/minute', PROXY_FIX_HOPS=hops)
+    client = app.test_client()
+    assert client.get('/', headers={'X-Forwarded-For': '10.0.0.1'}).status_code == 200
+    # without a trusted proxy the header is ignored, both requests come from the same address
+    assert client.get('/', headers={'X-Forwarded-For': '10.0.0.2'}).status_code == (200 if hops else 429)
+    assert client.get('/', headers={'X-Forwarded-For': '10.0.0.1'}).status_code == 429
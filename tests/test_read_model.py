@@ -0,0 +1,39 @@
+"""
+The read model documents follow the changes of the rows they embed.
+"""
+import json
+from conftest import add_planets, login
+
+def document(kind, entity_id):
+    from models import db, ReadModel
+    body = db.session.query(ReadModel.body).filter_by(kind=kind, entity_id=entity_id).scalar()
+    return json.loads(body)
+
+def character_ids(planet):
+    return sorted(character["id"] for character in planet["characters"])
+
+def test_moving_a_character_rebuilds_both_planets(make_app):
+    from models import db, Planet
+    from read_model import rebuild_all
+    app = make_app(READ_MODEL_ENABLED=1)
+    headers = login(app)
+    with app.app_context():
+        first, second = add_planets(2, characters_per_planet=2)
+        first_id, second_id = first.id, second.id
+        list(rebuild_all(db.session))
+        # the collection is loaded in the session before the change
+        planet = db.session.get(Planet, first_id)
+        character = planet.characters[0]
+        moved = character.id
+        character.planet_id = second_id
+        db.session.commit()
+
+        assert moved not in character_ids(document('planet', first_id))
+        assert moved in character_ids(document('planet', second_id))
+
+    client = app.test_client()
+    for planet_id in (first_id, second_id):
+        served = client.get('/planet/%d' % planet_id, headers=headers).get_json()
+        listed = client.get('/planet?ids=%d' % planet_id, headers=headers).get_json()["results"][0]
+        assert character_ids(served) == character_ids(listed)
+    assert moved not in character_ids(client.get('/planet/%d' % first_id, headers=headers).get_json())
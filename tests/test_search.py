@@ -0,0 +1,47 @@
+"""
+?q= on the collections matches word prefixes of the names through the /search index.
+"""
+from conftest import add_planets, StatementCounter
+
+def names(response):
+    assert response.status_code == 200
+    return sorted(planet["name"] for planet in response.get_json())
+
+def test_q_matches_word_prefixes(app, client, auth):
+    from models import db, Planet
+    with app.app_context():
+        planets = add_planets(3)
+        planets[0].name = 'Tatooine'
+        planets[1].name = 'Dagobah System'
+        hoth = planets[2].id
+        db.session.commit()
+    assert names(client.get('/planet?q=tat', headers=auth)) == ['Tatooine']
+    assert names(client.get('/planet?q=sys dag', headers=auth)) == ['Dagobah System']
+    assert names(client.get('/planet?q=oine', headers=auth)) == []
+    assert names(client.get('/planet?q=planet&fields=name', headers=auth)) == ['Planet 2']
+
+    # a rename is seen by the next request
+    with app.app_context():
+        db.session.get(Planet, hoth).name = 'Hoth'
+        db.session.commit()
+    assert names(client.get('/planet?q=ho', headers=auth)) == ['Hoth']
+
+def test_q_pages_send_at_most_a_page_of_ids(app, client, auth):
+    from models import db, Planet
+    with app.app_context():
+        planets = add_planets(50, characters_per_planet=0)
+        for planet in planets[::2]:
+            planet.terrain = 'swamp'
+        db.session.commit()
+        engine = db.engine
+    seen = []
+    url = '/planet?q=planet&terrain=desert&limit=5'
+    with StatementCounter(engine) as counter:
+        while url:
+            response = client.get(url, headers=auth)
+            seen += names(response)
+            url = response.headers.get('Link', '').partition('<')[2].partition('>')[0]
+    assert sorted(seen) == sorted('Planet %d' % i for i in range(1, 50, 2)) and len(seen) == 25
+    # 6 ids per IN (limit + 1), never the 50 matches
+    sizes = [len(parameters) for statement, parameters in counter.statements if 'FROM planet' in statement and ' IN (' in statement]
+    assert sizes and max(sizes) <= 6 + 1
@@ -0,0 +1,42 @@
+"""
+Thread safety under the gthread workers: every request gets its own session, and the session
+is removed (its connection back in the pool) when the request ends.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import text
+from conftest import login
+
+def test_concurrent_requests_get_their_own_session(make_app, tmp_path):
+    from models import db
+    app = make_app('sqlite:///%s' % tmp_path.joinpath('sessions.db'), DB_POOL_SIZE=8, DB_MAX_OVERFLOW=0)
+    headers = login(app)
+    sessions = {}
+    lock = threading.Lock()
+    # every request waits for the others, so all of them hold their session at the same time
+    barrier = threading.Barrier(8, timeout=10)
+
+    @app.route('/session')
+    def session():
+        db.session.execute(text('SELECT 1'))
+        with lock:
+            sessions[threading.get_ident()] = db.session()
+        barrier.wait()
+        # still the session of this request after the others started theirs
+        assert db.session() is sessions[threading.get_ident()]
+        return 'ok'
+
+    def request(i):
+        return app.test_client().get('/session', headers=headers).status_code
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        statuses = list(pool.map(request, range(8)))
+
+    assert statuses == [200] * 8
+    assert len(sessions) == 8
+    assert len(set(map(id, sessions.values()))) == 8
+    # removed on teardown: nothing left in the scoped registry, no transaction, no connection out
+    assert db.session.registry.registry == {}
+    assert not any(session.in_transaction() for session in sessions.values())
+    with app.app_context():
+        assert db.engine.pool.checkedout() == 0
@@ -0,0 +1,13 @@
+"""
+The sitemap at / lists the GET endpoints of the api blueprint, and /admin/ only where it is served.
+"""
+import pytest
+
+@pytest.mark.parametrize('roles', [('api',), ('api', 'admin')])
+def test_sitemap_links_admin_only_with_the_admin_role(make_app, roles):
+    app = make_app(roles=roles)
+    response = app.test_client().get('/')
+    assert response.status_code == 200
+    page = response.get_data(as_text=True)
+    assert "href='/planet'" in page and "href='/health'" in page
+    assert ("href='/admin/'" in page) == ('admin' in roles)